@@ -1,21 +1,26 @@
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QMainWindow, QPushButton, QVBoxLayout, QHBoxLayout, QLabel, QTextEdit, QFileDialog, QStackedWidget, QFrame, QSizePolicy
 )
-from PyQt6.QtCore import Qt, QTimer, pyqtSignal
-from PyQt6.QtGui import QDragEnterEvent, QDropEvent, QFont, QIcon, QPixmap
+from PyQt6.QtCore import Qt, QTimer, QObject, pyqtSignal
+from PyQt6.QtGui import QDragEnterEvent, QDropEvent, QFont, QIcon, QPixmap, QTextCursor
 import sys
 import os
 import wave
 import threading
 import time
 import datetime
+import hashlib
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
 # Import inference
 sys.path.append(os.path.join(os.path.dirname(__file__), 'inference'))   #
 try:
-    from inference import inference
+    from inference import get_session
+    from data.embedding_cache import EmbeddingCache
 except Exception as e:
-    inference = None
+    get_session = None
     print(f"inference import error: {e}")
 
 try:
@@ -24,6 +29,19 @@ try:
 except ImportError:
     PYAUDIO_AVAILABLE = False
 
+# Number of captions computed at the same time, they share one loaded model
+INFERENCE_WORKERS = int(os.environ.get("AUDIOCAPTION_WORKERS", "1"))
+
+# Live captions while recording: caption the last LIVE_WINDOW seconds every 
+# LIVE_HOP seconds, or slower if a caption takes longer than that
+LIVE_WINDOW = 10.
+LIVE_HOP = 2.
+RECORD_SR = 32000
+
+# Recordings up to this length are also kept in memory and captioned without 
+# reading the WAV file back
+MAX_CAPTURE_SECONDS = 600
+
 RECORD_DIR = os.path.join(os.path.dirname(__file__), 'recoding')
 if not os.path.exists(RECORD_DIR):
     os.makedirs(RECORD_DIR)
@@ -36,12 +54,214 @@ def get_next_wav_filename():
     next_num = max(nums) + 1 if nums else 1
     return os.path.join(RECORD_DIR, f"{next_num:03d}.wav")
 
+def format_latency(session):
+    stats = session.latency_stats()
+    if stats["warm_count"] == 0:
+        return f"Cold caption: {stats['cold_latency']:.2f} s"
+    return f"Warm caption: {session.warm_latencies[-1]:.2f} s (cold {stats['cold_latency']:.2f} s)"
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class InferenceWorker(QObject):
+    r"""Run captions on a bounded thread pool with one shared model. 
+    
+    Jobs wait in the executor queue. A file whose content is already queued 
+    or running is not submitted again, and pending jobs can be cancelled. 
+    Files are hashed for this check on their own thread, not on the GUI one. 
+    Partial captions of a job are emitted with the job key as tokens are 
+    sampled, the final caption is emitted with the same key.
+    """
+    caption_partial = pyqtSignal(str, str, bool)  # Job key, caption, final
+    progress = pyqtSignal(str)
+    pending_changed = pyqtSignal(int)
+
+    def __init__(self, max_workers=INFERENCE_WORKERS, parent=None):
+        super().__init__(parent)
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # One thread hashes submitted files in order, a long file does not 
+        # block the GUI thread
+        self.digest_executor = ThreadPoolExecutor(max_workers=1)
+        self.jobs = {}  # File digest -> Future
+        self.lock = threading.Lock()
+
+    def submit(self, audio_path, audio=None):
+        r"""Caption audio_path, or audio if given, an int16 waveform at 
+        RECORD_SR of the same recording. Returns immediately, the file is 
+        hashed and queued on the digest thread."""
+        if not get_session:
+            return False
+        self.digest_executor.submit(self._enqueue, audio_path, audio)
+        return True
+
+    def _enqueue(self, audio_path, audio=None):
+        name = os.path.basename(audio_path)
+        if audio is not None:
+            key = hashlib.blake2b(audio.data, digest_size=16).hexdigest()
+        else:
+            try:
+                key = file_digest(audio_path)
+            except OSError as e:
+                # Errors of the digest thread are not raised anywhere
+                self.progress.emit(f"Cannot read {name}: {e}")
+                return False
+        with self.lock:
+            if key in self.jobs:
+                self.progress.emit(f"{name} is already being analyzed, skipped")
+                return False
+            future = self.executor.submit(self._run, key, audio_path, audio)
+            self.jobs[key] = future
+            pending = len(self.jobs)
+        self.pending_changed.emit(pending)
+        if pending > self.max_workers:
+            self.progress.emit(f"{name} queued ({pending} jobs)")
+        future.add_done_callback(lambda f: self._on_done(key, name, f))
+        return True
+
+    def _run(self, key, audio_path, audio=None):
+        self.progress.emit(f"Analyzing {os.path.basename(audio_path)}, please wait...")
+        session = get_session()
+        if audio is not None:
+            stream = session.caption_stream(audio, sr=RECORD_SR)
+        else:
+            stream = session.caption_stream(audio_path)
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        result = ""
+        for result in stream:
+            self.caption_partial.emit(key, f"{now} AI Caption: {result} ...", False)
+        return result, format_latency(session)
+
+    def submit_live(self, audio):
+        r"""Caption a float32 waveform at RECORD_SR of a live recording. Live 
+        captions run on the same executor as the other jobs, so no more than 
+        max_workers captions run at once, and are kept out of the latency 
+        stats. Returns a Future of the caption."""
+        return self.executor.submit(self._run_live, audio)
+
+    def _run_live(self, audio):
+        return get_session().caption(audio, sr=RECORD_SR, record_latency=False)
+
+    def _on_done(self, key, name, future):
+        with self.lock:
+            self.jobs.pop(key, None)
+            pending = len(self.jobs)
+        self.pending_changed.emit(pending)
+        if future.cancelled():
+            self.progress.emit(f"{name} cancelled")
+            return
+        try:
+            result, latency = future.result()
+        except Exception as e:
+            self.caption_partial.emit(key, f"AI inference error: {e}", True)
+            return
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.caption_partial.emit(key, f"{now} AI Caption: {result}", True)
+        self.progress.emit(latency)
+
+    def cancel_pending(self):
+        with self.lock:
+            futures = list(self.jobs.values())
+        for future in futures:
+            future.cancel()  # Running jobs can not be cancelled and finish normally
+
+    def shutdown(self):
+        self.digest_executor.shutdown(wait=False, cancel_futures=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class AudioRingBuffer:
+    r"""The last seconds of int16 microphone audio."""
+
+    def __init__(self, seconds, sr=RECORD_SR):
+        self.buffer = np.zeros(int(seconds * sr), dtype=np.int16)
+        self.pos = 0  # Next write position
+        self.filled = 0
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        x = np.frombuffer(data, dtype=np.int16)[-len(self.buffer):]
+        n = len(x)
+        with self.lock:
+            first = min(n, len(self.buffer) - self.pos)
+            self.buffer[self.pos : self.pos + first] = x[:first]
+            self.buffer[: n - first] = x[first:]
+            self.pos = (self.pos + n) % len(self.buffer)
+            self.filled = min(self.filled + n, len(self.buffer))
+
+    def read_float(self):
+        r"""Buffered audio in time order as float32 in [-1, 1)."""
+        with self.lock:
+            if self.filled < len(self.buffer):
+                x = self.buffer[: self.filled].astype(np.float32)
+            else:
+                x = np.concatenate((self.buffer[self.pos:], self.buffer[: self.pos])).astype(np.float32)
+        x *= 1. / 32768
+        return x
+
+class WavStreamWriter:
+    r"""Write int16 mono audio to a WAV file from a background thread. 
+    
+    Frames wait in a bounded queue. The header is finalised by close()."""
+
+    def __init__(self, path, sr=RECORD_SR, max_queue_size=256):
+        self.wf = wave.open(path, 'wb')
+        self.wf.setnchannels(1)
+        self.wf.setsampwidth(2)
+        self.wf.setframerate(sr)
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        self.queue.put(data)
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            self.wf.writeframesraw(data)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.wf.close()  # Patches the data size in the header
+
+class CaptureBuffer:
+    r"""Preallocated int16 copy of a recording up to max_seconds. Longer
+    recordings stop being captured in memory."""
+
+    def __init__(self, max_seconds=MAX_CAPTURE_SECONDS, sr=RECORD_SR):
+        self.buffer = np.empty(int(max_seconds * sr), dtype=np.int16)
+        self.length = 0
+        self.overflow = False
+
+    def write(self, data):
+        if self.overflow:
+            return
+        x = np.frombuffer(data, dtype=np.int16)
+        if self.length + len(x) > len(self.buffer):
+            self.overflow = True
+            return
+        self.buffer[self.length : self.length + len(x)] = x
+        self.length += len(x)
+
+    def view(self):
+        r"""The captured audio without a copy, or None after an overflow."""
+        if self.overflow:
+            return None
+        return self.buffer[: self.length]
+
 class DragDropWidget(QFrame):
-    ai_caption = pyqtSignal(str)
     file_saved = pyqtSignal(str)
 
-    def __init__(self, parent=None):
+    def __init__(self, worker=None, parent=None):
         super().__init__(parent)
+        self.worker = worker
         self.setAcceptDrops(True)
         self.setFrameShape(QFrame.Shape.StyledPanel)
         self.label = QLabel("Drag or select a .wav file here", self)
@@ -79,30 +299,28 @@ class DragDropWidget(QFrame):
         with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
             dst.write(src.read())
         self.file_saved.emit(f"File saved to: {dst_path}")
-        if inference:
-            def run_infer():
-                self.file_saved.emit("Analyzing audio, please wait...")
-                try:
-                    result = inference(dst_path)
-                    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    self.ai_caption.emit(f"{now} AI Caption: {result}")
-                except Exception as e:
-                    self.ai_caption.emit(f"AI inference error: {e}")
-            threading.Thread(target=run_infer, daemon=True).start()
+        if self.worker:
+            self.worker.submit(dst_path)
 
 class RecordWidget(QFrame):
     record_status = pyqtSignal(str)
     record_time = pyqtSignal(str)
-    caption_result = pyqtSignal(str)  # Signal for AI caption result
+    live_caption = pyqtSignal(str)
 
-    def __init__(self, parent=None):
+    def __init__(self, worker=None, parent=None):
         super().__init__(parent)
+        self.worker = worker
         self.setFrameShape(QFrame.Shape.StyledPanel)
         self.layout = QVBoxLayout(self)
         self.record_btn = QPushButton("Record", self)
         self.record_btn.setFont(QFont("Tahoma", 13))
         self.record_btn.clicked.connect(self.start_record)
         self.layout.addWidget(self.record_btn)
+        self.live_btn = QPushButton("Live captions", self)
+        self.live_btn.setFont(QFont("Tahoma", 11))
+        self.live_btn.setCheckable(True)
+        self.live_btn.setToolTip("Caption the last seconds while recording")
+        self.layout.addWidget(self.live_btn)
         self.setLayout(self.layout)
         self.is_recording = False
         self.is_paused = False
@@ -117,16 +335,19 @@ class RecordWidget(QFrame):
         # Recording variables
         self.audio_thread = None
         self.audio_stream = None
-        self.audio_frames = []
+        self.capture = None
         self.wav_path = None
         self.p = None
         self.lock = threading.Lock()
+        self.ring_buffer = None
+        self.live_thread = None
 
     def start_record(self):
         if not PYAUDIO_AVAILABLE:
             self.record_status.emit("pyaudio is not installed, cannot record!")
             return
         self.record_btn.hide()
+        self.live_btn.setEnabled(False)
         self.pause_btn = QPushButton("Pause", self)
         self.pause_btn.setFont(QFont("Tahoma", 12))
         self.stop_btn = QPushButton("Stop", self)
@@ -143,9 +364,12 @@ class RecordWidget(QFrame):
         self.time_label.show()
         self.timer.start(1000)
         self.wav_path = get_next_wav_filename()
-        self.audio_frames = []
+        self.ring_buffer = AudioRingBuffer(LIVE_WINDOW) if self.live_btn.isChecked() else None
         self.audio_thread = threading.Thread(target=self.record_audio)
         self.audio_thread.start()
+        if self.ring_buffer is not None and self.worker and get_session:
+            self.live_thread = threading.Thread(target=self.live_captions, daemon=True)
+            self.live_thread.start()
         self.record_status.emit(f"Start recording... File will be saved to: {self.wav_path}")
 
     def update_time(self):
@@ -157,40 +381,59 @@ class RecordWidget(QFrame):
 
     def record_audio(self):
         self.p = pyaudio.PyAudio()
-        stream = self.p.open(format=pyaudio.paInt16, channels=1, rate=32000, input=True, frames_per_buffer=1024)
+        stream = self.p.open(format=pyaudio.paInt16, channels=1, rate=RECORD_SR, input=True, frames_per_buffer=1024)
         self.audio_stream = stream
+        # Stream frames to disk while recording, memory stays bounded
+        writer = WavStreamWriter(self.wav_path)
+        with self.lock:
+            self.capture = CaptureBuffer()
         while self.is_recording:
             if self.is_paused:
                 time.sleep(0.1)
                 continue
             data = stream.read(1024, exception_on_overflow=False)
+            writer.write(data)
             with self.lock:
-                self.audio_frames.append(data)
+                self.capture.write(data)
+            if self.ring_buffer is not None:
+                self.ring_buffer.write(data)
         stream.stop_stream()
         stream.close()
         self.p.terminate()
-        # Save wav
-        wf = wave.open(self.wav_path, 'wb')
-        wf.setnchannels(1)
-        wf.setsampwidth(self.p.get_sample_size(pyaudio.paInt16))
-        wf.setframerate(32000)
-        with self.lock:
-            for frame in self.audio_frames:
-                wf.writeframes(frame)
-        wf.close()
+        writer.close()
         self.record_status.emit(f"Recording saved: {os.path.basename(self.wav_path)}")
-        # After recording, automatically run inference
-        if inference:
-            # Use thread to avoid blocking UI
-            def run_infer():
-                self.record_status.emit("Analyzing audio, please wait...")
-                try:
-                    result = inference(self.wav_path)
-                    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    self.caption_result.emit(f"{now} AI Caption: {result}")
-                except Exception as e:
-                    self.caption_result.emit(f"AI inference error: {e}")
-            threading.Thread(target=run_infer, daemon=True).start()
+        # After recording, automatically run inference on the in-memory audio
+        if self.worker:
+            with self.lock:
+                audio = self.capture.view()
+                self.capture = None
+            self.worker.submit(self.wav_path, audio=audio)
+
+    def live_captions(self):
+        r"""Caption the ring buffer every hop while recording, through the 
+        inference worker. The hop grows with the measured caption latency, 
+        including the wait behind other jobs, so that captions never queue up."""
+        hop = LIVE_HOP
+        next_time = time.perf_counter() + hop
+        while self.is_recording:
+            if self.is_paused or time.perf_counter() < next_time:
+                time.sleep(0.05)
+                continue
+            audio = self.ring_buffer.read_float()
+            if len(audio) < RECORD_SR:
+                next_time = time.perf_counter() + 0.5
+                continue
+            t0 = time.perf_counter()
+            try:
+                caption = self.worker.submit_live(audio).result()
+            except Exception as e:
+                self.record_status.emit(f"Live caption error: {e}")
+                return
+            latency = time.perf_counter() - t0
+            hop = max(LIVE_HOP, 1.2 * latency)
+            next_time = t0 + hop
+            m, s = divmod(self.elapsed_seconds, 60)
+            self.live_caption.emit(f"[Live {m:02d}:{s:02d}] {caption}")
 
     def pause_record(self):
         if not self.is_paused:
@@ -206,6 +449,7 @@ class RecordWidget(QFrame):
         self.pause_btn.deleteLater()
         self.stop_btn.deleteLater()
         self.record_btn.show()
+        self.live_btn.setEnabled(True)
         self.is_recording = False
         self.is_paused = False
         self.timer.stop()
@@ -249,15 +493,25 @@ class StartPage(QWidget):
         self.output_box.setFont(QFont("Tahoma", 13))
         self.output_box.setStyleSheet("QTextEdit { color: #87CEFA; }")
         self.output_box.hide()  # Initially hidden
+        self.ai_blocks = {}  # Job key -> block number of its streaming caption
         
         # Add both to container
         output_container.layout().addWidget(self.image_label)
         output_container.layout().addWidget(self.output_box)
         
+        # Cancel pending captions
+        self.cancel_btn = QPushButton("Cancel pending", self)
+        self.cancel_btn.setFont(QFont("Tahoma", 11))
+        self.cancel_btn.hide()
+        output_container.layout().addWidget(self.cancel_btn, alignment=Qt.AlignmentFlag.AlignRight)
+
+        # One inference worker shared by recording and drag-and-drop
+        self.worker = InferenceWorker(parent=self)
+
         # Bottom area
         bottom_layout = QHBoxLayout()
-        self.record_widget = RecordWidget(self)
-        self.dragdrop_widget = DragDropWidget(self)
+        self.record_widget = RecordWidget(self.worker, self)
+        self.dragdrop_widget = DragDropWidget(self.worker, self)
         bottom_layout.addWidget(self.record_widget, 1)
         bottom_layout.addWidget(self.dragdrop_widget, 3)
         main_layout.addWidget(output_container, 2)
@@ -266,9 +520,12 @@ class StartPage(QWidget):
         # Connect signals
         self.record_widget.record_status.connect(self.append_left_output)
         self.record_widget.record_time.connect(self.show_time)
-        self.record_widget.caption_result.connect(self.append_ai_output)
-        self.dragdrop_widget.ai_caption.connect(self.append_ai_output)
+        self.record_widget.live_caption.connect(self.append_ai_output)
         self.dragdrop_widget.file_saved.connect(self.append_left_output)
+        self.worker.caption_partial.connect(self.update_ai_output)
+        self.worker.progress.connect(self.append_left_output)
+        self.worker.pending_changed.connect(self.update_pending)
+        self.cancel_btn.clicked.connect(self.worker.cancel_pending)
 
     def set_left_output(self, left_output_widget):
         self.left_output = left_output_widget
@@ -285,6 +542,23 @@ class StartPage(QWidget):
         html = f'<span style="color:#1976D2;">{msg}</span>'
         self.output_box.append(html)
 
+    def update_ai_output(self, key, msg, final):
+        # The first message of a job appends a block, later ones replace it
+        if key not in self.ai_blocks:
+            self.append_ai_output(msg)
+            self.ai_blocks[key] = self.output_box.document().blockCount() - 1
+        else:
+            block = self.output_box.document().findBlockByNumber(self.ai_blocks[key])
+            cursor = QTextCursor(block)
+            cursor.movePosition(QTextCursor.MoveOperation.EndOfBlock, QTextCursor.MoveMode.KeepAnchor)
+            cursor.insertHtml(f'<span style="color:#1976D2;">{msg}</span>')
+        if final:
+            self.ai_blocks.pop(key)
+
+    def update_pending(self, pending):
+        # Only jobs waiting for a worker can be cancelled
+        self.cancel_btn.setVisible(pending > self.worker.max_workers)
+
     def show_time(self, t):
         pass
 
@@ -435,6 +709,10 @@ class MainWindow(QMainWindow):
         main_layout.addWidget(self.stack, 2)
         self.setCentralWidget(main_widget)
         self.start_page.set_left_output(self.left_output)
+        # Load the models in the background so the first caption is fast
+        if get_session:
+            # Re-submitted recordings reuse their CNN14 embeddings
+            get_session(embedding_cache=EmbeddingCache()).warmup(background=True)
         self.start_btn.clicked.connect(self.show_start)
         self.About_btn.clicked.connect(self.show_about)
         self.show_start()
@@ -442,6 +720,10 @@ class MainWindow(QMainWindow):
     def show_start(self):
         self.stack.setCurrentWidget(self.start_page)
 
+    def closeEvent(self, event):
+        self.start_page.worker.shutdown()
+        super().closeEvent(event)
+
     def show_about(self):
         self.stack.setCurrentWidget(self.About_page)
         
@@ -0,0 +1,91 @@
+"""Compare the latency of top-k sampling and beam search on CPU.
+
+Usage: python benchmarks/beam_search.py [--ckpt_path inference/step=10000.pth]
+
+Without a checkpoint the decoder has random weights and rarely samples 
+[SEP], so every caption runs all max_new_tokens steps (worst case).
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.llama import Llama, LlamaConfig
+
+
+def get_model(ckpt_path: None | str) -> Llama:
+    config = LlamaConfig(
+        block_size=1024,
+        audio_latent_dim=2048,
+        vocab_size=30522,
+        n_layer=12,
+        n_head=12,
+        n_embd=768
+    )
+    model = Llama(config=config)
+    if ckpt_path:
+        model.load_state_dict(torch.load(ckpt_path, map_location="cpu"))
+    model.eval()
+    return model
+
+
+def decode(model: Llama, audio_latent: torch.Tensor, beam_size: None | int, args) -> float:
+
+    B = audio_latent.shape[0]
+    text_ids = torch.full((B, 1), fill_value=args.cls_token_id, dtype=torch.long)
+    seqs = [audio_latent, text_ids]
+    seq_types = ["audio", "text"]
+
+    t0 = time.perf_counter()
+
+    if beam_size is None:
+        model.generate(
+            seqs=seqs, 
+            seq_types=seq_types, 
+            max_new_tokens=args.max_new_tokens, 
+            temperature=1.0, 
+            top_k=200, 
+            eos_token_id=args.sep_token_id
+        )
+    else:
+        model.beam_search(
+            seqs=seqs, 
+            seq_types=seq_types, 
+            max_new_tokens=args.max_new_tokens, 
+            beam_size=beam_size, 
+            eos_token_id=args.sep_token_id
+        )
+
+    return time.perf_counter() - t0
+
+
+def main(args):
+
+    torch.set_num_threads(args.num_threads)
+    torch.manual_seed(1234)
+    model = get_model(args.ckpt_path)
+    audio_latent = torch.randn(args.batch_size, 1, model.config.audio_latent_dim)
+
+    for beam_size in [None, 1, 3, 5]:
+        latencies = [decode(model, audio_latent, beam_size, args) for _ in range(args.num_runs)]
+        latency = sorted(latencies)[len(latencies) // 2]
+        name = "sampling (top_k=200)" if beam_size is None else "beam_size={}".format(beam_size)
+        print("{}: {:.3f} s per batch of {}".format(name, latency, args.batch_size))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_path", type=str, default=None)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--max_new_tokens", type=int, default=20)
+    parser.add_argument("--cls_token_id", type=int, default=101)
+    parser.add_argument("--sep_token_id", type=int, default=102)
+    parser.add_argument("--num_runs", type=int, default=5)
+    parser.add_argument("--num_threads", type=int, default=4)
+    args = parser.parse_args()
+
+    main(args)
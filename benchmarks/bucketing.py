@@ -0,0 +1,205 @@
+"""Report the padded tokens eliminated and the training speed of length-bucketed
+batches trimmed to their longest captions, versus random batches padded to
+max_length. Also checks that trimming does not change caption_loss.
+
+Caption lengths are read from a caption index if given, otherwise sampled to
+resemble Clotho (8 to 20 words per caption).
+
+Usage:
+    python benchmarks/bucketing.py --device cuda
+    python benchmarks/bucketing.py --caption_index_dir ./caption_index
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.optim as optim
+from audidata.samplers import InfiniteSampler
+from torch.utils.data import DataLoader, default_collate
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.bucketing import BucketBatchSampler, TrimCollate
+from models.llama import Llama, LlamaConfig
+from train import caption_loss
+
+
+class SyntheticCaptions:
+    r"""Audio latents and padded token IDs of given caption lengths."""
+
+    def __init__(self, lengths: np.ndarray, max_length: int, audio_latent_dim: int, pad_token_id: int) -> None:
+        self.lengths = lengths
+        self.max_length = max_length
+        self.audio_latent_dim = audio_latent_dim
+        self.pad_token_id = pad_token_id
+
+    def __getitem__(self, index: int) -> dict:
+
+        rs = np.random.RandomState(index)
+        target = np.full(self.max_length, fill_value=self.pad_token_id, dtype=np.int64)
+        target[0 : self.lengths[index]] = rs.randint(1000, 2000, self.lengths[index])
+
+        data = {
+            "audio_latent": rs.randn(1, self.audio_latent_dim).astype(np.float32),
+            "target": target
+        }
+
+        return data
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+
+def get_lengths(args) -> np.ndarray:
+
+    if args.caption_index_dir:
+        offsets = np.load(Path(args.caption_index_dir, "offsets.npy"))
+        lengths = np.diff(offsets)
+    else:
+        rs = np.random.RandomState(1234)
+        lengths = rs.randint(8, 21, size=19195) + 2  # words, [CLS] and [SEP]
+
+    return np.minimum(lengths, args.max_length)
+
+
+def padding_fraction(dataloader: DataLoader, steps: int, max_length: int) -> tuple[float, float]:
+    r"""Fraction of padded tokens without and with trimming."""
+
+    padding = torch.zeros(2, dtype=torch.long)
+    total = 0
+
+    for step, data in enumerate(dataloader):
+        padding += data["padding"]
+        total += data["target"].shape[0] * max_length
+
+        if step == steps:
+            break
+
+    return padding[0].item() / total, padding[1].item() / total
+
+
+def steps_per_sec(
+    dataloader: DataLoader,
+    model: Llama,
+    optimizer: optim.Optimizer,
+    pad_token_id: int,
+    device: str,
+    steps: int,
+    warmup_steps: int = 3
+) -> float:
+
+    for step, data in enumerate(dataloader):
+
+        if step == warmup_steps:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+
+        input_seqs = [data["audio_latent"].to(device), data["target"].to(device)]
+        output_seqs = model(seqs=input_seqs, seq_types=["audio", "text"], compute_heads=[False, True])
+        loss = caption_loss(output_seqs=output_seqs, input_seqs=input_seqs, ignore_index=pad_token_id)
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        if step == warmup_steps + steps:
+            break
+
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+    return steps / (time.perf_counter() - t0)
+
+
+def main(args):
+
+    device = args.device
+    pad_token_id = 0
+    torch.manual_seed(1234)
+
+    config = LlamaConfig(
+        block_size=1024,
+        audio_latent_dim=2048,
+        vocab_size=30522,
+        n_layer=args.n_layer,
+        n_head=args.n_head,
+        n_embd=args.n_embd
+    )
+    model = Llama(config=config).to(device)
+    optimizer = optim.AdamW(params=model.parameters(), lr=1e-4)
+
+    lengths = get_lengths(args)
+    dataset = SyntheticCaptions(lengths, args.max_length, config.audio_latent_dim, pad_token_id)
+    collate_fn = TrimCollate(pad_token_id=pad_token_id)
+
+    random_dataloader = DataLoader(
+        dataset=dataset,
+        batch_size=args.batch_size,
+        sampler=InfiniteSampler(dataset),
+        collate_fn=collate_fn,
+        num_workers=args.num_workers
+    )
+    bucket_dataloader = DataLoader(
+        dataset=dataset,
+        batch_sampler=BucketBatchSampler(lengths=lengths, batch_size=args.batch_size),
+        collate_fn=collate_fn,
+        num_workers=args.num_workers
+    )
+
+    # Trimming does not change the loss
+    model.eval()
+    batch = [dataset[i] for i in range(args.batch_size)]
+    full = default_collate(batch)
+    trimmed = collate_fn(batch)
+    losses = []
+    with torch.no_grad():
+        for data in [full, trimmed]:
+            input_seqs = [data["audio_latent"].to(device), data["target"].to(device)]
+            output_seqs = model(seqs=input_seqs, seq_types=["audio", "text"], compute_heads=[False, True])
+            losses.append(caption_loss(output_seqs=output_seqs, input_seqs=input_seqs, ignore_index=pad_token_id).item())
+    print("Loss padded to {}: {:.6f}, trimmed to {}: {:.6f}".format(
+        full["target"].shape[1], losses[0], trimmed["target"].shape[1], losses[1]))
+
+    print("Mean caption length {:.1f} tokens, max_length {}".format(lengths.mean(), args.max_length))
+
+    for name, dataloader in [("random batches", random_dataloader), ("bucketed batches", bucket_dataloader)]:
+        before, after = padding_fraction(dataloader, args.steps, args.max_length)
+        print("{}: padded tokens {:.1%} -> {:.1%} after trimming, {:.1%} eliminated".format(
+            name, before, after, 1. - after / before))
+
+    padded_dataloader = DataLoader(
+        dataset=dataset,
+        batch_size=args.batch_size,
+        sampler=InfiniteSampler(dataset),
+        num_workers=args.num_workers
+    )
+
+    model.train()
+    for name, dataloader in [
+        ("padded to max_length", padded_dataloader),
+        ("random batches, trimmed", random_dataloader),
+        ("bucketed batches, trimmed", bucket_dataloader)
+    ]:
+        speed = steps_per_sec(dataloader, model, optimizer, pad_token_id, device, args.steps)
+        print("{}: {:.2f} steps/s".format(name, speed))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--caption_index_dir", type=str, default=None)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--max_length", type=int, default=30)
+    parser.add_argument("--n_layer", type=int, default=12)
+    parser.add_argument("--n_head", type=int, default=12)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--steps", type=int, default=20)
+    args = parser.parse_args()
+
+    main(args)
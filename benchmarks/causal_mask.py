@@ -0,0 +1,141 @@
+"""Compare attention masks of Llama.forward: a causal mask built on every
+forward (the old path), the cached causal mask buffer and the is_causal fast
+path of SDPA. Also check that key padding masks give the same outputs as
+unpadded sequences.
+
+Usage: python benchmarks/causal_mask.py --device cuda
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.llama import Llama, LlamaConfig, build_causal_mask, build_key_padding_mask
+
+
+def get_model(n_layer: int, n_head: int, n_embd: int, device: str) -> Llama:
+    config = LlamaConfig(
+        block_size=1024,
+        audio_latent_dim=2048,
+        vocab_size=30522,
+        n_layer=n_layer,
+        n_head=n_head,
+        n_embd=n_embd
+    )
+    model = Llama(config=config).to(device)
+    model.eval()
+    return model
+
+
+def timeit(func, num_runs: int, device: str) -> float:
+    r"""Median latency of func in seconds."""
+    latencies = []
+    for _ in range(num_runs):
+        if device == "cuda":
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        func()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        latencies.append(time.perf_counter() - t0)
+    return sorted(latencies)[len(latencies) // 2]
+
+
+def check_key_padding(model: Llama, device: str, pad_token_id: int = 0) -> None:
+    r"""Right padded rows must give the same logits as unpadded rows at valid 
+    steps. Left padded rows must not give NaN (fully masked padded queries)."""
+
+    torch.manual_seed(0)
+    audio_latent = torch.randn(2, 1, model.config.audio_latent_dim, device=device)
+    text_ids = torch.randint(1000, 2000, (2, 12), device=device)
+    seq_types = ["audio", "text"]
+    valid_len = 7
+
+    with torch.no_grad():
+
+        # Right padding
+        padded_ids = text_ids.clone()
+        padded_ids[1, valid_len :] = pad_token_id
+        seqs = [audio_latent, padded_ids]
+        key_padding_mask = build_key_padding_mask(seqs, seq_types, pad_token_id=pad_token_id)
+
+        out = model(seqs=seqs, seq_types=seq_types, key_padding_mask=key_padding_mask)[1]
+        ref = model(seqs=[audio_latent[1 :], padded_ids[1 :, 0 : valid_len]], seq_types=seq_types)[1]
+        assert torch.allclose(out[1 :, 0 : valid_len], ref, atol=1e-4), "Right padding output differs"
+
+        # Left padding of text only sequences
+        padded_ids = text_ids.clone()
+        padded_ids[1, 0 : 12 - valid_len] = pad_token_id
+        key_padding_mask = build_key_padding_mask([padded_ids], ["text"], pad_token_id=pad_token_id)
+
+        out = model(seqs=[padded_ids], seq_types=["text"], key_padding_mask=key_padding_mask)[0]
+        assert not torch.isnan(out).any(), "NaN outputs with left padding"
+
+    print("Key padding masks: right padding matches unpadded forward, no NaN with left padding.")
+
+
+def main(args):
+
+    device = args.device
+    torch.manual_seed(1234)
+    model = get_model(n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd, device=device)
+
+    check_key_padding(model, device)
+
+    # Attention only, so that the mask cost is not hidden by the MLPs
+    B, H, T = args.batch_size, args.n_head, args.seq_len
+    q, k, v = torch.randn(3, B, H, T, args.n_embd // args.n_head, device=device).unbind(0)
+
+    def built_mask():
+        mask = build_causal_mask(seq_len=T).to(device)
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+    def cached_mask():
+        mask = model.causal_mask[:, :, 0 : T, 0 : T]
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+    def is_causal():
+        return F.scaled_dot_product_attention(q, k, v, is_causal=True)
+
+    assert torch.allclose(built_mask(), is_causal(), atol=1e-5)
+
+    print("Attention, b={}, h={}, t={}:".format(B, H, T))
+    with torch.no_grad():
+        for name, func in [("built mask", built_mask), ("cached mask", cached_mask), ("is_causal", is_causal)]:
+            latency = timeit(func, num_runs=args.num_runs, device=device)
+            print("  {:<12} {:.3f} ms".format(name, latency * 1000))
+
+    # Full forward, e.g., a training step without gradients
+    audio_latent = torch.randn(B, 1, model.config.audio_latent_dim, device=device)
+    text_ids = torch.randint(1000, 2000, (B, T - 1), device=device)
+    seqs = [audio_latent, text_ids]
+    seq_types = ["audio", "text"]
+    old_mask = lambda: build_causal_mask(seq_len=T).to(device)
+
+    print("Llama.forward, b={}, t={}:".format(B, T))
+    with torch.no_grad():
+        for name, func in [
+            ("built mask", lambda: model(seqs=seqs, seq_types=seq_types, mask=old_mask())),
+            ("is_causal", lambda: model(seqs=seqs, seq_types=seq_types)),
+        ]:
+            latency = timeit(func, num_runs=args.num_runs, device=device)
+            print("  {:<12} {:.3f} ms".format(name, latency * 1000))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--n_layer", type=int, default=12)
+    parser.add_argument("--n_head", type=int, default=12)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--seq_len", type=int, default=64)
+    parser.add_argument("--num_runs", type=int, default=20)
+    args = parser.parse_args()
+
+    main(args)
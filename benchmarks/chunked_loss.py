@@ -0,0 +1,142 @@
+"""Compare the peak memory and speed of caption_loss() over full vocab logits
+with chunked_cross_entropy(), which computes text_head and the loss together
+in chunks of non-padded steps. Also checks that the losses and gradients match.
+
+Peak memory is the CUDA allocator peak, or the peak resident memory on Linux
+CPUs, above the memory in use before the loss.
+
+Usage: python benchmarks/chunked_loss.py --device cuda
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from train import caption_loss
+
+
+def read_rss(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def peak_memory(func, device: str) -> None | float:
+    r"""Peak memory in MB of func() above the memory in use before it."""
+
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        func()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - base) / 1e6
+
+    try:
+        # Reset the peak resident memory, Linux only
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return None
+
+    base = read_rss("VmRSS")
+    func()
+    return (read_rss("VmHWM") - base) / 1e6
+
+
+def steps_per_sec(func, device: str, steps: int, warmup_steps: int = 2) -> float:
+
+    for step in range(warmup_steps + steps):
+
+        if step == warmup_steps:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+
+        func()
+
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+    return steps / (time.perf_counter() - t0)
+
+
+def main(args):
+
+    device = args.device
+    torch.manual_seed(1234)
+
+    text_head = nn.Linear(args.n_embd, args.vocab_size, bias=False).to(device)
+
+    for batch_size in args.batch_sizes:
+
+        # Text latents and captions of 10 to 22 tokens padded to max_length
+        latent = torch.randn(batch_size, args.max_length, args.n_embd, device=device, requires_grad=True)
+        lengths = torch.randint(10, 23, (batch_size,), device=device)
+        text_ids = torch.randint(1000, 2000, (batch_size, args.max_length), device=device)
+        text_ids[torch.arange(args.max_length, device=device)[None, :] >= lengths[:, None]] = 0
+        input_seqs = [None, text_ids]
+
+        def full_loss():
+            output_seqs = [None, text_head(latent)]
+            return caption_loss(output_seqs=output_seqs, input_seqs=input_seqs, ignore_index=0)
+
+        def chunked_loss():
+            output_seqs = [None, latent]
+            return caption_loss(
+                output_seqs=output_seqs,
+                input_seqs=input_seqs,
+                ignore_index=0,
+                text_head=text_head,
+                chunk_size=args.chunk_size
+            )
+
+        def step(loss_func):
+            loss = loss_func()
+            loss.backward()
+            latent.grad = None
+            text_head.weight.grad = None
+
+        # Same loss and gradients
+        results = []
+        for loss_func in [full_loss, chunked_loss]:
+            loss = loss_func()
+            loss.backward()
+            results.append((loss.item(), latent.grad.clone(), text_head.weight.grad.clone()))
+            latent.grad = None
+            text_head.weight.grad = None
+
+        (loss_a, grad_a, grad_w_a), (loss_b, grad_b, grad_w_b) = results
+        valid_steps = int((text_ids[:, 1 :] != 0).sum())
+
+        print("b={}, t={}, {} of {} targets valid:".format(
+            batch_size, args.max_length - 1, valid_steps, batch_size * (args.max_length - 1)))
+        print("  loss {:.6f} vs {:.6f}, max gradient difference {:.2e} (latent), {:.2e} (text_head)".format(
+            loss_a, loss_b, (grad_a - grad_b).abs().max().item(), (grad_w_a - grad_w_b).abs().max().item()))
+
+        for name, loss_func in [("full logits", full_loss), ("chunked", chunked_loss)]:
+            peak = peak_memory(lambda: step(loss_func), device)
+            speed = steps_per_sec(lambda: step(loss_func), device, args.steps)
+            peak = "{:.1f} MB".format(peak) if peak is not None else "n/a"
+            print("  {:<12} peak memory {}, {:.2f} steps/s".format(name, peak, speed))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--max_length", type=int, default=30)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--vocab_size", type=int, default=30522)
+    parser.add_argument("--chunk_size", type=int, default=1024)
+    parser.add_argument("--steps", type=int, default=5)
+    args = parser.parse_args()
+
+    main(args)
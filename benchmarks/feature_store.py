@@ -0,0 +1,128 @@
+"""Compare training steps/sec of the raw audio pipeline (decode, resample,
+CNN14, decoder) with the precomputed feature store (decoder only).
+
+Usage:
+    python extract_features.py --clotho_root /datasets/clotho --output_dir ./features
+    python benchmarks/feature_store.py --clotho_root /datasets/clotho --feature_store_dir ./features
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torch.optim as optim
+from audidata.datasets import Clotho
+from audidata.io.crops import RandomCrop
+from audidata.samplers import InfiniteSampler
+from audidata.transforms import Mono
+from torch.utils.data import DataLoader
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.feature_store import ClothoFeatures
+from data.text_normalization import TextNormalization
+from data.text_tokenization import BertTokenizer
+from train import caption_loss, get_audio_encoder, get_audio_latent, get_llm_decoder
+
+
+def steps_per_sec(
+    dataloader: DataLoader,
+    audio_encoder: None | torch.nn.Module,
+    llm_decoder: torch.nn.Module,
+    optimizer: optim.Optimizer,
+    pad_token_id: int,
+    device: str,
+    steps: int,
+    warmup_steps: int = 5
+) -> float:
+
+    for step, data in enumerate(dataloader):
+
+        if step == warmup_steps:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+
+        text_ids = data["target"].to(device)
+
+        if audio_encoder is None:
+            audio_latent = data["audio_latent"].to(device)
+        else:
+            audio_latent = get_audio_latent(model_name="Cnn14", model=audio_encoder, audio=data["audio"].to(device))
+
+        input_seqs = [audio_latent, text_ids]
+        output_seqs = llm_decoder(seqs=input_seqs, seq_types=["audio", "text"], compute_heads=[False, True])
+        loss = caption_loss(output_seqs=output_seqs, input_seqs=input_seqs, ignore_index=pad_token_id)
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        if step == warmup_steps + steps:
+            break
+
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+    return steps / (time.perf_counter() - t0)
+
+
+def main(args):
+
+    device = args.device
+    target_transform = [TextNormalization(), BertTokenizer(max_length=30)]
+    pad_token_id = target_transform[1].tokenizer.pad_token_id
+
+    audio_encoder, audio_latent_dim = get_audio_encoder(model_name="Cnn14")
+    audio_encoder.to(device)
+
+    llm_decoder = get_llm_decoder(
+        model_name="Llama",
+        audio_latent_dim=audio_latent_dim,
+        text_vocab_size=target_transform[1].tokenizer.vocab_size
+    ).to(device)
+    optimizer = optim.AdamW(params=llm_decoder.parameters(), lr=1e-4)
+
+    raw_dataset = Clotho(
+        root=args.clotho_root,
+        split="train",
+        sr=32000,
+        crop=RandomCrop(clip_duration=10., end_pad=0.),
+        transform=Mono(),
+        target_transform=target_transform
+    )
+    feature_dataset = ClothoFeatures(root=Path(args.feature_store_dir, "train"), target_transform=target_transform)
+
+    for name, dataset, encoder in [("raw audio + CNN14", raw_dataset, audio_encoder), ("feature store", feature_dataset, None)]:
+        dataloader = DataLoader(
+            dataset=dataset,
+            batch_size=args.batch_size,
+            sampler=InfiniteSampler(dataset),
+            num_workers=args.num_workers,
+            pin_memory=device == "cuda"
+        )
+        speed = steps_per_sec(
+            dataloader=dataloader,
+            audio_encoder=encoder,
+            llm_decoder=llm_decoder,
+            optimizer=optimizer,
+            pad_token_id=pad_token_id,
+            device=device,
+            steps=args.steps
+        )
+        print("{}: {:.2f} steps/s".format(name, speed))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clotho_root", type=str, required=True)
+    parser.add_argument("--feature_store_dir", type=str, required=True)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_workers", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=50)
+    args = parser.parse_args()
+
+    main(args)
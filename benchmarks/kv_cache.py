@@ -0,0 +1,96 @@
+"""Check that cached decoding matches uncached decoding and compare their 
+speed on CPU.
+
+Usage: python benchmarks/kv_cache.py
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.llama import Llama, LlamaConfig
+
+
+def get_model(n_layer: int, n_head: int, n_embd: int) -> Llama:
+    config = LlamaConfig(
+        block_size=1024,
+        audio_latent_dim=2048,
+        vocab_size=30522,
+        n_layer=n_layer,
+        n_head=n_head,
+        n_embd=n_embd
+    )
+    model = Llama(config=config)
+    model.eval()
+    return model
+
+
+def generate(
+    model: Llama, 
+    batch_size: int, 
+    max_new_tokens: int, 
+    use_cache: bool, 
+    seed: int
+) -> tuple[torch.Tensor, float]:
+
+    torch.manual_seed(seed)
+    audio_latent = torch.randn(batch_size, 1, model.config.audio_latent_dim)
+    text_ids = torch.full((batch_size, 1), fill_value=101, dtype=torch.long)  # [CLS]
+
+    t0 = time.perf_counter()
+    outputs = model.generate(
+        seqs=[audio_latent, text_ids],
+        seq_types=["audio", "text"],
+        max_new_tokens=max_new_tokens,
+        temperature=1.0,
+        top_k=200,
+        use_cache=use_cache
+    )
+    latency = time.perf_counter() - t0
+
+    return outputs[-1], latency
+
+
+def main(args):
+
+    torch.set_num_threads(args.num_threads)
+    torch.manual_seed(1234)
+    model = get_model(n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd)
+
+    # Correctness: the same seed must give the same tokens
+    for seed in range(args.num_checks):
+        ids_cached, _ = generate(model, args.batch_size, args.max_new_tokens, use_cache=True, seed=seed)
+        ids_full, _ = generate(model, args.batch_size, args.max_new_tokens, use_cache=False, seed=seed)
+        assert torch.equal(ids_cached, ids_full), "Cached decoding differs with seed {}".format(seed)
+
+    print("Cached and uncached decoding match on {} seeds.".format(args.num_checks))
+
+    # Speed
+    for use_cache in [False, True]:
+        latencies = []
+        for seed in range(args.num_runs):
+            _, latency = generate(model, args.batch_size, args.max_new_tokens, use_cache=use_cache, seed=seed)
+            latencies.append(latency)
+
+        latency = sorted(latencies)[len(latencies) // 2]
+        tokens_per_sec = args.batch_size * args.max_new_tokens / latency
+        print("use_cache={}: {:.3f} s per caption, {:.1f} tokens/s".format(use_cache, latency, tokens_per_sec))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layer", type=int, default=12)
+    parser.add_argument("--n_head", type=int, default=12)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--max_new_tokens", type=int, default=20)
+    parser.add_argument("--num_checks", type=int, default=5)
+    parser.add_argument("--num_runs", type=int, default=5)
+    parser.add_argument("--num_threads", type=int, default=4)
+    args = parser.parse_args()
+
+    main(args)
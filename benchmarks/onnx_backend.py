@@ -0,0 +1,57 @@
+"""Check that the onnxruntime backend gives the same greedy captions as the 
+PyTorch backend on CPU and compare their latency.
+
+Usage: 
+    python inference/export_onnx.py
+    python benchmarks/onnx_backend.py recoding/
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inference"))
+from inference import InferenceSession
+from batch_caption import find_audio_paths
+
+
+def main(args):
+
+    paths = find_audio_paths(args.inputs)[0 : args.max_clips]
+    results = {}
+
+    for backend in ["torch", "onnx"]:
+        session = InferenceSession(device="cpu", top_k=1, backend=backend)
+        session.warmup()
+
+        captions = []
+        latencies = []
+        for path in paths:
+            t0 = time.perf_counter()
+            captions.append(session.caption(path))
+            latencies.append(time.perf_counter() - t0)
+
+        results[backend] = (captions, latencies)
+        print("{}: {:.3f} s per clip".format(backend, np.mean(latencies)))
+
+    mismatches = [
+        (path, a, b) for path, a, b in zip(paths, results["torch"][0], results["onnx"][0]) if a != b
+    ]
+
+    for path, a, b in mismatches:
+        print("Mismatch {}:\n  torch: {}\n  onnx:  {}".format(path, a, b))
+
+    print("Identical greedy captions: {}/{}".format(len(paths) - len(mismatches), len(paths)))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs="+", help="Audio files or directories")
+    parser.add_argument("--max_clips", type=int, default=50)
+    args = parser.parse_args()
+
+    main(args)
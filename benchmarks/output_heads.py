@@ -0,0 +1,121 @@
+"""Report the FLOPs and memory saved by computing output heads only where they
+are needed: last step text logits for decoding and no audio_head in training.
+
+Usage: python benchmarks/output_heads.py --device cuda
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.llama import Llama, LlamaConfig
+
+
+def get_model(n_layer: int, n_head: int, n_embd: int, device: str) -> Llama:
+    config = LlamaConfig(
+        block_size=1024,
+        audio_latent_dim=2048,
+        vocab_size=30522,
+        n_layer=n_layer,
+        n_head=n_head,
+        n_embd=n_embd
+    )
+    model = Llama(config=config).to(device)
+    return model
+
+
+def head_cost(steps: int, batch_size: int, n_embd: int, out_dim: int) -> tuple[float, float]:
+    r"""FLOPs of a bias-free Linear head and the MB of its fp32 outputs."""
+    flops = 2 * batch_size * steps * n_embd * out_dim
+    megabytes = batch_size * steps * out_dim * 4 / 1e6
+    return flops, megabytes
+
+
+def measure(func, device: str, num_runs: int) -> tuple[float, None | float]:
+    r"""Median latency in ms and peak CUDA memory in MB."""
+    latencies = []
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    for _ in range(num_runs):
+        if device == "cuda":
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        func()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        latencies.append(time.perf_counter() - t0)
+    latency = sorted(latencies)[len(latencies) // 2] * 1000
+    peak = torch.cuda.max_memory_allocated() / 1e6 if device == "cuda" else None
+    return latency, peak
+
+
+def report(name: str, latency: float, peak: None | float) -> None:
+    if peak is None:
+        print("  {:<24} {:.2f} ms".format(name, latency))
+    else:
+        print("  {:<24} {:.2f} ms, peak memory {:.1f} MB".format(name, latency, peak))
+
+
+def main(args):
+
+    device = args.device
+    torch.manual_seed(1234)
+    model = get_model(n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd, device=device)
+    config = model.config
+
+    B = args.batch_size
+    t_audio, t_text = 1, args.text_len
+    audio_latent = torch.randn(B, t_audio, config.audio_latent_dim, device=device)
+    text_ids = torch.randint(1000, 2000, (B, t_text), device=device)
+    seqs = [audio_latent, text_ids]
+    seq_types = ["audio", "text"]
+
+    # Analytic savings
+    text_flops, text_mb = head_cost(t_text, B, config.n_embd, config.vocab_size)
+    last_flops, last_mb = head_cost(1, B, config.n_embd, config.vocab_size)
+    audio_flops, audio_mb = head_cost(t_audio, B, config.n_embd, config.audio_latent_dim)
+
+    print("Per step, b={}, t_audio={}, t_text={}:".format(B, t_audio, t_text))
+    print("  Decoding prefill: text_head {:.2f} -> {:.2f} GFLOPs, logits {:.1f} -> {:.2f} MB, audio_head {:.3f} GFLOPs skipped".format(
+        text_flops / 1e9, last_flops / 1e9, text_mb, last_mb, audio_flops / 1e9))
+    print("  Training: audio_head {:.3f} GFLOPs forward and {:.3f} GFLOPs backward skipped, {:.2f} MB outputs".format(
+        audio_flops / 1e9, 2 * audio_flops / 1e9, audio_mb))
+
+    # Measured: decoding prefill
+    model.eval()
+    print("Prefill forward:")
+    with torch.no_grad():
+        for name, kwargs in [("all heads", {}), ("last_only", {"last_only": True})]:
+            func = lambda: model(seqs=seqs, seq_types=seq_types, **kwargs)
+            report(name, *measure(func, device, args.num_runs))
+
+    # Measured: training step
+    model.train()
+    print("Training forward and backward:")
+    for name, kwargs in [("all heads", {}), ("compute_heads", {"compute_heads": [False, True]})]:
+        def func():
+            outputs = model(seqs=seqs, seq_types=seq_types, **kwargs)
+            loss = outputs[1].float().logsumexp(dim=-1).mean()
+            if outputs[0] is not None:
+                loss = loss + 0. * outputs[0].mean()  # The audio output is not in caption_loss
+            loss.backward()
+            model.zero_grad(set_to_none=True)
+        report(name, *measure(func, device, args.num_runs))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--n_layer", type=int, default=12)
+    parser.add_argument("--n_head", type=int, default=12)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--text_len", type=int, default=32)
+    parser.add_argument("--num_runs", type=int, default=10)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,134 @@
+"""Check that packed training gives the same loss and gradients as unpacked
+training, and compare the examples/sec of padded batches with packed rows.
+
+Caption lengths are sampled to resemble Clotho (8 to 20 words per caption).
+
+Usage: python benchmarks/packing.py --device cuda
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.packing import pack_captions
+from models.llama import Llama, LlamaConfig, build_packed_mask
+from train import caption_loss, packed_caption_loss
+
+
+def get_batch(num: int, max_length: int, audio_latent_dim: int, device: str) -> tuple[torch.Tensor, torch.Tensor]:
+    r"""Random audio latents and captions of 10 to 22 tokens padded to max_length."""
+
+    lengths = torch.randint(10, 23, (num,))
+    text_ids = torch.randint(1000, 2000, (num, max_length))
+    text_ids[torch.arange(max_length)[None, :] >= lengths[:, None]] = 0
+    audio_latent = torch.randn(num, 1, audio_latent_dim)
+
+    return audio_latent.to(device), text_ids.to(device)
+
+
+def unpacked_loss(model: Llama, audio_latent: torch.Tensor, text_ids: torch.Tensor) -> torch.Tensor:
+    input_seqs = [audio_latent, text_ids]
+    output_seqs = model(seqs=input_seqs, seq_types=["audio", "text"], compute_heads=[False, True])
+    return caption_loss(output_seqs=output_seqs, input_seqs=input_seqs, ignore_index=0)
+
+
+def packed_loss(model: Llama, audio_latent: torch.Tensor, text_ids: torch.Tensor, pack_length: int) -> torch.Tensor:
+    packed = pack_captions(audio_latent=audio_latent, text_ids=text_ids, pad_token_id=0, pack_length=pack_length)
+    output_seqs = model(
+        seqs=[packed["audio_latent"], packed["text_ids"]],
+        seq_types=["audio", "text"],
+        mask=build_packed_mask(segment_ids=packed["segment_ids"], input_pos=packed["input_pos"]),
+        input_pos=packed["input_pos"],
+        compute_heads=[False, True]
+    )
+    return packed_caption_loss(output_seqs=output_seqs, targets=packed["targets"], ignore_index=0)
+
+
+def examples_per_sec(func, num: int, device: str, steps: int, warmup_steps: int = 2) -> float:
+
+    for step in range(warmup_steps + steps):
+
+        if step == warmup_steps:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+
+        func()
+
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+    return num * steps / (time.perf_counter() - t0)
+
+
+def main(args):
+
+    device = args.device
+    torch.manual_seed(1234)
+
+    config = LlamaConfig(
+        block_size=1024,
+        audio_latent_dim=2048,
+        vocab_size=30522,
+        n_layer=args.n_layer,
+        n_head=args.n_head,
+        n_embd=args.n_embd
+    )
+    model = Llama(config=config).to(device)
+
+    # Same loss and gradients
+    audio_latent, text_ids = get_batch(args.check_num, args.max_length, config.audio_latent_dim, device)
+    packed = pack_captions(audio_latent=audio_latent, text_ids=text_ids, pad_token_id=0, pack_length=args.pack_length)
+    print("{} captions packed into {} rows of {} steps".format(
+        args.check_num, packed["text_ids"].shape[0], packed["input_pos"].shape[1]))
+
+    grads = []
+    losses = []
+    for func in [
+        lambda: unpacked_loss(model, audio_latent, text_ids),
+        lambda: packed_loss(model, audio_latent, text_ids, args.pack_length)
+    ]:
+        model.zero_grad(set_to_none=True)
+        loss = func()
+        loss.backward()
+        losses.append(loss.item())
+        grads.append(torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None]))
+
+    print("Loss unpacked: {:.6f}, packed: {:.6f}".format(*losses))
+    print("Max gradient difference: {:.3e} (max gradient {:.3e})".format(
+        (grads[0] - grads[1]).abs().max().item(), grads[0].abs().max().item()))
+
+    # Throughput
+    def train_step(func):
+        loss = func()
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    batch = get_batch(args.batch_size, args.max_length, config.audio_latent_dim, device)
+    speed = examples_per_sec(lambda: train_step(lambda: unpacked_loss(model, *batch)), args.batch_size, device, args.steps)
+    print("Padded batches of {}: {:.1f} examples/s".format(args.batch_size, speed))
+
+    batch = get_batch(args.pack_num, args.max_length, config.audio_latent_dim, device)
+    speed = examples_per_sec(lambda: train_step(lambda: packed_loss(model, *batch, args.pack_length)), args.pack_num, device, args.steps)
+    print("{} captions packed into rows of {}: {:.1f} examples/s".format(args.pack_num, args.pack_length, speed))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--max_length", type=int, default=30)
+    parser.add_argument("--n_layer", type=int, default=12)
+    parser.add_argument("--n_head", type=int, default=12)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--pack_length", type=int, default=1024)
+    parser.add_argument("--pack_num", type=int, default=256, help="Captions packed per step")
+    parser.add_argument("--check_num", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=5)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,97 @@
+"""Compare the float32 and int8 dynamic quantized LLM decoder on CPU.
+
+Usage: 
+    python benchmarks/quantization.py /path/to/clotho/evaluation \
+        --captions_csv /path/to/clotho_captions_evaluation.csv
+
+Both sessions decode greedily (top_k=1), so the differences are only caused 
+by quantization. The script reports the latency per clip, the fraction of 
+identical captions, and, if reference captions are given, the mean word 
+F1 against the best matching reference.
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inference"))
+from data.text_normalization import TextNormalization
+from inference import InferenceSession
+from batch_caption import find_audio_paths
+
+
+def word_f1(hypothesis: str, reference: str) -> float:
+    hyp = Counter(hypothesis.split())
+    ref = Counter(reference.split())
+    overlap = sum((hyp & ref).values())
+    if overlap == 0:
+        return 0.
+    precision = overlap / sum(hyp.values())
+    recall = overlap / sum(ref.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+def load_references(captions_csv: str) -> dict[str, list[str]]:
+    r"""Load Clotho captions, e.g., {"a.wav": ["caption 1", ..., "caption 5"]}."""
+    df = pd.read_csv(captions_csv)
+    normalize = TextNormalization()
+    references = {}
+    for _, row in df.iterrows():
+        references[row["file_name"]] = [normalize(row["caption_{}".format(n)]) for n in range(1, 6)]
+    return references
+
+
+def run(session: InferenceSession, paths: list[str]) -> tuple[list[str], list[float]]:
+    captions = []
+    latencies = []
+    for path in paths:
+        t0 = time.perf_counter()
+        captions.append(session.caption(path))
+        latencies.append(time.perf_counter() - t0)
+    return captions, latencies
+
+
+def main(args):
+
+    paths = find_audio_paths(args.inputs)[0 : args.max_clips]
+    references = load_references(args.captions_csv) if args.captions_csv else None
+
+    results = {}
+
+    for quantize in [False, True]:
+        session = InferenceSession(device="cpu", top_k=1, quantize=quantize)
+        session.warmup()
+        results[quantize] = run(session, paths)
+
+    fp32_captions, fp32_latencies = results[False]
+    int8_captions, int8_latencies = results[True]
+
+    print("Clips: {}".format(len(paths)))
+    print("fp32 latency: {:.3f} s per clip".format(np.mean(fp32_latencies)))
+    print("int8 latency: {:.3f} s per clip".format(np.mean(int8_latencies)))
+    agreement = np.mean([a == b for a, b in zip(fp32_captions, int8_captions)])
+    print("Identical captions: {:.1%}".format(agreement))
+
+    if references:
+        for name, captions in [("fp32", fp32_captions), ("int8", int8_captions)]:
+            f1s = [
+                max(word_f1(caption, ref) for ref in references[os.path.basename(path)])
+                for path, caption in zip(paths, captions) if os.path.basename(path) in references
+            ]
+            print("{} word F1: {:.4f}".format(name, np.mean(f1s)))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs="+", help="Held-out audio files or directories")
+    parser.add_argument("--captions_csv", type=str, default=None, help="Clotho captions csv")
+    parser.add_argument("--max_clips", type=int, default=100)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,97 @@
+"""Compare apply_rope with apply_rope_cos_sin, apply_rope_complex and
+apply_rope_fast on CPU: outputs must match, and time them for decoding (t=1)
+and prefill / training shapes, in float32 and bfloat16.
+
+Usage: python benchmarks/rope.py
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.rope import build_rope, apply_rope, apply_rope_complex, apply_rope_cos_sin, apply_rope_fast
+
+
+def timeit(func, num_runs: int) -> float:
+    r"""Median latency of func in microseconds."""
+    latencies = []
+    for _ in range(num_runs):
+        t0 = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t0)
+    return sorted(latencies)[len(latencies) // 2] * 1e6
+
+
+def main(args):
+
+    torch.set_num_threads(args.num_threads)
+    head_dim = args.n_embd // args.n_head
+    rope = build_rope(seq_len=args.block_size, head_dim=head_dim)  # shape: (t, head_dim/2, 2)
+
+    # Correctness, including a position offset and per row positions
+    x = torch.randn(2, 16, args.n_head, head_dim)
+    offset = 37
+    ref = apply_rope(x, rope[offset :])
+    input_pos = torch.stack([torch.arange(16), torch.arange(16) + offset])  # shape: (b, t)
+
+    for new_rope in [apply_rope_cos_sin, apply_rope_complex]:
+        assert torch.allclose(apply_rope(x, rope), new_rope(x, rope), atol=1e-5)
+        assert torch.allclose(ref, new_rope(x, rope, offset=offset), atol=1e-5)
+
+        out = new_rope(x, rope[input_pos])
+        assert torch.allclose(out[0], apply_rope(x[0 : 1], rope)[0], atol=1e-5)
+        assert torch.allclose(out[1], ref[1], atol=1e-5)
+
+    for new_rope in [apply_rope_cos_sin, apply_rope_fast]:
+        out = new_rope(x.bfloat16(), rope.bfloat16(), offset=offset)
+        assert out.dtype == torch.bfloat16
+        assert torch.allclose(out.float(), ref, atol=5e-2)
+
+    print("apply_rope_cos_sin, apply_rope_complex and apply_rope_fast match apply_rope (offset and per row positions).")
+
+    # Speed. Decoding passes the rope at input_pos, as Llama.forward does
+    for dtype in [torch.float32, torch.bfloat16]:
+        for T in [1, args.seq_len]:
+            # q of CausalSelfAttention is a strided view of the qkv projection
+            qkv = torch.randn(args.batch_size, T, 3 * args.n_embd, dtype=dtype)
+            x = qkv.split(args.n_embd, dim=2)[0].view(args.batch_size, T, args.n_head, head_dim)
+            input_pos = torch.arange(T) + offset
+            rope_dtype = rope.to(dtype)
+
+            funcs = [
+                ("apply_rope", lambda: apply_rope(x, rope_dtype[input_pos])),
+                ("apply_rope_cos_sin", lambda: apply_rope_cos_sin(x, rope_dtype[input_pos]))
+            ]
+
+            if dtype == torch.float32:
+                funcs.append(("apply_rope_complex", lambda: apply_rope_complex(x, rope_dtype[input_pos])))
+            else:
+                # Rotates in float32 with apply_rope_complex()
+                funcs.append(("apply_rope_fast", lambda: apply_rope_fast(x, rope_dtype[input_pos])))
+
+            t_old = timeit(funcs[0][1], args.num_runs)
+            line = "{}, b={}, t={}: apply_rope {:.1f} us".format(dtype, args.batch_size, T, t_old)
+
+            for name, func in funcs[1 :]:
+                t_new = timeit(func, args.num_runs)
+                line += ", {} {:.1f} us ({:.2f}x)".format(name, t_new, t_old / t_new)
+
+            print(line)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--block_size", type=int, default=1024)
+    parser.add_argument("--n_head", type=int, default=12)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--seq_len", type=int, default=64)
+    parser.add_argument("--num_runs", type=int, default=1000)
+    parser.add_argument("--num_threads", type=int, default=4)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,209 @@
+"""Speculative decoding: check that it samples from the target distribution
+and compare its speed with Llama.generate.
+
+Usage:
+    python benchmarks/speculative.py --target_ckpt inference/step=10000.pth \
+        --draft_ckpt checkpoints/train_draft/Cnn14_Llama_draft_2layers/step=10000.pth
+
+Without checkpoints the models are random, so the draft is a poor proposer
+and only the overhead is measured. Use --n_layer etc. for larger targets.
+"""
+import argparse
+import itertools
+import math
+import os
+import sys
+import time
+from collections import Counter
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.llama import Llama, LlamaConfig
+from models.speculative import init_draft_from_target, speculative_generate
+
+
+def get_model(n_layer: int, n_head: int, n_embd: int, vocab_size: int, device: str) -> Llama:
+    config = LlamaConfig(
+        block_size=1024,
+        audio_latent_dim=2048,
+        vocab_size=vocab_size,
+        n_layer=n_layer,
+        n_head=n_head,
+        n_embd=n_embd
+    )
+    model = Llama(config=config).to(device)
+    model.eval()
+    return model
+
+
+def sequence_distribution(model: Llama, audio_latent: torch.Tensor, vocab_size: int, length: int) -> dict:
+    r"""Exact probability of every sequence of length new tokens after 
+    [audio_latent, 0], p(a, b, ...) = p(a) p(b | a) ..., in one batched forward."""
+
+    seqs = list(itertools.product(range(vocab_size), repeat=length))
+    ids = torch.tensor([[0] + list(seq) for seq in seqs], device=audio_latent.device)  # shape: (n, 1 + length)
+
+    with torch.no_grad():
+        logits = model(seqs=[audio_latent.expand(len(seqs), -1, -1), ids], seq_types=["audio", "text"])[1]
+        log_probs = torch.log_softmax(logits[:, 0 : -1, :].double(), dim=-1)  # shape: (n, length, v)
+        log_probs = log_probs.gather(2, ids[:, 1 :, None])[:, :, 0].sum(dim=1)  # shape: (n,)
+
+    return dict(zip(seqs, log_probs.exp().tolist()))
+
+
+def tv_bound(exact: dict, num_samples: int, delta: float = 1e-3) -> float:
+    r"""Total variation distance that the empirical distribution of num_samples 
+    samples of exact stays below with probability at least 1 - delta. The 
+    expected distance is at most 0.5 * sum(sqrt(p (1 - p) / n)), and one 
+    sample changes the distance by at most 1 / n, so by McDiarmid's 
+    inequality it exceeds its expectation by sqrt(log(1 / delta) / (2 n)) 
+    with probability at most delta."""
+
+    expected = 0.5 * sum(math.sqrt(p * (1. - p) / num_samples) for p in exact.values())
+
+    return expected + math.sqrt(math.log(1. / delta) / (2 * num_samples))
+
+
+def total_variation(exact: dict, count: Counter, num_samples: int) -> float:
+    return 0.5 * sum(abs(count[k] / num_samples - p) for k, p in exact.items())
+
+
+def check_distribution(device: str, num_samples: int) -> None:
+    r"""Compare the empirical distributions of 3-token sequences sampled by 
+    generate and speculative_generate with the exact target distribution, 
+    using a tiny vocabulary. With max_new_tokens=3 every verify step of 
+    speculative_generate drafts one token, so acceptance, the residual 
+    distribution and the extra target token are all exercised."""
+
+    torch.manual_seed(0)
+    V = 4
+    length = 3
+    target = get_model(n_layer=2, n_head=2, n_embd=32, vocab_size=V, device=device)
+    draft = get_model(n_layer=1, n_head=2, n_embd=32, vocab_size=V, device=device)
+    audio_latent = torch.randn(1, 1, 2048, device=device)
+    text_ids = torch.zeros(1, 1, dtype=torch.long, device=device)
+    seq_types = ["audio", "text"]
+
+    exact = sequence_distribution(target, audio_latent, vocab_size=V, length=length)
+    bound = tv_bound(exact, num_samples)
+
+    # How far off sampling from the draft alone would be
+    draft_tv = 0.5 * sum(abs(p - exact[k]) for k, p in sequence_distribution(draft, audio_latent, V, length).items())
+
+    counts = {"generate": Counter(), "speculative": Counter()}
+    drafted = 0
+
+    for _ in range(num_samples):
+        ids = target.generate(seqs=[audio_latent, text_ids.clone()], seq_types=seq_types, max_new_tokens=length)[-1]
+        counts["generate"][tuple(ids[0, 1 :].tolist())] += 1
+
+        (_, ids), stats = speculative_generate(
+            target=target,
+            draft=draft,
+            seqs=[audio_latent, text_ids.clone()],
+            seq_types=seq_types,
+            max_new_tokens=length,
+            num_draft_tokens=2
+        )
+        counts["speculative"][tuple(ids[0, 1 :].tolist())] += 1
+        drafted += stats["drafted_tokens"]
+
+    assert drafted > 0, "No draft tokens were proposed, the check does not test speculative sampling"
+    print("Draft tokens proposed: {}, total variation distance of the draft to the target: {:.4f}".format(
+        drafted, draft_tv))
+
+    for name, count in counts.items():
+        tv = total_variation(exact, count, num_samples)
+        print("Total variation distance of {} to the target over {} samples: {:.4f} (bound {:.4f})".format(
+            name, num_samples, tv, bound))
+        assert tv < bound, "{} does not sample from the target distribution".format(name)
+
+
+def main(args):
+
+    device = args.device
+
+    if args.check_samples > 0:
+        check_distribution(device=device, num_samples=args.check_samples)
+
+    torch.manual_seed(1234)
+    target = get_model(args.n_layer, args.n_head, args.n_embd, vocab_size=30522, device=device)
+    if args.target_ckpt:
+        target.load_state_dict(torch.load(args.target_ckpt, map_location=device))
+
+    draft = init_draft_from_target(target=target, n_layer=args.draft_n_layer)
+    if args.draft_ckpt:
+        draft.load_state_dict(torch.load(args.draft_ckpt, map_location=device))
+    draft.eval()
+
+    def run(speculative: bool, seed: int) -> tuple[float, int, dict]:
+        torch.manual_seed(seed)
+        audio_latent = torch.randn(1, 1, 2048, device=device)
+        text_ids = torch.full((1, 1), fill_value=101, dtype=torch.long, device=device)  # [CLS]
+        seqs = [audio_latent, text_ids]
+        seq_types = ["audio", "text"]
+        stats = {}
+
+        t0 = time.perf_counter()
+        if speculative:
+            seqs, stats = speculative_generate(
+                target=target,
+                draft=draft,
+                seqs=seqs,
+                seq_types=seq_types,
+                max_new_tokens=args.max_new_tokens,
+                num_draft_tokens=args.num_draft_tokens,
+                temperature=args.temperature,
+                top_k=args.top_k,
+                eos_token_id=102
+            )
+        else:
+            seqs = target.generate(
+                seqs=seqs,
+                seq_types=seq_types,
+                max_new_tokens=args.max_new_tokens,
+                temperature=args.temperature,
+                top_k=args.top_k,
+                eos_token_id=102
+            )
+        if device == "cuda":
+            torch.cuda.synchronize()
+        latency = time.perf_counter() - t0
+
+        return latency, seqs[-1].shape[1] - 1, stats
+
+    for speculative in [False, True]:
+        latency, num_tokens, drafted, accepted = 0., 0, 0, 0
+        for seed in range(args.num_runs):
+            t, n, stats = run(speculative, seed)
+            latency += t
+            num_tokens += n
+            drafted += stats.get("drafted_tokens", 0)
+            accepted += stats.get("accepted_tokens", 0)
+
+        line = "speculative={}: {:.1f} tokens/s".format(speculative, num_tokens / latency)
+        if speculative:
+            line += ", acceptance rate {:.2f}".format(accepted / max(drafted, 1))
+        print(line)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--target_ckpt", type=str, default=None)
+    parser.add_argument("--draft_ckpt", type=str, default=None)
+    parser.add_argument("--n_layer", type=int, default=12)
+    parser.add_argument("--n_head", type=int, default=12)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--draft_n_layer", type=int, default=2)
+    parser.add_argument("--num_draft_tokens", type=int, default=4)
+    parser.add_argument("--max_new_tokens", type=int, default=20)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_k", type=int, default=200)
+    parser.add_argument("--num_runs", type=int, default=10)
+    parser.add_argument("--check_samples", type=int, default=2000, help="0 to skip the distribution check")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,343 @@
+import math
+import os
+import struct
+from functools import lru_cache
+
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
+import torchaudio
+
+
+# WAV format codes
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class AudioReader:
+    r"""Read mono float32 blocks of an audio file.
+
+    PCM16, PCM32 and float32 WAV files are memory mapped, so reading a block
+    only touches the bytes of that block. Other files are read with soundfile.
+    """
+
+    def __init__(self, path: str) -> None:
+
+        self.path = path
+        self._memmap = None
+        self._sf = None
+
+        wav_info = parse_wav_header(path)
+
+        if wav_info is not None:
+            self.samplerate = wav_info["samplerate"]
+            self.channels = wav_info["channels"]
+            self.frames = wav_info["frames"]
+            self._scale = wav_info["scale"]
+            self._memmap = np.memmap(
+                path, 
+                dtype=wav_info["dtype"], 
+                mode="r", 
+                offset=wav_info["offset"], 
+                shape=(self.frames, self.channels)
+            )
+
+        else:
+            self._sf = sf.SoundFile(path)
+            self.samplerate = self._sf.samplerate
+            self.channels = self._sf.channels
+            self.frames = self._sf.frames
+
+    def read(self, start: int, frames: int) -> np.ndarray:
+        r"""Read frames from start.
+
+        Outputs:
+            x: (samples_num,), mono float32
+        """
+
+        start = max(0, min(start, self.frames))
+        end = min(start + frames, self.frames)
+
+        if self._memmap is not None:
+            x = self._memmap[start : end]  # shape: (t, c)
+
+            if self.channels == 1:
+                x = x[:, 0].astype(np.float32)
+            else:
+                x = np.mean(x, axis=1, dtype=np.float32)
+
+            if self._scale != 1.:
+                x *= self._scale
+
+            return x
+
+        self._sf.seek(start)
+        x = self._sf.read(frames=end - start, dtype="float32", always_2d=True)  # shape: (t, c)
+
+        if self.channels == 1:
+            return x[:, 0]
+        
+        return np.mean(x, axis=1)
+
+    def close(self) -> None:
+        if self._sf is not None:
+            self._sf.close()
+        self._memmap = None
+
+    def __enter__(self) -> "AudioReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class Resampler:
+    r"""Resample mono float32 audio from orig_sr to sr. The windowed sinc 
+    kernel is computed once, use get_resampler() to share it between calls.
+    """
+
+    def __init__(self, orig_sr: int, sr: int) -> None:
+
+        gcd = math.gcd(orig_sr, sr)
+        self.orig_sr = orig_sr
+        self.sr = sr
+        self.up = sr // gcd
+        self.down = orig_sr // gcd
+
+        if orig_sr == sr:
+            self.context = 0
+            self.resample = None
+        else:
+            # Input samples read around a block, a multiple of down so that 
+            # the output samples of neighbouring blocks stay aligned
+            self.context = self.down * math.ceil(256 / self.down)
+            self.resample = torchaudio.transforms.Resample(orig_freq=orig_sr, new_freq=sr)
+
+    def output_length(self, frames: int) -> int:
+        return -(-frames * self.up // self.down)
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        r"""
+        Args:
+            x: (samples_num,), float32 at orig_sr
+
+        Outputs:
+            y: (new_samples_num,), float32 at sr
+        """
+        if self.resample is None:
+            return x
+
+        with torch.no_grad():
+            y = self.resample(torch.from_numpy(x))
+
+        return y.numpy()
+
+
+@lru_cache(maxsize=None)
+def get_resampler(orig_sr: int, sr: int) -> Resampler:
+    r"""Cached Resampler of each (orig_sr, sr) pair."""
+    return Resampler(orig_sr=orig_sr, sr=sr)
+
+
+def read_resampled(reader: AudioReader, start: int, frames: int, resampler: Resampler) -> np.ndarray:
+    r"""Read frames from start and resample them. Context samples around the
+    block are resampled with it and cropped, so that consecutive blocks join
+    like a single resampled signal.
+
+    Outputs:
+        y: (new_samples_num,), mono float32 at resampler.sr
+    """
+
+    frames = min(frames, reader.frames - start)
+    left = min(start, resampler.context)
+    right = max(0, min(resampler.context, reader.frames - start - frames))
+
+    x = reader.read(start=start - left, frames=left + frames + right)
+    y = resampler(x)
+
+    offset = left * resampler.up // resampler.down
+    return y[offset : offset + resampler.output_length(frames)]
+
+
+def load_audio(path: str, sr: int, block_duration: float = 30.) -> np.ndarray:
+    r"""Load an audio file as mono float32 at sr. 
+
+    The file is read and resampled block by block into one preallocated 
+    array. Formats that soundfile can not read fall back to librosa.load().
+
+    Outputs:
+        audio: (samples_num,)
+    """
+
+    try:
+        reader = AudioReader(path)
+    except RuntimeError:
+        audio, _ = librosa.load(path=path, sr=sr, mono=True)
+        return audio
+
+    with reader:
+        resampler = get_resampler(reader.samplerate, sr)
+
+        block_frames = int(block_duration * reader.samplerate)
+        block_frames = resampler.down * max(1, block_frames // resampler.down)
+
+        audio = np.empty(resampler.output_length(reader.frames), dtype=np.float32)
+        n = 0
+
+        for start in range(0, reader.frames, block_frames):
+            y = read_resampled(reader=reader, start=start, frames=block_frames, resampler=resampler)
+            audio[n : n + len(y)] = y
+            n += len(y)
+
+    return audio[0 : n]
+
+
+def iter_audio_windows(
+    path: str, 
+    sr: int, 
+    window: float, 
+    hop: float, 
+    min_duration: float = 1.
+):
+    r"""Read an audio file one window at a time. Formats that soundfile can 
+    not read fall back to librosa.load() of the whole file.
+
+    Args:
+        path: str
+        sr: int, target sample rate
+        window: float, window duration in seconds
+        hop: float, hop between window starts in seconds
+        min_duration: float, drop a last window shorter than this
+
+    Yields:
+        start: float, start time in seconds
+        waveform: (samples_num,), mono float32 at sr
+    """
+
+    if window <= 0 or hop <= 0:
+        raise ValueError("window and hop must be positive, got window={} and hop={}".format(window, hop))
+
+    try:
+        reader = AudioReader(path)
+    except RuntimeError:
+        # Formats that soundfile can not read are decoded whole, like load_audio()
+        audio, _ = librosa.load(path=path, sr=sr, mono=True)
+        window_samples = int(window * sr)
+        k = 0
+        start = 0
+
+        while start < len(audio):
+
+            if start > 0 and len(audio) - start < min_duration * sr:
+                break
+
+            yield start / sr, audio[start : start + window_samples]
+
+            k += 1
+            start = max(k, round(k * hop * sr))
+
+        return
+
+    with reader:
+
+        orig_sr = reader.samplerate
+        resampler = get_resampler(orig_sr, sr)
+        window_samples = int(window * orig_sr)
+
+        # Window starts are rounded to multiples of resampler.down, so that 
+        # read_resampled() crops the resampled block at an exact output 
+        # sample. Each start is rounded from k * hop, so the rounding errors 
+        # do not add up over a long file.
+        hop_blocks = hop * orig_sr / resampler.down
+        k = 0
+        start = 0
+
+        while start < reader.frames:
+
+            if start > 0 and reader.frames - start < min_duration * orig_sr:
+                break
+
+            x = read_resampled(reader=reader, start=start, frames=window_samples, resampler=resampler)
+
+            yield start / orig_sr, x
+
+            k += 1
+            start = resampler.down * max(k, round(k * hop_blocks))
+
+
+def parse_wav_header(path: str) -> None | dict:
+    r"""Locate the sample data of a PCM16, PCM32 or float32 WAV file. Return 
+    None for other files."""
+
+    with open(path, "rb") as f:
+
+        header = f.read(12)
+        if len(header) < 12 or header[0 : 4] != b"RIFF" or header[8 : 12] != b"WAVE":
+            return None
+
+        fmt = None
+
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return None
+
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+
+            if chunk_id == b"fmt ":
+                data = f.read(chunk_size)
+                format_code, channels, samplerate, _, block_align, bits = struct.unpack("<HHIIHH", data[0 : 16])
+
+                if format_code == WAVE_FORMAT_EXTENSIBLE and len(data) >= 26:
+                    format_code = struct.unpack("<H", data[24 : 26])[0]
+
+                fmt = (format_code, channels, samplerate, block_align, bits)
+
+            elif chunk_id == b"data":
+                if fmt is None:
+                    return None
+                offset = f.tell()
+                break
+
+            else:
+                f.seek(chunk_size, 1)
+
+            # Chunks are word aligned
+            if chunk_size % 2 == 1 and chunk_id != b"data":
+                f.seek(1, 1)
+
+    format_code, channels, samplerate, block_align, bits = fmt
+
+    if format_code == WAVE_FORMAT_PCM and bits == 16:
+        dtype, scale = np.dtype("<i2"), 1. / 32768
+    elif format_code == WAVE_FORMAT_PCM and bits == 32:
+        dtype, scale = np.dtype("<i4"), 1. / 2147483648
+    elif format_code == WAVE_FORMAT_IEEE_FLOAT and bits == 32:
+        dtype, scale = np.dtype("<f4"), 1.
+    else:
+        return None
+
+    if block_align != channels * dtype.itemsize:
+        return None
+
+    # The data size of a WAV file that was not finalized can be 0 or wrong
+    file_size = os.path.getsize(path)
+
+    if chunk_size in [0, 0xFFFFFFFF]:
+        chunk_size = file_size - offset
+
+    frames = min(chunk_size, file_size - offset) // block_align
+
+    if frames == 0:
+        return None
+
+    return {
+        "samplerate": samplerate,
+        "channels": channels,
+        "frames": frames,
+        "offset": offset,
+        "dtype": dtype,
+        "scale": scale,
+    }
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import default_collate
+
+
+class BucketBatchSampler:
+    def __init__(
+        self,
+        lengths: list[int],
+        batch_size: int,
+        pool_batches: int = 100
+    ) -> None:
+        r"""Infinitely yield batches of indexes of similar lengths. Like
+        InfiniteSampler, indexes are shuffled and traversed without
+        replacement, then reshuffled.
+
+        Each pool of batch_size * pool_batches shuffled indexes is sorted by
+        length and split into batches, and the batches of a pool are yielded
+        in random order, so batches stay random but need little padding.
+
+        Args:
+            lengths: list of int, e.g., token lengths of the captions
+            batch_size: int
+            pool_batches: int, batches sorted together
+        """
+
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.pool_size = batch_size * pool_batches
+
+        self.indexes = list(range(len(lengths)))
+        random.shuffle(self.indexes)
+        self.p = 0  # pointer
+
+    def __iter__(self) -> list[int]:
+        r"""Yield a batch of indexes."""
+
+        while True:
+
+            if self.p >= len(self.indexes):
+
+                # Traversed all data. Reshuffle indexes. Reset pointer.
+                random.shuffle(self.indexes)
+                self.p = 0
+
+            pool = self.indexes[self.p : self.p + self.pool_size]
+            self.p += self.pool_size
+
+            pool = sorted(pool, key=lambda index: self.lengths[index])
+            batches = [pool[i : i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+            random.shuffle(batches)
+
+            for batch in batches:
+                yield batch
+
+
+class TrimCollate:
+    def __init__(self, pad_token_id: int, key: str = "target") -> None:
+        r"""Collate a batch and trim the padded token IDs data[key] to the
+        longest sequence in the batch. Also returns data["padding"], the
+        number of padded tokens before and after trimming, shape: (2,).
+
+        Causal attention does not let valid steps see later padded steps, and
+        the loss ignores padded targets, so trimming does not change the loss.
+        """
+        self.pad_token_id = pad_token_id
+        self.key = key
+
+    def __call__(self, batch: list[dict]) -> dict:
+
+        data = default_collate(batch)
+
+        ids = data[self.key]  # shape: (b, t)
+        valid = ids != self.pad_token_id  # shape: (b, t)
+        max_len = int(valid.any(dim=0).nonzero().max()) + 1 if valid.any() else 1
+
+        padded = ids.numel() - int(valid.sum())
+        data[self.key] = ids[:, 0 : max_len]
+        data["padding"] = torch.LongTensor([padded, padded - ids.shape[0] * (ids.shape[1] - max_len)])
+
+        return data
+
+
+def caption_lengths(
+    captions: list[str],
+    target_transform: None | callable,
+    pad_token_id: int
+) -> list[int]:
+    r"""Token lengths of captions without padding, e.g., of
+    dataset.meta_dict["caption"]. With a CaptionIndex as target_transform the
+    captions are looked up instead of tokenized.
+
+    Args:
+        captions: list of str
+        target_transform: callable | list of callable, e.g.,
+            [TextNormalization(), BertTokenizer(max_length)]
+        pad_token_id: int
+
+    Outputs:
+        lengths: list of int
+    """
+
+    lengths = []
+
+    for caption in captions:
+
+        target = caption
+
+        if isinstance(target_transform, list):
+            for transform in target_transform:
+                target = transform(target)
+
+        elif target_transform:
+            target = target_transform(target)
+
+        lengths.append(int(np.sum(np.asarray(target) != pad_token_id)))
+
+    return lengths
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+
+def build_caption_index(
+    root: str,
+    captions: list[str],
+    tokenizer,
+    normalize: None | Callable[[str], str] = None,
+    batch_size: int = 1024
+) -> None:
+    r"""Tokenize captions once and write them as a flat id array with offsets.
+
+    The index looks like:
+
+        root
+        ├── ids.npy, (total_tokens,) int16 | int32, with [CLS] and [SEP]
+        ├── offsets.npy, (captions_num + 1,) int64
+        ├── captions.json, the raw captions, i.e., the lookup keys
+        └── meta.json
+
+    Args:
+        root: str, directory of the index
+        captions: list of raw captions, e.g., as passed to target_transform
+        tokenizer: fast transformers tokenizer, e.g., BertTokenizer(...).tokenizer
+        normalize: None | callable, e.g., TextNormalization()
+        batch_size: int, captions per tokenizer call
+    """
+
+    Path(root).mkdir(parents=True, exist_ok=True)
+
+    captions = list(dict.fromkeys(captions))  # Unique, keep order
+    dtype = np.int16 if tokenizer.vocab_size <= np.iinfo(np.int16).max + 1 else np.int32
+
+    ids = []
+    lengths = []
+
+    for i in range(0, len(captions), batch_size):
+        texts = captions[i : i + batch_size]
+
+        if normalize is not None:
+            texts = [normalize(text) for text in texts]
+
+        for x in tokenizer(texts, add_special_tokens=True)["input_ids"]:
+            ids.append(np.asarray(x, dtype=dtype))
+            lengths.append(len(x))
+
+    offsets = np.zeros(len(captions) + 1, dtype=np.int64)
+    offsets[1 :] = np.cumsum(lengths)
+
+    np.save(Path(root, "ids.npy"), np.concatenate(ids) if ids else np.zeros(0, dtype=dtype))
+    np.save(Path(root, "offsets.npy"), offsets)
+
+    with open(Path(root, "captions.json"), "w") as f:
+        json.dump(captions, f)
+
+    # meta.json is written last, an index without it is incomplete
+    meta = {
+        "vocab_size": tokenizer.vocab_size,
+        "pad_token_id": tokenizer.pad_token_id,
+        "cls_token_id": tokenizer.cls_token_id,
+        "sep_token_id": tokenizer.sep_token_id,
+        "dtype": np.dtype(dtype).name,
+        "captions_num": len(captions),
+        "total_tokens": int(offsets[-1])
+    }
+
+    tmp_path = Path(root, "meta.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, Path(root, "meta.json"))
+
+
+class CaptionIndex:
+    r"""Caption to token IDs lookup of an index written by build_caption_index().
+    A drop-in replacement of [TextNormalization(), BertTokenizer(max_length)]
+    as target_transform, without tokenizing in DataLoader workers."""
+
+    def __init__(self, root: str, max_length: int) -> None:
+        r"""
+        Args:
+            root: str, directory of the index
+            max_length: pad or truncate sequence length
+        """
+
+        self.root = root
+        self.max_length = max_length
+
+        meta_path = Path(root, "meta.json")
+
+        if not meta_path.exists():
+            raise FileNotFoundError("{} does not exist, the index is incomplete".format(meta_path))
+
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+
+        with open(Path(root, "captions.json")) as f:
+            captions = json.load(f)
+
+        self.caption_to_idx = {caption: n for n, caption in enumerate(captions)}
+        self.pad_token_id = self.meta["pad_token_id"]
+        self.sep_token_id = self.meta["sep_token_id"]
+        self.vocab_size = self.meta["vocab_size"]
+
+        self._ids = None
+        self._offsets = None
+
+    def __call__(self, x: str) -> np.ndarray:
+        r"""Look up the token IDs of a caption.
+
+        Args:
+            x: str, a raw caption of the index
+
+        Outputs:
+            x: ndarray, e.g., [101, 8667, 1362,  119,  102, 0, 0], the same as
+                BertTokenizer(max_length)(TextNormalization()(x))
+        """
+
+        if self._ids is None:
+            self._ids = np.load(Path(self.root, "ids.npy"), mmap_mode="r")
+            self._offsets = np.load(Path(self.root, "offsets.npy"))
+
+        try:
+            n = self.caption_to_idx[x]
+        except KeyError:
+            raise KeyError("Caption is not in {}, rebuild the index: {}".format(self.root, x))
+
+        ids = self._ids[self._offsets[n] : self._offsets[n + 1]]
+
+        out = np.full(self.max_length, fill_value=self.pad_token_id, dtype=np.int64)
+
+        if len(ids) <= self.max_length:
+            out[0 : len(ids)] = ids
+        else:
+            # Truncate the words and keep [SEP], as the tokenizer does
+            out[0 : self.max_length - 1] = ids[0 : self.max_length - 1]
+            out[-1] = self.sep_token_id
+
+        return out
+
+    def __getstate__(self) -> dict:
+        # Do not pickle memory maps into DataLoader workers
+        state = self.__dict__.copy()
+        state["_ids"] = None
+        state["_offsets"] = None
+        return state
@@ -0,0 +1,237 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import torch.nn as nn
+
+
+class EmbeddingCache:
+    r"""Content addressed cache of audio embeddings.
+
+    Keys are hashes of the decoded audio together with the encoder identity 
+    and the sample rate, so a re-submitted recording is found under any file 
+    name. Clips of files on disk can instead be keyed by their path and crop 
+    with clip_key(), which does not need the decoded audio. Embeddings are 
+    kept in an in-memory LRU and, if cache_dir is set, in .npy files on disk. 
+    Both are bounded and evict least recently used entries. All methods can 
+    be called from several threads. The disk usage is only counted by this 
+    object, so cache_dir should not be written by several processes at once.
+    """
+
+    def __init__(
+        self, 
+        cache_dir: None | str = None, 
+        encoder_id: None | str = None, 
+        sr: int = 32000, 
+        max_items: int = 4096, 
+        max_disk_bytes: int = 2 * 1024 ** 3
+    ) -> None:
+        r"""
+        Args:
+            cache_dir: None | str, in-memory cache only if None
+            encoder_id: None | str, identity of the encoder and its weights, 
+                e.g., encoder_fingerprint(), so that embeddings of other 
+                weights are not returned. If None, the cache can not be used 
+                until bind_encoder() is called
+            sr: int, sample rate of the audio
+            max_items: int, max embeddings in memory
+            max_disk_bytes: int, max bytes of the embeddings on disk
+        """
+
+        self.cache_dir = cache_dir
+        self.encoder_id = encoder_id
+        self.sr = sr
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> embedding
+        self._disk = OrderedDict()  # key -> bytes, least recently used first
+        self._disk_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        if cache_dir is not None:
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            self._scan_disk()
+
+    def bind_encoder(self, encoder_id: str) -> None:
+        r"""Set encoder_id of a cache created without one, e.g., by a caller 
+        that has not loaded the encoder yet. A cache of another encoder_id 
+        raises ValueError, its keys never change once set."""
+
+        with self._lock:
+            if self.encoder_id is None:
+                self.encoder_id = encoder_id
+            elif self.encoder_id != encoder_id:
+                raise ValueError("EmbeddingCache of encoder {} can not be used with encoder {}".format(
+                    self.encoder_id, encoder_id))
+
+    def _key_prefix(self) -> str:
+        if self.encoder_id is None:
+            raise ValueError("EmbeddingCache has no encoder_id, call bind_encoder() first")
+        return "{}|{}|".format(self.encoder_id, self.sr)
+
+    def key(self, audio: np.ndarray) -> str:
+        r"""Key of a mono float32 waveform."""
+        audio = np.ascontiguousarray(audio, dtype=np.float32)
+        h = hashlib.blake2b(digest_size=20)
+        h.update(self._key_prefix().encode())
+        h.update(audio.data)
+        return h.hexdigest()
+
+    def clip_key(self, audio_path: str, start_time: float, duration: float) -> str:
+        r"""Key of the clip of an audio file from start_time. The size and 
+        modification time of the file are part of the key, so an edited file 
+        is not found under its old embedding. Only deterministic crops are 
+        found again, e.g., StartCrop."""
+        stat = os.stat(audio_path)
+        h = hashlib.blake2b(digest_size=20)
+        h.update("{}{}|{}|{}|{!r}|{!r}".format(
+            self._key_prefix(), os.path.abspath(audio_path), stat.st_size, 
+            stat.st_mtime_ns, float(start_time), float(duration)).encode())
+        return h.hexdigest()
+
+    def get(self, key: str) -> None | np.ndarray:
+
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+            on_disk = key in self._disk
+
+        if on_disk:
+            try:
+                embedding = np.load(self._path(key))
+            except (OSError, ValueError):
+                # Evicted since it was looked up
+                embedding = None
+
+            if embedding is not None:
+                with self._lock:
+                    self.hits += 1
+                    self._put_memory(key, embedding)
+                    if key in self._disk:
+                        self._disk.move_to_end(key)
+                return embedding
+
+        with self._lock:
+            self.misses += 1
+
+        return None
+
+    def put(self, key: str, embedding: np.ndarray) -> None:
+
+        embedding = np.ascontiguousarray(embedding)
+
+        with self._lock:
+            self._put_memory(key, embedding)
+
+            if self.cache_dir is None or key in self._disk:
+                return
+
+        # Write to a temporary file and rename so that readers never see a 
+        # partial file
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".{}.{}.tmp".format(os.getpid(), threading.get_ident()))
+        with open(tmp_path, "wb") as f:
+            np.save(f, embedding)
+        os.replace(tmp_path, path)
+        nbytes = path.stat().st_size
+
+        with self._lock:
+            if key not in self._disk:
+                self._disk[key] = nbytes
+                self._disk_bytes += nbytes
+            self._evict_disk()
+
+    def get_or_compute(
+        self, 
+        keys: list[str], 
+        compute: Callable[[list[int]], np.ndarray]
+    ) -> np.ndarray:
+        r"""Look up the embeddings of a batch and compute the missing ones in 
+        one call.
+
+        Args:
+            keys: list of str, key() or clip_key() of each audio of the batch
+            compute: function mapping the indexes of missing audios to their 
+                embeddings, e.g., (missing_num, t_audio, d)
+
+        Returns:
+            embeddings: (batch_size, ...)
+        """
+
+        embeddings = [self.get(key) for key in keys]
+        missing = [n for n, embedding in enumerate(embeddings) if embedding is None]
+
+        if missing:
+            computed = compute(missing)
+
+            for n, embedding in zip(missing, computed):
+                embeddings[n] = embedding
+                self.put(keys[n], embedding)
+
+        return np.stack(embeddings, axis=0)
+
+    def _path(self, key: str) -> Path:
+        return Path(self.cache_dir, key[0 : 2], "{}.npy".format(key))
+
+    def _put_memory(self, key: str, embedding: np.ndarray) -> None:
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self) -> None:
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            key, nbytes = self._disk.popitem(last=False)
+            self._disk_bytes -= nbytes
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _scan_disk(self) -> None:
+        r"""Index existing files, least recently modified first."""
+        paths = sorted(Path(self.cache_dir).glob("*/*.npy"), key=lambda p: p.stat().st_mtime)
+        for path in paths:
+            nbytes = path.stat().st_size
+            self._disk[path.stem] = nbytes
+            self._disk_bytes += nbytes
+        self._evict_disk()
+
+
+def encoder_fingerprint(name: str, model: nn.Module) -> str:
+    r"""Encoder identity for EmbeddingCache, the model name and a hash of its 
+    weights, e.g., "Cnn14-3f2a9c1e7b6d". Hashing the weights takes a fraction 
+    of a second for CNN14 and is done once per loaded model."""
+
+    h = hashlib.blake2b(digest_size=6)
+
+    for key, value in model.state_dict().items():
+        h.update(key.encode())
+        h.update(value.detach().cpu().contiguous().numpy().tobytes())
+
+    return "{}-{}".format(name, h.hexdigest())
+
+
+def file_fingerprint(name: str, path: str) -> str:
+    r"""Encoder identity for EmbeddingCache of an encoder stored in one file, 
+    e.g., an exported ONNX model, the name and a hash of the file."""
+
+    h = hashlib.blake2b(digest_size=6)
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+    return "{}-{}".format(name, h.hexdigest())
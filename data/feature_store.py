@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import json
+import os
+import random
+from pathlib import Path
+
+import numpy as np
+from torch.utils.data import Dataset
+
+
+class FeatureStoreWriter:
+    r"""Write embeddings into fixed size float16 shards on disk.
+
+    The store looks like:
+
+        root
+        ├── shard_00000.npy, (shard_size, dim)
+        ├── shard_00001.npy
+        ├── ...
+        └── meta.json
+
+    meta.json is written last by close(), so a store without it is incomplete.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        num_items: int,
+        dim: int,
+        shard_size: int = 65536,
+        dtype: str = "float16"
+    ) -> None:
+        r"""
+        Args:
+            root: str, directory of the store
+            num_items: int, total number of embeddings
+            dim: int, embedding dim, e.g., 2048
+            shard_size: int, embeddings per shard
+            dtype: str, e.g., "float16"
+        """
+
+        self.root = root
+        self.num_items = num_items
+        self.dim = dim
+        self.shard_size = shard_size
+        self.dtype = dtype
+
+        Path(root).mkdir(parents=True, exist_ok=True)
+
+        self.shards = []
+
+        for n, start in enumerate(range(0, num_items, shard_size)):
+            rows = min(shard_size, num_items - start)
+            shard = np.lib.format.open_memmap(
+                filename=str(Path(root, "shard_{:05d}.npy".format(n))),
+                mode="w+",
+                dtype=dtype,
+                shape=(rows, dim)
+            )
+            self.shards.append(shard)
+
+    def write(self, start: int, features: np.ndarray) -> None:
+        r"""Write features (n, dim) to items [start, start + n)."""
+
+        n = 0
+
+        while n < len(features):
+            shard_idx, row = divmod(start + n, self.shard_size)
+            shard = self.shards[shard_idx]
+            rows = min(len(shard) - row, len(features) - n)
+            shard[row : row + rows] = features[n : n + rows]
+            n += rows
+
+    def close(self, meta: None | dict = None) -> None:
+        r"""Flush the shards and write meta.json with extra meta."""
+
+        for shard in self.shards:
+            shard.flush()
+
+        meta = dict(meta or {})
+        meta.update({
+            "num_items": self.num_items,
+            "dim": self.dim,
+            "shard_size": self.shard_size,
+            "dtype": self.dtype,
+            "num_shards": len(self.shards)
+        })
+
+        tmp_path = Path(self.root, "meta.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, Path(self.root, "meta.json"))
+
+
+class FeatureStore:
+    r"""Read embeddings written by FeatureStoreWriter. Shards are memory mapped
+    lazily, so the store can be passed to DataLoader workers."""
+
+    def __init__(self, root: str) -> None:
+
+        self.root = root
+
+        meta_path = Path(root, "meta.json")
+
+        if not meta_path.exists():
+            raise FileNotFoundError("{} does not exist, the store is incomplete".format(meta_path))
+
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+
+        self.num_items = self.meta["num_items"]
+        self.dim = self.meta["dim"]
+        self.shard_size = self.meta["shard_size"]
+
+        self._shards = None
+
+    def __len__(self) -> int:
+        return self.num_items
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        r"""Embedding (dim,) of an item."""
+
+        if self._shards is None:
+            self._shards = [
+                np.load(Path(self.root, "shard_{:05d}.npy".format(n)), mmap_mode="r")
+                for n in range(self.meta["num_shards"])
+            ]
+
+        shard_idx, row = divmod(index, self.shard_size)
+
+        return self._shards[shard_idx][row]
+
+    def __getstate__(self) -> dict:
+        # Do not pickle memory maps into DataLoader workers
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+
+class ClothoFeatures(Dataset):
+    r"""Clotho captions with precomputed audio embeddings of random crops,
+    written by extract_features.py. Like audidata's Clotho, there is one item
+    per (audio, caption) pair, and each access picks one of the num_crops crops
+    of the audio at random.
+
+    The store root looks like:
+
+        root
+        ├── shard_00000.npy, ...
+        ├── meta.json
+        └── clips.json, [{"audio_name": ..., "captions": [...]}, ...]
+    """
+
+    def __init__(self, root: str, target_transform: None | callable = None) -> None:
+
+        self.root = root
+        self.target_transform = target_transform
+
+        self.store = FeatureStore(root)
+        self.num_crops = self.store.meta["num_crops"]
+
+        with open(Path(root, "clips.json")) as f:
+            clips = json.load(f)
+
+        assert len(clips) * self.num_crops == len(self.store)
+
+        self.meta_dict = {"audio_name": [], "clip_idx": [], "caption": []}
+
+        for clip_idx, clip in enumerate(clips):
+            for caption in clip["captions"]:
+                self.meta_dict["audio_name"].append(clip["audio_name"])
+                self.meta_dict["clip_idx"].append(clip_idx)
+                self.meta_dict["caption"].append(caption)
+
+    def __getitem__(self, index: int) -> dict:
+
+        clip_idx = self.meta_dict["clip_idx"][index]
+        caption = self.meta_dict["caption"][index]
+
+        crop_idx = random.randrange(self.num_crops)
+        audio_latent = self.store[clip_idx * self.num_crops + crop_idx]  # shape: (d,)
+        audio_latent = audio_latent.astype(np.float32)[None, :]  # shape: (t_audio, d)
+
+        target = caption
+
+        if isinstance(self.target_transform, list):
+            for transform in self.target_transform:
+                target = transform(target)
+
+        elif self.target_transform:
+            target = self.target_transform(target)
+
+        data = {
+            "dataset_name": "Clotho",
+            "audio_name": self.meta_dict["audio_name"][index],
+            "audio_latent": audio_latent,
+            "caption": caption,
+            "target": target
+        }
+
+        return data
+
+    def __len__(self) -> int:
+        return len(self.meta_dict["caption"])
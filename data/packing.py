@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import torch
+
+
+def pack_captions(
+    audio_latent: torch.Tensor,
+    text_ids: torch.Tensor,
+    pad_token_id: int,
+    pack_length: int
+) -> dict:
+    r"""Pack many (audio latent, caption) pairs into a few long rows.
+
+    Each row holds the audio steps of its segments followed by their text
+    tokens, i.e., the two seqs ["audio", "text"] of Llama.forward(). Positions
+    restart from 0 at every segment and build_packed_mask() of segment_ids and
+    input_pos only lets a step attend to its own segment, so every segment
+    sees the same attention as when it is forwarded alone.
+
+    Segments are filled row by row until the audio steps plus the text tokens
+    of the longest rows would exceed pack_length.
+
+    n: examples_num
+    b: packed rows
+
+    Args:
+        audio_latent: (n, t_audio, d)
+        text_ids: (n, t_text), padded on the right with pad_token_id
+        pad_token_id: int
+        pack_length: int, max steps per row, e.g., config.block_size
+
+    Outputs:
+        packed: dict, {
+            "audio_latent": (b, t_packed_audio, d),
+            "text_ids": (b, t_packed_text),
+            "targets": (b, t_packed_text), next token of each text step,
+                pad_token_id at the last step of segments and padded steps,
+            "input_pos": (b, t_packed_audio + t_packed_text),
+            "segment_ids": (b, t_packed_audio + t_packed_text), -1 for padded steps
+        }
+    """
+
+    device = text_ids.device
+    N, T_audio, D = audio_latent.shape
+
+    valid = text_ids != pad_token_id  # shape: (n, t_text)
+    lengths = valid.sum(dim=1).tolist()
+
+    # Assign examples to rows
+    rows = []  # Row of each example
+    audio_offsets = []  # Start of each example in the audio seq of its row
+    text_offsets = []  # Start of each example in the text seq of its row
+    row, row_audio, row_text = 0, 0, 0
+    max_audio, max_text = 0, 0
+
+    for length in lengths:
+
+        assert T_audio + length <= pack_length, "Example of {} steps is longer than pack_length {}".format(
+            T_audio + length, pack_length)
+
+        if row_audio > 0 and max(max_audio, row_audio + T_audio) + max(max_text, row_text + length) > pack_length:
+            # Start a new row
+            row, row_audio, row_text = row + 1, 0, 0
+
+        rows.append(row)
+        audio_offsets.append(row_audio)
+        text_offsets.append(row_text)
+        row_audio += T_audio
+        row_text += length
+        max_audio = max(max_audio, row_audio)
+        max_text = max(max_text, row_text)
+
+    B = row + 1
+    rows = torch.LongTensor(rows).to(device)  # shape: (n,)
+    audio_offsets = torch.LongTensor(audio_offsets).to(device)  # shape: (n,)
+    text_offsets = torch.LongTensor(text_offsets).to(device)  # shape: (n,)
+    lengths = torch.LongTensor(lengths).to(device)  # shape: (n,)
+    segments = torch.arange(N, device=device)  # shape: (n,)
+
+    # Row and column of every audio step
+    audio_steps = torch.arange(T_audio, device=device)
+    audio_rows = rows[:, None].expand(N, T_audio).flatten()  # shape: (n*t_audio,)
+    audio_cols = (audio_offsets[:, None] + audio_steps[None, :]).flatten()  # shape: (n*t_audio,)
+
+    # Row and column of every valid text step
+    text_steps = valid.nonzero()[:, 1]  # shape: (n_tokens,)
+    text_rows = rows.repeat_interleave(lengths)  # shape: (n_tokens,)
+    text_cols = text_offsets.repeat_interleave(lengths) + text_steps  # shape: (n_tokens,)
+
+    # Next token targets, the last token of each caption has no target
+    targets = torch.cat([text_ids[:, 1 :], torch.full_like(text_ids[:, 0 : 1], pad_token_id)], dim=1)
+
+    packed_audio = audio_latent.new_zeros(B, max_audio, D)
+    packed_audio[audio_rows, audio_cols] = audio_latent.flatten(0, 1)
+
+    packed_text = torch.full((B, max_text), fill_value=pad_token_id, dtype=text_ids.dtype, device=device)
+    packed_text[text_rows, text_cols] = text_ids[valid]
+
+    packed_targets = torch.full_like(packed_text, pad_token_id)
+    packed_targets[text_rows, text_cols] = targets[valid]
+
+    # Positions and segments, padded steps are segment -1 at position 0
+    input_pos = torch.zeros(B, max_audio + max_text, dtype=torch.long, device=device)
+    input_pos[audio_rows, audio_cols] = audio_steps.repeat(N)
+    input_pos[text_rows, max_audio + text_cols] = T_audio + text_steps
+
+    segment_ids = torch.full((B, max_audio + max_text), fill_value=-1, dtype=torch.long, device=device)
+    segment_ids[audio_rows, audio_cols] = segments.repeat_interleave(T_audio)
+    segment_ids[text_rows, max_audio + text_cols] = segments.repeat_interleave(lengths)
+
+    packed = {
+        "audio_latent": packed_audio,
+        "text_ids": packed_text,
+        "targets": packed_targets,
+        "input_pos": input_pos,
+        "segment_ids": segment_ids
+    }
+
+    return packed
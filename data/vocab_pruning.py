@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+from typing import Callable, Iterable
+
+import numpy as np
+import torch
+
+
+class VocabMapping:
+    r"""Map the full tokenizer vocabulary to the tokens used by a caption
+    corpus. A pruned LLM decoder embeds and predicts reduced ids, the
+    tokenizer decodes full ids.
+    """
+
+    def __init__(self, kept_ids: np.ndarray, full_vocab_size: int, unk_token_id: int) -> None:
+        r"""
+        Args:
+            kept_ids: (v_reduced,), sorted full ids. Reduced id n is kept_ids[n]
+            full_vocab_size: int, e.g., 30,522
+            unk_token_id: int, full id of tokens that are not kept, e.g., 100
+        """
+
+        self.kept_ids = np.asarray(kept_ids, dtype=np.int64)
+        self.full_vocab_size = full_vocab_size
+        self.unk_token_id = unk_token_id
+
+        assert unk_token_id in self.kept_ids, "[UNK] must be kept"
+
+        # Full id -> reduced id, tokens that are not kept map to [UNK]
+        reduced_unk_id = np.searchsorted(self.kept_ids, unk_token_id)
+        self.table = np.full(full_vocab_size, fill_value=reduced_unk_id, dtype=np.int64)
+        self.table[self.kept_ids] = np.arange(len(self.kept_ids))
+
+    @property
+    def vocab_size(self) -> int:
+        return len(self.kept_ids)
+
+    @classmethod
+    def from_captions(
+        cls,
+        captions: Iterable[str],
+        tokenizer,
+        normalize: None | Callable[[str], str] = None,
+        min_count: int = 1
+    ) -> VocabMapping:
+        r"""Keep the special tokens and the tokens of the normalized captions.
+
+        Args:
+            captions: iterable of str
+            tokenizer: transformers tokenizer, e.g., BertTokenizer(...).tokenizer
+            normalize: None | callable, e.g., TextNormalization()
+            min_count: int, tokens that appear fewer times are mapped to [UNK]
+        """
+
+        counts = np.zeros(tokenizer.vocab_size, dtype=np.int64)
+
+        for caption in captions:
+            if normalize is not None:
+                caption = normalize(caption)
+            ids = tokenizer.encode(text=caption, add_special_tokens=False)
+            np.add.at(counts, ids, 1)
+
+        kept = counts >= min_count
+        kept[tokenizer.all_special_ids] = True
+
+        return cls(
+            kept_ids=np.nonzero(kept)[0],
+            full_vocab_size=tokenizer.vocab_size,
+            unk_token_id=tokenizer.unk_token_id
+        )
+
+    def to_reduced(self, ids: np.ndarray | torch.Tensor) -> np.ndarray | torch.Tensor:
+        r"""Full ids to reduced ids."""
+        if isinstance(ids, torch.Tensor):
+            return torch.from_numpy(self.table).to(ids.device)[ids]
+        return self.table[ids]
+
+    def to_full(self, ids: np.ndarray | torch.Tensor) -> np.ndarray | torch.Tensor:
+        r"""Reduced ids to full ids."""
+        if isinstance(ids, torch.Tensor):
+            return torch.from_numpy(self.kept_ids).to(ids.device)[ids]
+        return self.kept_ids[ids]
+
+    def save(self, path: str) -> None:
+        np.savez(
+            path,
+            kept_ids=self.kept_ids,
+            full_vocab_size=self.full_vocab_size,
+            unk_token_id=self.unk_token_id
+        )
+
+    @classmethod
+    def load(cls, path: str) -> VocabMapping:
+        data = np.load(path)
+        return cls(
+            kept_ids=data["kept_ids"],
+            full_vocab_size=int(data["full_vocab_size"]),
+            unk_token_id=int(data["unk_token_id"])
+        )
+
+
+def prune_state_dict(state_dict: dict, vocab: VocabMapping) -> dict:
+    r"""Slice the token embedding and text head rows of a Llama checkpoint to
+    the kept tokens. Other weights are shared with the input state_dict."""
+
+    index = torch.from_numpy(vocab.kept_ids)
+    state_dict = dict(state_dict)
+
+    for key in ["wte.weight", "text_head.weight"]:
+        weight = state_dict[key]  # shape: (v, d)
+        assert weight.shape[0] == vocab.full_vocab_size, \
+            "{} has {} rows, expected {}".format(key, weight.shape[0], vocab.full_vocab_size)
+        state_dict[key] = weight.index_select(dim=0, index=index)  # shape: (v_reduced, d)
+
+    return state_dict
@@ -0,0 +1,142 @@
+"""Run the frozen CNN14 encoder once over Clotho and write the embeddings of
+num_crops random crops per audio into a sharded float16 feature store. Train
+the decoder from the store by setting feature_store_dir in train.py.
+
+Usage:
+    python extract_features.py --clotho_root /datasets/clotho --output_dir ./features --num_crops 8
+"""
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+from data.audio_io import load_audio
+from data.feature_store import FeatureStoreWriter
+from train import get_audio_encoder, get_audio_latent
+
+
+SPLITS = {
+    "train": ("clotho_captions_development.csv", "clotho_audio_development"),
+    "test": ("clotho_captions_evaluation.csv", "clotho_audio_evaluation"),
+}
+
+
+def random_crops(
+    audio: np.ndarray,
+    clip_samples: int,
+    num_crops: int,
+    rs: np.random.RandomState
+) -> np.ndarray:
+    r"""Random crops of an audio, zero padded at the end if it is shorter, the
+    same as RandomCrop(clip_duration, end_pad=0.) of train.py.
+
+    Args:
+        audio: (samples_num,)
+
+    Outputs:
+        crops: (num_crops, clip_samples)
+    """
+
+    crops = np.zeros((num_crops, clip_samples), dtype=np.float32)
+
+    for n in range(num_crops):
+        start = rs.randint(0, max(len(audio) - clip_samples, 0) + 1)
+        crop = audio[start : start + clip_samples]
+        crops[n, 0 : len(crop)] = crop
+
+    return crops
+
+
+def extract_split(args, split: str, audio_encoder: torch.nn.Module, latent_dim: int) -> None:
+
+    captions_csv, audios_dir = SPLITS[split]
+    df = pd.read_csv(Path(args.clotho_root, captions_csv))
+
+    clips = [
+        {
+            "audio_name": row["file_name"],
+            "captions": [row["caption_{}".format(n)] for n in range(1, 6)]
+        }
+        for _, row in df.iterrows()
+    ]
+
+    output_dir = Path(args.output_dir, split)
+    clip_samples = int(args.clip_duration * args.sr)
+    num_items = len(clips) * args.num_crops
+    rs = np.random.RandomState(args.seed)
+
+    writer = FeatureStoreWriter(
+        root=str(output_dir),
+        num_items=num_items,
+        dim=latent_dim,
+        shard_size=args.shard_size
+    )
+
+    # Encode batch_size crops at a time, items are ordered clip by clip
+    buffer = []
+    start = 0
+
+    def flush():
+        nonlocal buffer, start
+        audio = torch.from_numpy(np.concatenate(buffer, axis=0))[:, None, :].to(args.device)
+        latent = get_audio_latent(model_name="Cnn14", model=audio_encoder, audio=audio)  # shape: (b, 1, d)
+        latent = latent[:, 0, :].cpu().numpy().astype(np.float16)
+        writer.write(start=start, features=latent)
+        start += len(latent)
+        buffer = []
+
+    for clip in tqdm(clips, desc=split):
+        audio = load_audio(path=str(Path(args.clotho_root, audios_dir, clip["audio_name"])), sr=args.sr)
+        buffer.append(random_crops(audio, clip_samples, args.num_crops, rs))
+
+        if sum(len(crops) for crops in buffer) >= args.batch_size:
+            flush()
+
+    if buffer:
+        flush()
+
+    with open(Path(output_dir, "clips.json"), "w") as f:
+        json.dump(clips, f)
+
+    writer.close(meta={
+        "encoder": "Cnn14",
+        "sr": args.sr,
+        "clip_duration": args.clip_duration,
+        "num_crops": args.num_crops,
+        "seed": args.seed
+    })
+
+    print("Write {} embeddings of {} clips to {}".format(num_items, len(clips), output_dir))
+
+
+def extract_features(args):
+
+    audio_encoder, latent_dim = get_audio_encoder(model_name="Cnn14")
+    audio_encoder.to(args.device)
+
+    for split in args.splits:
+        extract_split(args, split=split, audio_encoder=audio_encoder, latent_dim=latent_dim)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clotho_root", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, default="./features")
+    parser.add_argument("--splits", type=str, nargs="+", default=["train", "test"])
+    parser.add_argument("--num_crops", type=int, default=8, help="Random crops per audio")
+    parser.add_argument("--clip_duration", type=float, default=10.)
+    parser.add_argument("--sr", type=int, default=32000)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--shard_size", type=int, default=65536)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    extract_features(args)
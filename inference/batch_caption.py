@@ -0,0 +1,156 @@
+"""Caption a list or directories of audio files into a JSONL file.
+
+Usage:
+    python inference/batch_caption.py recoding/ --output captions.jsonl
+
+Each line of the output is {"audio_path": str, "caption": str}. Files that 
+can not be decoded are written as {"audio_path": str, "caption": null, 
+"error": str} and the other files are still captioned. Files that are already 
+captioned in the output file are skipped, so an interrupted run can be 
+restarted with the same command, which also retries the failed files.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.embedding_cache import EmbeddingCache
+from inference import CKPT_PATH, get_session
+
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".mp3", ".ogg")
+
+
+def find_audio_paths(inputs: list[str], extensions: tuple[str] = AUDIO_EXTENSIONS) -> list[str]:
+    r"""Expand files and directories into a sorted list of audio paths."""
+
+    paths = []
+
+    for x in inputs:
+        if os.path.isdir(x):
+            paths.extend(str(p) for p in sorted(Path(x).rglob("*")) if p.suffix.lower() in extensions)
+        else:
+            paths.append(x)
+
+    return paths
+
+
+def load_done_paths(output_path: str) -> set[str]:
+    r"""Audio paths that have already been captioned in output_path."""
+
+    done = set()
+
+    if not os.path.exists(output_path):
+        return done
+
+    with open(output_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be truncated by an interrupted run
+                continue
+
+            # Files that failed to decode are retried
+            if "audio_path" in record and record.get("caption") is not None:
+                done.add(record["audio_path"])
+
+    return done
+
+
+def try_load_audio(session, path: str) -> np.ndarray | Exception:
+    r"""Decode one file, returning the exception instead of raising so that 
+    one broken file does not abort the other files of its chunk."""
+
+    try:
+        return session.load_audio(path)
+    except Exception as e:
+        return e
+
+
+def batch_caption(args):
+
+    all_paths = find_audio_paths(args.inputs)
+    done = load_done_paths(args.output)
+    paths = [path for path in all_paths if path not in done]
+
+    print("Skip {} captioned files, caption {} files.".format(len(all_paths) - len(paths), len(paths)))
+
+    if args.embedding_cache_dir:
+        embedding_cache = EmbeddingCache(cache_dir=args.embedding_cache_dir)
+    else:
+        embedding_cache = None
+
+    session = get_session(
+        ckpt_path=args.ckpt_path,
+        device=args.device, 
+        beam_size=args.beam_size, 
+        quantize=args.quantize, 
+        backend=args.backend,
+        embedding_cache=embedding_cache,
+        vocab_path=args.vocab_path
+    )
+    session.load()
+
+    # Decode and caption a chunk of files at a time to bound memory
+    chunk_size = args.batch_size * args.batches_per_chunk
+    t0 = time.perf_counter()
+    errors_num = 0
+
+    with open(args.output, "a") as f, ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        for i in range(0, len(paths), chunk_size):
+
+            chunk = paths[i : i + chunk_size]
+            audios = list(executor.map(lambda path: try_load_audio(session, path), chunk))
+
+            ok = [j for j, audio in enumerate(audios) if not isinstance(audio, Exception)]
+            captions = session.caption_batch(
+                audios=[audios[j] for j in ok], 
+                batch_size=args.batch_size, 
+                num_workers=args.num_workers
+            )
+            captions = dict(zip(ok, captions))
+
+            for j, (path, audio) in enumerate(zip(chunk, audios)):
+                if j in captions:
+                    record = {"audio_path": path, "caption": captions[j]}
+                else:
+                    record = {"audio_path": path, "caption": None, "error": "{}: {}".format(type(audio).__name__, audio)}
+                    errors_num += 1
+                    print("Failed to load {}: {}".format(path, audio))
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+
+            n = i + len(chunk)
+            print("{}/{} files, {:.2f} files/s".format(n, len(paths), n / (time.perf_counter() - t0)))
+
+    if errors_num > 0:
+        print("{} files could not be loaded, see the error rows of {}".format(errors_num, args.output))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs="+", help="Audio files or directories")
+    parser.add_argument("--output", type=str, default="captions.jsonl")
+    parser.add_argument("--device", type=str, default=None, help="Default to cuda if available")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--batches_per_chunk", type=int, default=8)
+    parser.add_argument("--beam_size", type=int, default=None, help="Beam search instead of sampling")
+    parser.add_argument("--quantize", action="store_true", help="Int8 dynamic quantized decoder, CPU only")
+    parser.add_argument("--backend", type=str, default="torch", choices=["torch", "onnx"])
+    parser.add_argument("--embedding_cache_dir", type=str, default=None, help="Cache CNN14 embeddings on disk")
+    parser.add_argument("--ckpt_path", type=str, default=CKPT_PATH)
+    parser.add_argument("--vocab_path", type=str, default=None, help="Vocabulary of a checkpoint pruned by prune_vocab.py")
+    args = parser.parse_args()
+
+    batch_caption(args)
@@ -0,0 +1,70 @@
+"""Caption a long recording with a sliding window.
+
+Usage:
+    python inference/caption_long.py recording.wav --window 10 --hop 5 --output track.srt
+
+Writes one caption per window as JSONL ({"start", "end", "caption"}) or SRT.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from inference import get_session
+
+
+def format_srt_time(t: float) -> str:
+    ms = int(round(t * 1000))
+    h, ms = divmod(ms, 3600000)
+    m, ms = divmod(ms, 60000)
+    s, ms = divmod(ms, 1000)
+    return "{:02d}:{:02d}:{:02d},{:03d}".format(h, m, s, ms)
+
+
+def caption_long(args):
+
+    session = get_session(device=args.device)
+    fmt = args.format or ("srt" if args.output and args.output.endswith(".srt") else "jsonl")
+    f = open(args.output, "w") if args.output else sys.stdout
+
+    segments = session.caption_long(
+        audio_path=args.audio_path, 
+        window=args.window, 
+        hop=args.hop, 
+        batch_size=args.batch_size
+    )
+
+    for n, segment in enumerate(segments):
+
+        if fmt == "srt":
+            f.write("{}\n{} --> {}\n{}\n\n".format(
+                n + 1, 
+                format_srt_time(segment["start"]), 
+                format_srt_time(segment["end"]), 
+                segment["caption"]
+            ))
+        else:
+            f.write(json.dumps(segment) + "\n")
+
+        f.flush()
+
+    if args.output:
+        f.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("audio_path", type=str)
+    parser.add_argument("--output", type=str, default=None, help="Default to stdout")
+    parser.add_argument("--format", type=str, default=None, choices=["jsonl", "srt"])
+    parser.add_argument("--window", type=float, default=10., help="Window duration in seconds")
+    parser.add_argument("--hop", type=float, default=10., help="Hop between windows in seconds")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--device", type=str, default=None)
+    args = parser.parse_args()
+
+    caption_long(args)
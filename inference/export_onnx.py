@@ -0,0 +1,193 @@
+"""Export the Cnn14 encoder and the Llama decoder to ONNX.
+
+Usage:
+    python inference/export_onnx.py --output_dir inference/onnx
+
+Writes:
+    encoder.onnx: audio (b, samples_num), lengths (b,) -> audio_latent (b, 1, d)
+    decoder_prefill.onnx: audio_latent, text_ids (b, t), input_pos (t_all,), 
+        k_caches, v_caches -> logits (b, v), k_caches, v_caches
+    decoder_decode.onnx: text_ids (b, 1), input_pos (1,), k_caches, v_caches 
+        -> logits (b, v), k_caches, v_caches
+    meta.json: cache shapes
+
+The caches have shape (n_layer, b, n_head, max_seq_len, head_dim) and are 
+passed in and out of every decoder call, see onnx_backend.OnnxCaptioner.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from inference import CKPT_PATH, cnn14_masked_embedding, get_audio_encoder, get_llm_decoder
+from models.llama import KVCache, Llama
+
+
+class Cnn14Embedding(nn.Module):
+    r"""Cnn14 embedding of zero padded audio."""
+
+    def __init__(self, model: nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, audio: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+        latent = cnn14_masked_embedding(model=self.model, audio=audio, lengths=lengths)  # (b, d)
+        return latent[:, None, :]  # (b, t_audio, d)
+
+
+class LlamaWithCaches(nn.Module):
+    r"""Llama forward with stacked key/value caches as inputs and outputs. 
+    Returns the text logits of the last step."""
+
+    def __init__(self, llm_decoder: Llama, seq_types: list[str]) -> None:
+        super().__init__()
+        self.llm_decoder = llm_decoder
+        self.seq_types = seq_types
+
+    def forward(self, *inputs: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+
+        seqs = list(inputs[0 : len(self.seq_types)])
+        input_pos, k_caches, v_caches = inputs[len(self.seq_types) :]
+
+        kv_caches = [
+            KVCache(k=k_caches[n].clone(), v=v_caches[n].clone()) 
+            for n in range(k_caches.shape[0])
+        ]
+
+        outputs = self.llm_decoder(
+            seqs=seqs, 
+            seq_types=self.seq_types, 
+            kv_caches=kv_caches, 
+            input_pos=input_pos,
+            last_only=True
+        )
+
+        logits = outputs[-1][:, -1, :]  # shape: (b, v)
+        k_caches = torch.stack([kv_cache.k for kv_cache in kv_caches], dim=0)
+        v_caches = torch.stack([kv_cache.v for kv_cache in kv_caches], dim=0)
+
+        return logits, k_caches, v_caches
+
+
+def export(args):
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    device = "cpu"
+    batch_size = 2
+    sr = 32000
+
+    audio_encoder, audio_latent_dim = get_audio_encoder(model_name="Cnn14", device=device)
+    audio_encoder.eval()
+
+    llm_decoder = get_llm_decoder(
+        model_name="Llama",
+        audio_latent_dim=audio_latent_dim,
+        text_vocab_size=args.vocab_size
+    )
+    llm_decoder.load_state_dict(torch.load(args.ckpt_path, map_location=device))
+    llm_decoder.eval()
+
+    config = llm_decoder.config
+    head_dim = config.n_embd // config.n_head
+    cache_shape = (config.n_layer, batch_size, config.n_head, args.max_seq_len, head_dim)
+
+    # Encoder
+    audio = torch.randn(batch_size, sr * 2)
+    lengths = torch.LongTensor([sr * 2, sr])
+
+    torch.onnx.export(
+        Cnn14Embedding(audio_encoder),
+        args=(audio, lengths),
+        f=str(Path(output_dir, "encoder.onnx")),
+        input_names=["audio", "lengths"],
+        output_names=["audio_latent"],
+        dynamic_axes={"audio": {0: "b", 1: "samples_num"}, "lengths": {0: "b"}, "audio_latent": {0: "b"}},
+        opset_version=args.opset
+    )
+
+    cache_axes = {0: "n_layer", 1: "b"}
+
+    # Decoder prefill
+    audio_latent = torch.randn(batch_size, 1, audio_latent_dim)
+    text_ids = torch.full((batch_size, 1), fill_value=args.cls_token_id, dtype=torch.long)
+    input_pos = torch.arange(2)
+    k_caches = torch.zeros(cache_shape)
+    v_caches = torch.zeros(cache_shape)
+
+    with torch.no_grad():
+        torch.onnx.export(
+            LlamaWithCaches(llm_decoder, seq_types=["audio", "text"]),
+            args=(audio_latent, text_ids, input_pos, k_caches, v_caches),
+            f=str(Path(output_dir, "decoder_prefill.onnx")),
+            input_names=["audio_latent", "text_ids", "input_pos", "k_caches", "v_caches"],
+            output_names=["logits", "k_caches_out", "v_caches_out"],
+            dynamic_axes={
+                "audio_latent": {0: "b"}, 
+                "text_ids": {0: "b", 1: "t_text"}, 
+                "input_pos": {0: "t"},
+                "k_caches": cache_axes, 
+                "v_caches": cache_axes, 
+                "logits": {0: "b"},
+                "k_caches_out": cache_axes, 
+                "v_caches_out": cache_axes
+            },
+            opset_version=args.opset
+        )
+
+    # Decoder single step
+    text_ids = torch.full((batch_size, 1), fill_value=args.cls_token_id, dtype=torch.long)
+    input_pos = torch.LongTensor([2])
+
+    with torch.no_grad():
+        torch.onnx.export(
+            LlamaWithCaches(llm_decoder, seq_types=["text"]),
+            args=(text_ids, input_pos, k_caches, v_caches),
+            f=str(Path(output_dir, "decoder_decode.onnx")),
+            input_names=["text_ids", "input_pos", "k_caches", "v_caches"],
+            output_names=["logits", "k_caches_out", "v_caches_out"],
+            dynamic_axes={
+                "text_ids": {0: "b"}, 
+                "k_caches": cache_axes, 
+                "v_caches": cache_axes, 
+                "logits": {0: "b"},
+                "k_caches_out": cache_axes, 
+                "v_caches_out": cache_axes
+            },
+            opset_version=args.opset
+        )
+
+    meta = {
+        "n_layer": config.n_layer,
+        "n_head": config.n_head,
+        "head_dim": head_dim,
+        "max_seq_len": args.max_seq_len,
+        "audio_latent_dim": audio_latent_dim,
+        "vocab_size": config.vocab_size,
+    }
+
+    with open(Path(output_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+    print("Export ONNX models to {}".format(output_dir))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_path", type=str, default=CKPT_PATH)
+    parser.add_argument("--output_dir", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx"))
+    parser.add_argument("--max_seq_len", type=int, default=32, help="Audio latent + [CLS] + max new tokens")
+    parser.add_argument("--vocab_size", type=int, default=30522)
+    parser.add_argument("--cls_token_id", type=int, default=101)
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    export(args)
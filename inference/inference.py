@@ -2,80 +2,665 @@
 """
 from __future__ import annotations
 
-import librosa
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 
-
-from data.text_normalization import TextNormalization
-from data.text_tokenization import BertTokenizer
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from panns_inference import AudioTagging
+
+from data.audio_io import get_resampler, iter_audio_windows, load_audio
+from data.embedding_cache import EmbeddingCache, encoder_fingerprint, file_fingerprint
 from data.text_normalization import TextNormalization
 from data.text_tokenization import BertTokenizer
+from data.vocab_pruning import VocabMapping
 from models.llama import Llama, LlamaConfig
+from models.speculative import init_draft_from_target, speculative_generate
 
 
-def inference(audio_path):
-    ckpt_path = "inference\\step=10000.pth"
-    sr = 32000
-    device = "cuda"
-    max_length = 20
-    audio_encoder_name = "Cnn14"
-    llm_decoder_name = "Llama"
-    num_samples = 1
-    temperature = 1.0
-    top_k = 200
-
-    # crop = RandomCrop(clip_duration=clip_duration, end_pad=0.)
-    target_transform = [
-        TextNormalization(),
-        BertTokenizer(max_length=max_length)
-    ]
-    tokenizer = target_transform[1].tokenizer
-    start_token_id = tokenizer.cls_token_id
-    text_vocab_size = tokenizer.vocab_size
-
-    audio_encoder, audio_latent_dim = get_audio_encoder(model_name=audio_encoder_name)
-    audio_encoder.to(device)
-    llm_decoder = get_llm_decoder(
-        model_name=llm_decoder_name,
-        audio_latent_dim=audio_latent_dim,
-        text_vocab_size=text_vocab_size
-    )
-    llm_decoder.load_state_dict(torch.load(ckpt_path))
-    llm_decoder.to(device)
-    text_ids = torch.LongTensor([[start_token_id]]).to(device)
-
-    audio, _ = librosa.load(path=audio_path, sr=sr, mono=True)
-    audio = torch.Tensor(audio[None, None, :]).to(device)
-    audio_latent = get_audio_latent(
-        model_name=audio_encoder_name,
-        model=audio_encoder, audio=audio
-    )
-    for n in range(num_samples):
-        input_seqs = [audio_latent, text_ids]
-        seq_types = ["audio", "text"]
-        with torch.no_grad():
-            llm_decoder.eval()
-            outputs = llm_decoder.generate(
-                seqs=input_seqs,
-                seq_types=seq_types,
-                max_new_tokens=max_length,
-                temperature=temperature,
-                top_k=top_k
+CKPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "step=10000.pth")
+ONNX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx")
+
+
+class InferenceSession:
+    r"""Long-lived captioning session.
+
+    The audio encoder, the LLM decoder and the tokenizer are loaded once and
+    kept in eval mode on one device, so every caption after the first one only
+    pays for the forward passes. The GUI and batch tools share one session via
+    get_session().
+    """
+
+    def __init__(
+        self,
+        ckpt_path: str = CKPT_PATH,
+        device: None | str = None,
+        sr: int = 32000,
+        max_length: int = 20,
+        audio_encoder_name: str = "Cnn14",
+        llm_decoder_name: str = "Llama",
+        temperature: float = 1.0,
+        top_k: None | int = 200,
+        beam_size: None | int = None,
+        length_penalty: float = 1.0,
+        quantize: bool = False,
+        backend: str = "torch",
+        onnx_dir: str = ONNX_DIR,
+        embedding_cache: None | EmbeddingCache = None,
+        vocab_path: None | str = None,
+        draft_ckpt_path: None | str = None,
+        draft_n_layer: int = 2,
+        num_draft_tokens: int = 4
+    ) -> None:
+        r"""
+        Args:
+            device: None | str, e.g., "cuda" | "cpu". Default to "cuda" if 
+                available, otherwise "cpu"
+            beam_size: None | int, use top-k sampling if None, otherwise beam search
+            length_penalty: float, beam scores are divided by length ** length_penalty
+            quantize: bool, int8 dynamic quantization of the LLM decoder, CPU only
+            backend: str, "torch" | "onnx". The onnx backend runs the models 
+                exported by export_onnx.py with onnxruntime
+            onnx_dir: str, directory of the exported ONNX models
+            embedding_cache: None | EmbeddingCache, reuse the audio latents 
+                of audio that has been captioned before. A cache without 
+                encoder_id is bound to the audio encoder by load(), a cache 
+                of another encoder raises ValueError
+            vocab_path: None | str, vocabulary written by prune_vocab.py. The 
+                checkpoint (or ONNX models) must be pruned with the same 
+                vocabulary. Sampling runs over the reduced vocabulary
+            draft_ckpt_path: None | str, draft decoder trained by 
+                train_draft.py. Single captions of caption() and 
+                caption_batch() are sampled with speculative decoding, which 
+                keeps the distribution of the LLM decoder. caption_stream(), 
+                which the GUI uses, always samples with the LLM decoder alone
+            draft_n_layer: int, number of blocks of the draft decoder
+            num_draft_tokens: int, tokens proposed by the draft per forward 
+                of the LLM decoder
+        """
+
+        self.ckpt_path = ckpt_path
+        self.device = get_device(device)
+        self.sr = sr
+        self.max_length = max_length
+        self.audio_encoder_name = audio_encoder_name
+        self.llm_decoder_name = llm_decoder_name
+        self.temperature = temperature
+        self.top_k = top_k
+        self.beam_size = beam_size
+        self.length_penalty = length_penalty
+        self.quantize = quantize
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        self.embedding_cache = embedding_cache
+        self.vocab_path = vocab_path
+        self.draft_ckpt_path = draft_ckpt_path
+        self.draft_n_layer = draft_n_layer
+        self.num_draft_tokens = num_draft_tokens
+
+        if quantize and self.device != "cpu":
+            raise ValueError("Dynamic quantization only runs on CPU, got device={}".format(self.device))
+
+        if backend not in ["torch", "onnx"]:
+            raise ValueError(backend)
+
+        if backend == "onnx" and beam_size is not None:
+            raise ValueError("Beam search is not supported by the onnx backend")
+
+        if draft_ckpt_path is not None and (backend == "onnx" or quantize):
+            raise ValueError("Speculative decoding only runs with the float torch backend")
+
+        self.tokenizer = None
+        self.audio_encoder = None
+        self.llm_decoder = None
+        self.draft_decoder = None
+        self.onnx_captioner = None
+        self.vocab = None
+
+        self._load_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._warmup_thread = None
+
+        # Latency statistics in seconds
+        self.load_time = None
+        self.cold_latency = None
+        self.warm_latencies = []
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.tokenizer is not None
+
+    def load(self) -> None:
+        r"""Load the tokenizer, audio encoder and LLM decoder. Safe to call
+        from several threads, the models are only loaded once."""
+
+        with self._load_lock:
+
+            if self.is_loaded:
+                return
+
+            t0 = time.perf_counter()
+
+            tokenizer = BertTokenizer(max_length=self.max_length).tokenizer
+
+            if self.vocab_path is not None:
+                self.vocab = VocabMapping.load(self.vocab_path)
+
+            if self.backend == "onnx":
+                try:
+                    from onnx_backend import OnnxCaptioner
+                except ImportError:
+                    # Imported as inference.inference from the repo root
+                    from inference.onnx_backend import OnnxCaptioner
+                self.onnx_captioner = OnnxCaptioner(onnx_dir=self.onnx_dir)
+                if self.embedding_cache is not None:
+                    self.embedding_cache.bind_encoder(file_fingerprint(
+                        "{}-onnx".format(self.audio_encoder_name), os.path.join(self.onnx_dir, "encoder.onnx")))
+                self.tokenizer = tokenizer
+                self.load_time = time.perf_counter() - t0
+                return
+
+            audio_encoder, audio_latent_dim = get_audio_encoder(
+                model_name=self.audio_encoder_name, 
+                device=self.device
+            )
+            audio_encoder.to(self.device)
+            audio_encoder.eval()
+
+            if self.embedding_cache is not None:
+                self.embedding_cache.bind_encoder(encoder_fingerprint(self.audio_encoder_name, audio_encoder))
+
+            llm_decoder = get_llm_decoder(
+                model_name=self.llm_decoder_name,
+                audio_latent_dim=audio_latent_dim,
+                text_vocab_size=self.vocab.vocab_size if self.vocab else tokenizer.vocab_size
             )
-        sampled_text_ids = outputs[-1][0].cpu().numpy()
-        strings = tokenizer.decode(token_ids=sampled_text_ids, skip_special_tokens=True)
+            llm_decoder.load_state_dict(torch.load(self.ckpt_path, map_location=self.device))
+            llm_decoder.to(self.device)
+            llm_decoder.eval()
+
+            if self.quantize:
+                llm_decoder = quantize_llm_decoder(llm_decoder)
+
+            if self.draft_ckpt_path is not None:
+                draft_decoder = init_draft_from_target(target=llm_decoder, n_layer=self.draft_n_layer)
+                draft_decoder.load_state_dict(torch.load(self.draft_ckpt_path, map_location=self.device))
+                draft_decoder.eval()
+                self.draft_decoder = draft_decoder
+
+            self.audio_encoder = audio_encoder
+            self.llm_decoder = llm_decoder
+            self.tokenizer = tokenizer
+            self.load_time = time.perf_counter() - t0
+
+    def warmup(self, background: bool = False) -> None | threading.Thread:
+        r"""Load the models and run one dummy caption so that the first user
+        request does not pay for lazy initialization.
+
+        Args:
+            background: bool, run in a daemon thread and return the thread
+
+        Returns:
+            thread: None | threading.Thread
+        """
+
+        if background:
+            if self._warmup_thread is None or not self._warmup_thread.is_alive():
+                self._warmup_thread = threading.Thread(target=self.warmup, daemon=True)
+                self._warmup_thread.start()
+            return self._warmup_thread
+
+        t0 = time.perf_counter()
+        self.load()
+        audio = np.zeros(self.sr, dtype=np.float32)  # 1 s of silence
+        self._caption(audio)
+
+        # The warmup caption is the cold one, the following captions are warm
+        self._record_latency(time.perf_counter() - t0)
+        return None
+
+    def caption(
+        self, 
+        audio: str | np.ndarray | torch.Tensor, 
+        sr: None | int = None, 
+        record_latency: bool = True
+    ) -> str:
+        r"""Caption an audio file or a waveform.
+
+        Args:
+            audio: str, path of an audio file | (samples_num,) | (channels_num, samples_num), 
+                float or PCM integer waveform
+            sr: None | int, sample rate of a waveform input, default to self.sr
+            record_latency: bool, False to keep the caption out of 
+                latency_stats(), e.g., live captions of a recording
+
+        Returns:
+            caption: str
+        """
+
+        # The first caption of a session is cold, it includes model loading
+        # unless warmup() has already been called.
+        t0 = time.perf_counter()
+        self.load()
+        strings = self._caption(audio, sr=sr)
+
+        if record_latency:
+            self._record_latency(time.perf_counter() - t0)
+
         return strings
 
+    def caption_stream(
+        self, 
+        audio: str | np.ndarray | torch.Tensor, 
+        sr: None | int = None
+    ) -> Iterator[str]:
+        r"""Caption an audio file or a waveform, yielding the partial caption 
+        after every sampled token.
+
+        WordPiece continuations (e.g., "##ing") are merged by the tokenizer, so 
+        a partial caption may change its last word on the next step. The onnx 
+        backend and beam search only yield the final caption. The draft 
+        decoder is not used, tokens are sampled from the LLM decoder one by one.
+
+        Args:
+            audio: str, path of an audio file | (samples_num,) | (channels_num, samples_num), 
+                float or PCM integer waveform
+            sr: None | int, sample rate of a waveform input, default to self.sr
+
+        Yields:
+            caption: str, the caption decoded so far
+        """
+
+        t0 = time.perf_counter()
+        self.load()
+
+        if self.backend == "onnx" or self.beam_size is not None:
+            caption = self._caption(audio, sr=sr)
+            self._record_latency(time.perf_counter() - t0)
+            yield caption
+            return
+
+        audio = self.load_audio(audio, sr=sr)
+        audio_latent = self._get_audio_latent([audio])  # shape: (1, t_audio, d)
+        audio_latent = torch.from_numpy(audio_latent).to(self.device)
+
+        cls_token_id = self._model_token_id(self.tokenizer.cls_token_id)
+        sep_token_id = self._model_token_id(self.tokenizer.sep_token_id)
+
+        text_ids = torch.full((1, 1), fill_value=cls_token_id, dtype=torch.long)
+        text_ids = text_ids.to(self.device)
+
+        token_ids = []
+        caption = ""
+
+        for next_token in self.llm_decoder.generate_stream(
+            seqs=[audio_latent, text_ids],
+            seq_types=["audio", "text"],
+            max_new_tokens=self.max_length,
+            temperature=self.temperature,
+            top_k=self.top_k,
+            eos_token_id=sep_token_id
+        ):
+            token_id = next_token.item()
+
+            if token_id == sep_token_id:
+                break
+
+            token_ids.append(int(self._tokenizer_ids(token_id)))
+            partial = self.tokenizer.decode(token_ids=token_ids, skip_special_tokens=True)
+
+            if partial != caption:
+                caption = partial
+                yield caption
+
+        self._record_latency(time.perf_counter() - t0)
+
+    def caption_batch(
+        self, 
+        audios: list[str | np.ndarray | torch.Tensor], 
+        batch_size: int = 16, 
+        num_workers: int = 4
+    ) -> list[str]:
+        r"""Caption several audio files or waveforms at once.
+
+        The audio files are decoded in parallel, sorted by duration and 
+        captioned batch_size at a time.
+
+        Args:
+            audios: list of paths or waveforms at self.sr
+            batch_size: int
+            num_workers: int, number of audio decoding threads
+
+        Returns:
+            captions: list of str, in the order of audios
+        """
+
+        self.load()
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            waveforms = list(executor.map(self.load_audio, audios))
+
+        # Sort by duration so that each batch is padded as little as possible
+        order = np.argsort([len(waveform) for waveform in waveforms], kind="stable")
+        captions = [None] * len(waveforms)
+
+        for i in range(0, len(order), batch_size):
+            idxes = order[i : i + batch_size]
+            batch_captions = self._caption_waveforms([waveforms[j] for j in idxes])
+
+            for j, caption in zip(idxes, batch_captions):
+                captions[j] = caption
+
+        return captions
+
+    def caption_long(
+        self, 
+        audio_path: str, 
+        window: float = 10., 
+        hop: float = 10., 
+        batch_size: int = 16,
+        min_duration: float = 1.
+    ) -> Iterator[dict]:
+        r"""Caption a long recording window by window.
+
+        The file is read one window at a time and batch_size windows are 
+        captioned at once, so memory does not grow with the file length.
+
+        Args:
+            audio_path: str
+            window: float, window duration in seconds, e.g., the 10 s 
+                clip_duration used in training
+            hop: float, hop between window starts in seconds
+            batch_size: int
+            min_duration: float, drop a last window shorter than this
+
+        Yields:
+            segment: dict, e.g., {"start": 10.0, "end": 20.0, "caption": "..."}
+        """
+
+        self.load()
+
+        batch = []
+
+        for start, waveform in iter_audio_windows(
+            path=audio_path, sr=self.sr, window=window, hop=hop, min_duration=min_duration
+        ):
+            batch.append((start, waveform))
+
+            if len(batch) == batch_size:
+                yield from self._caption_segments(batch)
+                batch = []
+
+        if batch:
+            yield from self._caption_segments(batch)
+
+    def _caption_segments(self, batch: list[tuple[float, np.ndarray]]) -> Iterator[dict]:
+
+        captions = self._caption_waveforms([waveform for _, waveform in batch])
+
+        for (start, waveform), caption in zip(batch, captions):
+            yield {
+                "start": round(start, 3), 
+                "end": round(start + len(waveform) / self.sr, 3), 
+                "caption": caption
+            }
+
+    def _caption(self, audio: str | np.ndarray | torch.Tensor, sr: None | int = None) -> str:
+        audio = self.load_audio(audio, sr=sr)
+        return self._caption_waveforms([audio])[0]
+
+    def _caption_waveforms(self, waveforms: list[np.ndarray]) -> list[str]:
+        r"""Caption a batch of mono waveforms at self.sr."""
+
+        audio_latent = self._get_audio_latent(waveforms)
+        new_ids = self._decode(audio_latent)
+
+        captions = [
+            self.tokenizer.decode(token_ids=ids, skip_special_tokens=True) 
+            for ids in new_ids
+        ]
+
+        return captions
+
+    def _get_audio_latent(self, waveforms: list[np.ndarray]) -> np.ndarray:
+        r"""Audio latents of a batch of mono waveforms, read from the embedding 
+        cache if there is one."""
+
+        if self.embedding_cache is None:
+            return self._encode(waveforms)
+
+        return self.embedding_cache.get_or_compute(
+            keys=[self.embedding_cache.key(waveform) for waveform in waveforms], 
+            compute=lambda idxes: self._encode([waveforms[n] for n in idxes])
+        )
+
+    def _encode(self, waveforms: list[np.ndarray]) -> np.ndarray:
+        r"""Audio latents of a batch of mono waveforms at self.sr.
+
+        Outputs:
+            audio_latent: (b, t_audio, d)
+        """
+
+        B = len(waveforms)
+        lengths = [len(waveform) for waveform in waveforms]
+
+        if B == 1:
+            # A view, no copy
+            audio = np.ascontiguousarray(waveforms[0], dtype=np.float32)[None, None, :]
+        else:
+            # Zero pad to the longest waveform
+            audio = np.zeros((B, 1, max(lengths)), dtype=np.float32)
+            for n, waveform in enumerate(waveforms):
+                audio[n, 0, 0 : lengths[n]] = waveform
+
+        if self.backend == "onnx":
+            return self.onnx_captioner.get_audio_latent(
+                audio=audio[:, 0, :], 
+                lengths=np.array(lengths, dtype=np.int64)
+            )
+
+        audio = torch.from_numpy(audio).to(self.device)
+
+        # Exclude the padded frames from the encoder pooling
+        if min(lengths) == max(lengths):
+            lengths = None
+        else:
+            lengths = torch.LongTensor(lengths).to(self.device)
+
+        audio_latent = get_audio_latent(
+            model_name=self.audio_encoder_name,
+            model=self.audio_encoder, 
+            audio=audio,
+            lengths=lengths
+        )
+
+        return audio_latent.cpu().numpy()
+
+    def _decode(self, audio_latent: np.ndarray) -> np.ndarray:
+        r"""Generate token IDs from audio latents.
+
+        Args:
+            audio_latent: (b, t_audio, d)
+
+        Outputs:
+            text_ids: (b, t_text), tokenizer ids
+        """
+
+        B = audio_latent.shape[0]
+        cls_token_id = self._model_token_id(self.tokenizer.cls_token_id)
+        sep_token_id = self._model_token_id(self.tokenizer.sep_token_id)
+
+        if self.backend == "onnx":
+            text_ids = np.full((B, 1), fill_value=cls_token_id, dtype=np.int64)
+
+            text_ids = self.onnx_captioner.generate(
+                audio_latent=audio_latent,
+                text_ids=text_ids,
+                max_new_tokens=self.max_length,
+                temperature=self.temperature,
+                top_k=self.top_k,
+                eos_token_id=sep_token_id
+            )
+
+            return self._tokenizer_ids(text_ids)
+
+        audio_latent = torch.from_numpy(audio_latent).to(self.device)
+        text_ids = torch.full((B, 1), fill_value=cls_token_id, dtype=torch.long)
+        text_ids = text_ids.to(self.device)
+
+        with torch.no_grad():
+            if self.beam_size is None and self.draft_decoder is not None and B == 1:
+                outputs, _ = speculative_generate(
+                    target=self.llm_decoder,
+                    draft=self.draft_decoder,
+                    seqs=[audio_latent, text_ids],
+                    seq_types=["audio", "text"],
+                    max_new_tokens=self.max_length,
+                    num_draft_tokens=self.num_draft_tokens,
+                    temperature=self.temperature,
+                    top_k=self.top_k,
+                    eos_token_id=sep_token_id
+                )
+            elif self.beam_size is None:
+                outputs = self.llm_decoder.generate(
+                    seqs=[audio_latent, text_ids],
+                    seq_types=["audio", "text"],
+                    max_new_tokens=self.max_length,
+                    temperature=self.temperature,
+                    top_k=self.top_k,
+                    eos_token_id=sep_token_id
+                )
+            else:
+                outputs = self.llm_decoder.beam_search(
+                    seqs=[audio_latent, text_ids],
+                    seq_types=["audio", "text"],
+                    max_new_tokens=self.max_length,
+                    beam_size=self.beam_size,
+                    eos_token_id=sep_token_id,
+                    length_penalty=self.length_penalty
+                )
+
+        return self._tokenizer_ids(outputs[-1].cpu().numpy())
+
+    def load_audio(self, audio: str | np.ndarray | torch.Tensor, sr: None | int = None) -> np.ndarray:
+        r"""Load or convert audio to a mono float32 waveform at self.sr.
+
+        Outputs:
+            audio: (samples_num,)
+        """
+
+        if isinstance(audio, (str, os.PathLike)):
+            return load_audio(path=audio, sr=self.sr)
+
+        if isinstance(audio, torch.Tensor):
+            audio = audio.detach().cpu().numpy()
+
+        if np.issubdtype(audio.dtype, np.integer):
+            # PCM, e.g., int16 microphone audio
+            scale = 1. / (np.iinfo(audio.dtype).max + 1)
+            audio = audio.astype(np.float32) * scale
+        else:
+            audio = np.asarray(audio, dtype=np.float32)
+
+        if audio.ndim == 2:
+            audio = np.mean(audio, axis=0)
+
+        if sr is not None and sr != self.sr:
+            audio = get_resampler(sr, self.sr)(np.ascontiguousarray(audio))
+
+        return audio
+
+    def _model_token_id(self, token_id: int) -> int:
+        r"""Tokenizer id to the id embedded and predicted by the LLM decoder."""
+        if self.vocab is None:
+            return token_id
+        return int(self.vocab.table[token_id])
+
+    def _tokenizer_ids(self, ids: np.ndarray) -> np.ndarray:
+        r"""Ids predicted by the LLM decoder to tokenizer ids."""
+        if self.vocab is None:
+            return ids
+        return self.vocab.to_full(ids)
+
+    def _record_latency(self, latency: float) -> None:
+        with self._stats_lock:
+            if self.cold_latency is None:
+                self.cold_latency = latency
+            else:
+                self.warm_latencies.append(latency)
+
+    def latency_stats(self) -> dict:
+        r"""Cold (warmup() or the first caption) versus warm (subsequent 
+        captions) latency."""
+
+        with self._stats_lock:
+            warm = list(self.warm_latencies)
+
+        return {
+            "load_time": self.load_time,
+            "cold_latency": self.cold_latency,
+            "warm_latency_mean": float(np.mean(warm)) if warm else None,
+            "warm_count": len(warm),
+        }
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(**kwargs) -> InferenceSession:
+    r"""Return the process wide InferenceSession, creating it with kwargs on 
+    first use. Later calls may omit kwargs, but options that differ from the 
+    ones of the live session raise a ValueError instead of silently returning 
+    a session with other options."""
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = InferenceSession(**kwargs)
+
+        else:
+            different = {}
+
+            for key, value in kwargs.items():
+                current = getattr(_session, key)
+
+                if key == "device":
+                    value = get_device(value)
+
+                if value is not current and value != current:
+                    different[key] = (current, value)
+
+            if different:
+                raise ValueError("The shared InferenceSession has other options, (current, requested): {}".format(different))
+
+    return _session
+
+
+def inference(audio_path):
+    return get_session().caption(audio_path)
+
 
 def tokens_to_string(tokens, tokenizer):
     return "".join([tokenizer.itos(token) for token in tokens])
 
-def get_audio_encoder(model_name: str) -> nn.Module:
+def get_device(device: None | str = None) -> str:
+    r"""Return device, or "cuda" if available and "cpu" otherwise."""
+    if device is not None:
+        return device
+
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def get_audio_encoder(model_name: str, device: None | str = None) -> nn.Module:
     r"""Load pretrained audio encoder."""
     if model_name == "Cnn14":
-        model = AudioTagging().model
+        model = AudioTagging(device=get_device(device)).model
         latent_dim = 2048
         return model, latent_dim
 
@@ -104,10 +689,32 @@ def get_llm_decoder(
         raise ValueError(model_name)    
 
 
+def quantize_llm_decoder(model: nn.Module) -> nn.Module:
+    r"""Int8 dynamic quantization of the Linear layers of the LLM decoder. 
+
+    The attention, MLP, a2e and text_head layers are quantized. The audio_head
+    is not used for captioning and is kept in float32. Runs on CPU only.
+    """
+
+    names = {
+        name for name, module in model.named_modules() 
+        if isinstance(module, nn.Linear) and name != "audio_head"
+    }
+
+    model = torch.ao.quantization.quantize_dynamic(
+        model=model, 
+        qconfig_spec=names, 
+        dtype=torch.qint8
+    )
+
+    return model
+
+
 def get_audio_latent(
     model_name: str, 
     model: nn.Module, 
-    audio: torch.Tensor
+    audio: torch.Tensor,
+    lengths: None | torch.Tensor = None
 ) -> torch.Tensor:
     r"""Calculate audio latent from an audio.
 
@@ -115,6 +722,7 @@ def get_audio_latent(
         model_name: str
         model: nn.Module
         audio: (batch_size, channels_num, samples_num)
+        lengths: None | (batch_size,), valid samples of zero padded audio
 
     Outputs:
         audio_latent: (batch_size, time_steps, emb_dim)
@@ -122,7 +730,10 @@ def get_audio_latent(
     if model_name == "Cnn14":
         with torch.no_grad():
             model.eval()
-            latent = model(audio[:, 0, :])["embedding"]  # (b, d)
+            if lengths is None:
+                latent = model(audio[:, 0, :])["embedding"]  # (b, d)
+            else:
+                latent = cnn14_masked_embedding(model=model, audio=audio[:, 0, :], lengths=lengths)
             latent = latent[:, None, :]  # (b, t_audio, d)
         return latent
 
@@ -130,8 +741,59 @@ def get_audio_latent(
         raise ValueError(model_name)        
 
 
+def cnn14_masked_embedding(
+    model: nn.Module, 
+    audio: torch.Tensor, 
+    lengths: torch.Tensor,
+    hop_length: int = 320
+) -> torch.Tensor:
+    r"""Cnn14 embedding of zero padded audio. Same as Cnn14.forward() in eval 
+    mode, except that the global max and mean pooling over time only use the 
+    frames of the valid samples.
+
+    Args:
+        model: Cnn14
+        audio: (batch_size, samples_num)
+        lengths: (batch_size,)
+        hop_length: int, STFT hop size of Cnn14
+
+    Outputs:
+        embedding: (batch_size, emb_dim)
+    """
+
+    x = model.spectrogram_extractor(audio)  # shape: (b, 1, t, f)
+    x = model.logmel_extractor(x)  # shape: (b, 1, t, mel_bins)
+
+    x = x.transpose(1, 3)
+    x = model.bn0(x)
+    x = x.transpose(1, 3)
+
+    x = model.conv_block1(x, pool_size=(2, 2), pool_type="avg")
+    x = model.conv_block2(x, pool_size=(2, 2), pool_type="avg")
+    x = model.conv_block3(x, pool_size=(2, 2), pool_type="avg")
+    x = model.conv_block4(x, pool_size=(2, 2), pool_type="avg")
+    x = model.conv_block5(x, pool_size=(2, 2), pool_type="avg")
+    x = model.conv_block6(x, pool_size=(1, 1), pool_type="avg")
+    x = torch.mean(x, dim=3)  # shape: (b, c, t')
+
+    # Valid frames after the STFT (center=True) and five 2x time poolings
+    frames_num = torch.div(lengths, hop_length, rounding_mode="floor") + 1
+    frames_num = torch.div(frames_num, 32, rounding_mode="floor").clamp(1, x.shape[2])
+    mask = torch.arange(x.shape[2], device=x.device)[None, :] < frames_num[:, None]  # shape: (b, t')
+    mask = mask[:, None, :]  # shape: (b, 1, t')
+
+    x1 = x.masked_fill(~mask, -float("Inf")).max(dim=2)[0]
+    x2 = (x * mask).sum(dim=2) / mask.sum(dim=2)
+    x = x1 + x2  # shape: (b, c)
+
+    embedding = F.relu_(model.fc1(x))  # shape: (b, emb_dim)
+
+    return embedding
+
+
 if __name__ == "__main__":
 
     audio_path = "recoding"
 
-    inference(audio_path)
\ No newline at end of file
+    print(inference(audio_path))
+    print(get_session().latency_stats())
\ No newline at end of file
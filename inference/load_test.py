@@ -0,0 +1,95 @@
+"""Drive the caption server with concurrent requests.
+
+Usage:
+    python inference/server.py --port 8000
+    python inference/load_test.py recoding/001.wav --requests 200 --concurrency 32
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+
+async def post(args, body: bytes) -> tuple[int, float]:
+
+    t0 = time.perf_counter()
+
+    if args.unix_socket:
+        reader, writer = await asyncio.open_unix_connection(args.unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+
+    writer.write("POST /caption HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n".format(args.host, len(body)).encode())
+    writer.write(body)
+    await writer.drain()
+
+    response = await reader.read()
+    writer.close()
+
+    status = int(response.split(b" ", 2)[1])
+
+    return status, time.perf_counter() - t0
+
+
+async def get_stats(args) -> dict:
+
+    if args.unix_socket:
+        reader, writer = await asyncio.open_unix_connection(args.unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+
+    writer.write("GET /stats HTTP/1.1\r\nHost: {}\r\n\r\n".format(args.host).encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+async def load_test(args):
+
+    with open(args.audio_path, "rb") as f:
+        body = f.read()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = []
+
+    async def _request():
+        async with semaphore:
+            results.append(await post(args, body))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[_request() for _ in range(args.requests)])
+    duration = time.perf_counter() - t0
+
+    latencies = np.array([latency for status, latency in results if status == 200])
+    statuses = [status for status, _ in results]
+
+    print("Requests: {}, concurrency: {}".format(args.requests, args.concurrency))
+    print("Status codes: {}".format({s: statuses.count(s) for s in sorted(set(statuses))}))
+    print("Throughput: {:.2f} requests/s".format(len(latencies) / duration))
+
+    if len(latencies) > 0:
+        print("Latency p50: {:.3f} s, p95: {:.3f} s, max: {:.3f} s".format(
+            np.percentile(latencies, 50), np.percentile(latencies, 95), np.max(latencies)
+        ))
+
+    print("Server stats: {}".format(await get_stats(args)))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("audio_path", type=str)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", type=str, default=None)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    asyncio.run(load_test(args))
@@ -0,0 +1,162 @@
+"""onnxruntime backend of the captioner. Export the models first with 
+inference/export_onnx.py.
+"""
+from __future__ import annotations
+
+import json
+import os
+
+import numpy as np
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+
+class OnnxCaptioner:
+    r"""Run the exported Cnn14 encoder and Llama decoder with onnxruntime."""
+
+    def __init__(self, onnx_dir: str, providers: None | list[str] = None) -> None:
+
+        if ort is None:
+            raise ImportError("onnxruntime is not installed, run pip install onnxruntime")
+
+        providers = providers or ["CPUExecutionProvider"]
+
+        with open(os.path.join(onnx_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+
+        def _load(name):
+            return ort.InferenceSession(os.path.join(onnx_dir, name), providers=providers)
+
+        self.encoder = _load("encoder.onnx")
+        self.prefill = _load("decoder_prefill.onnx")
+        self.decode = _load("decoder_decode.onnx")
+
+        self.rng = np.random.default_rng()
+
+    def get_audio_latent(self, audio: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        r"""
+        Args:
+            audio: (b, samples_num), float32, zero padded
+            lengths: (b,), int64
+
+        Outputs:
+            audio_latent: (b, 1, d)
+        """
+        audio_latent, = self.encoder.run(None, {"audio": audio, "lengths": lengths})
+        return audio_latent
+
+    def generate(
+        self, 
+        audio_latent: np.ndarray, 
+        text_ids: np.ndarray, 
+        max_new_tokens: int, 
+        temperature: float = 1.0, 
+        top_k: None | int = 1, 
+        eos_token_id: None | int = None
+    ) -> np.ndarray:
+        r"""Same as Llama.generate() with key/value caches.
+
+        Args:
+            audio_latent: (b, t_audio, d)
+            text_ids: (b, t_text)
+
+        Outputs:
+            new_ids: (b, t_new)
+        """
+
+        B = text_ids.shape[0]
+        prompt_len = audio_latent.shape[1] + text_ids.shape[1]
+        max_seq_len = self.meta["max_seq_len"]
+
+        assert prompt_len + max(max_new_tokens - 1, 0) <= max_seq_len, \
+            "Export with --max_seq_len >= {}".format(prompt_len + max_new_tokens - 1)
+
+        cache_shape = (self.meta["n_layer"], B, self.meta["n_head"], max_seq_len, self.meta["head_dim"])
+        k_caches = np.zeros(cache_shape, dtype=np.float32)
+        v_caches = np.zeros(cache_shape, dtype=np.float32)
+
+        fill_value = eos_token_id if eos_token_id is not None else 0
+        new_ids = np.full((B, max_new_tokens), fill_value=fill_value, dtype=np.int64)
+        num_new_tokens = 0
+        active = np.arange(B)
+
+        # Prefill
+        logits, k_caches, v_caches = self.prefill.run(None, {
+            "audio_latent": audio_latent.astype(np.float32),
+            "text_ids": text_ids.astype(np.int64),
+            "input_pos": np.arange(prompt_len, dtype=np.int64),
+            "k_caches": k_caches,
+            "v_caches": v_caches,
+        })
+
+        for n in range(max_new_tokens):
+
+            next_token = sample_next_token(logits, temperature=temperature, top_k=top_k, rng=self.rng)
+            new_ids[active, n] = next_token
+            num_new_tokens = n + 1
+
+            if n == max_new_tokens - 1:
+                break
+
+            # Remove finished rows from the batch
+            if eos_token_id is not None:
+                unfinished = next_token != eos_token_id
+
+                if not unfinished.all():
+
+                    if not unfinished.any():
+                        break
+
+                    active = active[unfinished]
+                    next_token = next_token[unfinished]
+                    k_caches = k_caches[:, unfinished]
+                    v_caches = v_caches[:, unfinished]
+
+            # Decode one step
+            logits, k_caches, v_caches = self.decode.run(None, {
+                "text_ids": next_token[:, None],
+                "input_pos": np.array([prompt_len + n], dtype=np.int64),
+                "k_caches": k_caches,
+                "v_caches": v_caches,
+            })
+
+        return new_ids[:, 0 : num_new_tokens]
+
+
+def sample_next_token(
+    logits: np.ndarray, 
+    temperature: float, 
+    top_k: None | int, 
+    rng: np.random.Generator
+) -> np.ndarray:
+    r"""Sample next tokens from the final step logits, greedy if top_k == 1.
+
+    Args:
+        logits: (b, v)
+
+    Outputs:
+        next_token: (b,)
+    """
+
+    if top_k == 1:
+        return np.argmax(logits, axis=-1).astype(np.int64)
+
+    logits = logits.astype(np.float64) / temperature
+
+    # Crop the logits to only the top k options, like logits_to_probs()
+    if top_k is not None:
+        top_k = min(top_k, logits.shape[-1])
+        kth = np.partition(logits, -top_k, axis=-1)[:, -top_k][:, None]
+        logits = np.where(logits < kth, -np.inf, logits)
+
+    probs = np.exp(logits - np.max(logits, axis=-1, keepdims=True))
+    probs /= np.sum(probs, axis=-1, keepdims=True)
+
+    cdf = np.cumsum(probs, axis=-1)
+    u = rng.random((probs.shape[0], 1)) * cdf[:, -1:]
+    next_token = np.argmax(cdf > u, axis=-1)
+
+    return next_token.astype(np.int64)
@@ -0,0 +1,75 @@
+"""Prune the text vocabulary of a checkpoint to the tokens of a caption corpus.
+
+Usage:
+    python inference/prune_vocab.py \
+        --captions_csv clotho_captions_development.csv clotho_captions_validation.csv \
+        --output_ckpt inference/step=10000_pruned.pth \
+        --output_vocab inference/vocab.npz
+
+Then caption with InferenceSession(ckpt_path=..., vocab_path=...).
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+
+import pandas as pd
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.text_normalization import TextNormalization
+from data.text_tokenization import BertTokenizer
+from data.vocab_pruning import VocabMapping, prune_state_dict
+from inference import CKPT_PATH
+
+
+def load_captions(captions_csvs: list[str]) -> list[str]:
+    r"""All captions of Clotho csv files (columns caption_1 ... caption_5)."""
+    captions = []
+    for captions_csv in captions_csvs:
+        df = pd.read_csv(captions_csv)
+        for n in range(1, 6):
+            captions.extend(df["caption_{}".format(n)].astype(str).tolist())
+    return captions
+
+
+def prune_vocab(args):
+
+    tokenizer = BertTokenizer(max_length=args.max_length).tokenizer
+    captions = load_captions(args.captions_csv)
+
+    vocab = VocabMapping.from_captions(
+        captions=captions,
+        tokenizer=tokenizer,
+        normalize=TextNormalization(),
+        min_count=args.min_count
+    )
+
+    state_dict = torch.load(args.ckpt_path, map_location="cpu")
+    pruned_state_dict = prune_state_dict(state_dict=state_dict, vocab=vocab)
+
+    torch.save(pruned_state_dict, args.output_ckpt)
+    vocab.save(args.output_vocab)
+
+    n_embd = state_dict["wte.weight"].shape[1]
+    removed_params = 2 * (vocab.full_vocab_size - vocab.vocab_size) * n_embd
+
+    print("Captions: {}".format(len(captions)))
+    print("Vocabulary: {} -> {} tokens".format(vocab.full_vocab_size, vocab.vocab_size))
+    print("Removed {:.1f}M parameters of wte and text_head".format(removed_params / 1e6))
+    print("Write checkpoint to {} and vocabulary to {}".format(args.output_ckpt, args.output_vocab))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--captions_csv", type=str, nargs="+", required=True, help="Clotho captions csv files")
+    parser.add_argument("--ckpt_path", type=str, default=CKPT_PATH)
+    parser.add_argument("--output_ckpt", type=str, required=True)
+    parser.add_argument("--output_vocab", type=str, required=True, help="e.g., vocab.npz")
+    parser.add_argument("--min_count", type=int, default=1)
+    parser.add_argument("--max_length", type=int, default=30)
+    args = parser.parse_args()
+
+    prune_vocab(args)
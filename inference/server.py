@@ -0,0 +1,324 @@
+"""Local HTTP caption server with request micro-batching.
+
+Usage:
+    python inference/server.py --port 8000
+    python inference/server.py --unix_socket /tmp/caption.sock
+
+    curl --data-binary @recoding/001.wav http://127.0.0.1:8000/caption
+    curl http://127.0.0.1:8000/stats
+
+Requests that arrive within max_wait_ms of each other are captioned in one 
+batch, up to max_batch_size. At most max_queue_size requests wait, further 
+requests are rejected with 503 so that clients can back off. Bodies larger 
+than max_body_mb are rejected with 413, and at most max_decodes bodies are 
+read and decoded at once, so memory stays bounded under load.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import soundfile as sf
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from inference import InferenceSession, get_session
+
+
+class MicroBatcher:
+    r"""Collect concurrent caption requests into batches."""
+
+    def __init__(
+        self, 
+        session: InferenceSession, 
+        max_batch_size: int = 16, 
+        max_wait_ms: float = 20., 
+        max_queue_size: int = 64
+    ) -> None:
+
+        self.session = session
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+
+        # One thread runs the models, the event loop keeps serving requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.start_time = time.perf_counter()
+        self.requests_num = 0
+        self.completed_num = 0
+        self.rejected_num = 0
+        self.error_num = 0
+        self.batches_num = 0
+        self.latencies = deque(maxlen=1000)
+        self.batch_sizes = deque(maxlen=1000)
+
+    def submit(self, waveform: np.ndarray) -> asyncio.Future:
+        r"""Queue a waveform at session.sr. Raise asyncio.QueueFull if the 
+        queue is full."""
+
+        future = asyncio.get_running_loop().create_future()
+        self.requests_num += 1
+
+        try:
+            self.queue.put_nowait((waveform, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.rejected_num += 1
+            raise
+
+        return future
+
+    async def run(self) -> None:
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            # Wait a short window for more requests
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            waveforms = [waveform for waveform, _, _ in batch]
+
+            try:
+                captions = await loop.run_in_executor(
+                    self.executor, 
+                    lambda: self.session.caption_batch(audios=waveforms, batch_size=len(waveforms))
+                )
+            except Exception as e:
+                self.error_num += len(batch)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches_num += 1
+            self.batch_sizes.append(len(batch))
+            now = time.perf_counter()
+
+            for (_, future, t0), caption in zip(batch, captions):
+                self.completed_num += 1
+                self.latencies.append(now - t0)
+                if not future.done():
+                    future.set_result(caption)
+
+    def stats(self) -> dict:
+
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        uptime = time.perf_counter() - self.start_time
+
+        return {
+            "requests": self.requests_num,
+            "completed": self.completed_num,
+            "rejected": self.rejected_num,
+            "errors": self.error_num,
+            "queued": self.queue.qsize(),
+            "batches": self.batches_num,
+            "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.,
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "throughput": self.completed_num / uptime,
+        }
+
+
+def decode_audio(data: bytes, session: InferenceSession) -> np.ndarray:
+    r"""Decode audio file bytes to a mono waveform at session.sr."""
+    audio, sr = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)  # shape: (t, c)
+    return session.load_audio(np.mean(audio, axis=1), sr=sr)
+
+
+async def read_head(reader: asyncio.StreamReader) -> tuple[str, str, int]:
+    r"""Read the head of one HTTP/1.1 request. Returns method, path and the 
+    content length, the body is left in reader."""
+
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    method, path, _ = lines[0].split(" ", 2)
+
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get("content-length", 0))
+    if length < 0:
+        raise ValueError("Negative Content-Length")
+
+    return method, path, length
+
+
+def write_response(writer: asyncio.StreamWriter, status: int, content: dict) -> None:
+    reasons = {
+        200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 
+        431: "Request Header Fields Too Large", 500: "Internal Server Error", 
+        503: "Service Unavailable"
+    }
+    body = json.dumps(content).encode()
+    writer.write("HTTP/1.1 {} {}\r\n".format(status, reasons[status]).encode())
+    writer.write(b"Content-Type: application/json\r\n")
+    writer.write("Content-Length: {}\r\n".format(len(body)).encode())
+    writer.write(b"Connection: close\r\n\r\n")
+    writer.write(body)
+
+
+async def discard_body(reader: asyncio.StreamReader, length: int, limit: int = 4 * 1024 ** 2, timeout: float = 1.) -> None:
+    r"""Read and drop up to limit bytes of a body that was not read, so that 
+    a client that is still sending receives the response instead of a 
+    connection reset."""
+
+    length = min(length, limit)
+
+    try:
+        while length > 0:
+            data = await asyncio.wait_for(reader.read(min(length, 1 << 16)), timeout)
+            if not data:
+                break
+            length -= len(data)
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+
+
+async def handle(
+    reader: asyncio.StreamReader, 
+    writer: asyncio.StreamWriter, 
+    batcher: MicroBatcher, 
+    decode_slots: asyncio.Semaphore, 
+    max_body_bytes: int
+) -> None:
+
+    unread = 0  # Body bytes that are not read
+
+    try:
+        method, path, length = await read_head(reader)
+        unread = length
+
+        if method == "GET" and path == "/stats":
+            write_response(writer, 200, batcher.stats())
+
+        elif method == "POST" and path == "/caption":
+            loop = asyncio.get_running_loop()
+
+            if length > max_body_bytes:
+                write_response(writer, 413, {"error": "Audio larger than {} bytes".format(max_body_bytes)})
+                return
+
+            # Reject before reading the body if it could not be queued
+            if decode_slots.locked() or batcher.queue.full():
+                batcher.requests_num += 1
+                batcher.rejected_num += 1
+                write_response(writer, 503, {"error": "Server busy, retry later"})
+                return
+
+            # Bound the bodies that are read and decoded at once
+            async with decode_slots:
+                body = await reader.readexactly(length)
+                unread = 0
+
+                try:
+                    waveform = await loop.run_in_executor(None, decode_audio, body, batcher.session)
+                except Exception as e:
+                    write_response(writer, 400, {"error": "Can not decode audio: {}".format(e)})
+                    return
+
+                # Only the decoded waveform is kept while queued
+                del body
+
+            try:
+                future = batcher.submit(waveform)
+            except asyncio.QueueFull:
+                write_response(writer, 503, {"error": "Server busy, retry later"})
+                return
+
+            try:
+                caption = await future
+                write_response(writer, 200, {"caption": caption})
+            except Exception as e:
+                write_response(writer, 500, {"error": str(e)})
+
+        else:
+            write_response(writer, 404, {"error": "Use POST /caption or GET /stats"})
+
+    except asyncio.LimitOverrunError:
+        write_response(writer, 431, {"error": "Request head too large"})
+
+    except (asyncio.IncompleteReadError, ValueError):
+        write_response(writer, 400, {"error": "Bad request"})
+
+    except ConnectionError:
+        pass
+
+    finally:
+        try:
+            await writer.drain()
+            # Early rejections close the connection after the response
+            if unread > 0:
+                await discard_body(reader, unread)
+        except ConnectionError:
+            pass
+        writer.close()
+
+
+async def serve(args):
+
+    session = get_session(device=args.device)
+    session.warmup()
+
+    batcher = MicroBatcher(
+        session=session, 
+        max_batch_size=args.max_batch_size, 
+        max_wait_ms=args.max_wait_ms, 
+        max_queue_size=args.max_queue_size
+    )
+
+    decode_slots = asyncio.Semaphore(args.max_decodes)
+    max_body_bytes = int(args.max_body_mb * 1024 ** 2)
+
+    async def _handle(reader, writer):
+        await handle(reader, writer, batcher, decode_slots, max_body_bytes)
+
+    if args.unix_socket:
+        server = await asyncio.start_unix_server(_handle, path=args.unix_socket)
+        print("Serving on {}".format(args.unix_socket))
+    else:
+        server = await asyncio.start_server(_handle, host=args.host, port=args.port)
+        print("Serving on http://{}:{}".format(args.host, args.port))
+
+    worker = asyncio.create_task(batcher.run())
+
+    async with server:
+        await server.serve_forever()
+
+    worker.cancel()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", type=str, default=None)
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--max_batch_size", type=int, default=16)
+    parser.add_argument("--max_wait_ms", type=float, default=20.)
+    parser.add_argument("--max_queue_size", type=int, default=64)
+    parser.add_argument("--max_decodes", type=int, default=4, help="Request bodies read and decoded at once")
+    parser.add_argument("--max_body_mb", type=float, default=50., help="Larger requests are rejected with 413")
+    args = parser.parse_args()
+
+    asyncio.run(serve(args))
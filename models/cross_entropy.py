@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import torch
+import torch.nn.functional as F
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    r"""Mean cross entropy of (x @ weight.T) computed chunk by chunk. The
+    gradients are computed together with the loss in forward(), so only the
+    logits of one chunk exist at a time and no logits are saved for backward.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        x: torch.Tensor,
+        weight: torch.Tensor,
+        targets: torch.Tensor,
+        chunk_size: int
+    ) -> torch.Tensor:
+        r"""
+        n: steps_num
+        d: hidden_size
+        v: vocab_size
+
+        Args:
+            x: (n, d)
+            weight: (v, d)
+            targets: (n,)
+            chunk_size: int
+
+        Outputs:
+            loss: ()
+        """
+
+        N = x.shape[0]
+        needs_grad = ctx.needs_input_grad[0] or ctx.needs_input_grad[1]
+
+        loss = torch.zeros((), dtype=torch.float32, device=x.device)
+        grad_x = torch.empty_like(x) if needs_grad else None
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32) if needs_grad else None
+
+        for i in range(0, N, chunk_size):
+
+            x_chunk = x[i : i + chunk_size]  # shape: (c, d)
+            target_chunk = targets[i : i + chunk_size]  # shape: (c,)
+
+            logits = (x_chunk @ weight.T).float()  # shape: (c, v)
+            lse = torch.logsumexp(logits, dim=-1)  # shape: (c,)
+            loss += (lse - logits.gather(1, target_chunk[:, None])[:, 0]).sum()
+
+            if needs_grad:
+                # d(loss) / d(logits) = (softmax - onehot) / n
+                grad_logits = logits.sub_(lse[:, None]).exp_()  # shape: (c, v)
+                grad_logits[torch.arange(len(target_chunk), device=x.device), target_chunk] -= 1.
+                grad_logits /= N
+
+                grad_x[i : i + chunk_size] = grad_logits.to(weight.dtype) @ weight
+                grad_weight.addmm_(grad_logits.T, x_chunk.float())
+
+        if needs_grad:
+            ctx.save_for_backward(grad_x, grad_weight.to(weight.dtype))
+
+        return loss / N
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+
+        grad_x, grad_weight = ctx.saved_tensors
+
+        # The loss is usually not scaled, avoid copies of the weight gradient
+        if not torch.equal(grad_output, torch.ones_like(grad_output)):
+            grad_x = grad_x * grad_output
+            grad_weight = grad_weight * grad_output
+
+        return grad_x, grad_weight, None, None
+
+
+def chunked_cross_entropy(
+    latent: torch.Tensor,
+    weight: torch.Tensor,
+    targets: torch.Tensor,
+    ignore_index: int,
+    chunk_size: int = 1024
+) -> torch.Tensor:
+    r"""The same as F.cross_entropy(F.linear(latent, weight), targets,
+    ignore_index=ignore_index) without materializing the logits of all steps.
+    Steps of ignore_index are dropped before the projection and the rest are
+    projected and reduced chunk_size steps at a time.
+
+    Args:
+        latent: (..., d), e.g., text latents of Llama.forward(return_latent=True)
+        weight: (v, d), e.g., text_head.weight
+        targets: (...,)
+        ignore_index: int, e.g., pad_token_id
+        chunk_size: int, steps per chunk, trades peak memory for speed
+
+    Outputs:
+        loss: ()
+    """
+
+    latent = latent.flatten(0, -2)  # shape: (n, d)
+    targets = targets.flatten()  # shape: (n,)
+
+    valid = targets != ignore_index
+    latent = latent[valid]
+    targets = targets[valid]
+
+    if latent.shape[0] == 0:
+        # Same as F.cross_entropy() without valid targets
+        return F.cross_entropy(latent @ weight.T, targets)
+
+    return ChunkedCrossEntropy.apply(latent, weight, targets, chunk_size)
@@ -1,14 +1,16 @@
 """
 Modified from https://github.com/Lightning-AI/lit-llama/blob/main/lit_llama/model.py
 """
+from __future__ import annotations
+
 import math
 from dataclasses import dataclass
-from typing import List, Optional, Tuple, Union
+from typing import Iterator, List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from models.rope import build_rope, apply_rope
+from models.rope import build_rope, apply_rope_fast
 
 
 @dataclass
@@ -52,13 +54,18 @@ class Llama(nn.Module):
         self.audio_head = nn.Linear(config.n_embd, config.audio_latent_dim, bias=False)
         self.text_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
 
-        # Build RoPE cache
+        # Build RoPE cache, the cos and sin of each (x_{2i}, x_{2i+1}) pair of the heads
         rope = build_rope(
             seq_len=config.block_size,
             head_dim=config.n_embd // config.n_head,
         )  # shape: (t, head_dim/2, 2)
         self.register_buffer(name="rope", tensor=rope)
 
+        # Causal mask of the longest sequence, sliced in forward(). It is not 
+        # saved to checkpoints
+        causal_mask = build_causal_mask(seq_len=config.block_size)  # shape: (1, 1, t, t)
+        self.register_buffer(name="causal_mask", tensor=causal_mask, persistent=False)
+
     def _init_weights(self, module: nn.Module) -> None:
         if isinstance(module, nn.Linear):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02 / math.sqrt(2 * config.n_layer))
@@ -70,7 +77,13 @@ class Llama(nn.Module):
         seqs: list[torch.Tensor],
         seq_types: list[str],
         mask: None | torch.Tensor = None,
-    ) -> list[torch.Tensor]:
+        kv_caches: None | list[KVCache] = None,
+        input_pos: None | torch.Tensor = None,
+        key_padding_mask: None | torch.Tensor = None,
+        compute_heads: None | list[bool] = None,
+        last_only: bool = False,
+        return_latent: bool = False,
+    ) -> list[None | torch.Tensor]:
         r"""Next token prediction with Llama.
 
         b: batch_size
@@ -81,10 +94,27 @@ class Llama(nn.Module):
         Args:
             seqs: list of input audio embeddings or text ids
             seq_types: list of types, e.g., ["audio", "text"]
-            mask: None | (1, 1, t, t), attention masks
+            mask: None | (1, 1, t, t) | (b, 1, t, t), attention masks, e.g., 
+                build_packed_mask() of packed rows. With kv_caches the shape 
+                is (1, 1, t, t_max). Default to causal masks
+            kv_caches: None | list of KVCache, one per block, see init_kv_caches()
+            input_pos: None | (t,) | (b, t), absolute positions of seqs. 
+                Default to 0, 1, ..., t-1. Per row (b, t) positions are only 
+                supported without kv_caches
+            key_padding_mask: None | (b, t), True for valid steps and False for 
+                padded steps, see build_key_padding_mask(). With kv_caches the 
+                shape is (b, t_max). Padded keys are not attended to
+            compute_heads: None | list of bool, whether to run the output head 
+                of each seq. Default to all True. E.g., [False, True] skips 
+                audio_head in training
+            last_only: bool, only output the last step of the last seq, e.g., 
+                next token logits for decoding. Other seqs output None
+            return_latent: bool, output the latents after ln_f instead of 
+                running the output heads, e.g., for chunked_cross_entropy()
 
         Outputs:
-            output_seqs: list of input audio embeddings or text ids
+            output_seqs: list of output audio latents or text logits, None for 
+                seqs without computed heads
         """
 
         # Transform and concatenate audio embeddings and text IDs into latent
@@ -95,20 +125,66 @@ class Llama(nn.Module):
 
         assert T <= self.config.block_size, "Can not forward sequence of {T} > {self.config.block_size}"
 
-        if mask is None:
-            mask = build_causal_mask(seq_len=T).to(device)
+        if kv_caches is None:
+            if input_pos is None:
+                rope = self.rope[0 : T]  # shape: (t, head_dim/2, 2)
+            else:
+                rope = self.rope[input_pos]  # shape: (t, head_dim/2, 2) | (b, t, head_dim/2, 2)
+
+            # Without masks, attention uses the is_causal fast path of SDPA
+            if key_padding_mask is not None:
+                if mask is None:
+                    mask = self.causal_mask[:, :, 0 : T, 0 : T]  # shape: (1, 1, t, t)
+                mask = merge_key_padding_mask(mask=mask, key_padding_mask=key_padding_mask)
+
+        else:
+            if input_pos is None:
+                input_pos = torch.arange(T, device=device)
+
+            # RoPE at the absolute positions of the new steps
+            rope = self.rope[input_pos]  # shape: (t, head_dim/2, 2)
+
+            if mask is None:
+                max_seq_len = kv_caches[0].max_seq_len
+                mask = self.causal_mask[:, :, input_pos, 0 : max_seq_len]  # shape: (1, 1, t, t_max)
+
+            if key_padding_mask is not None:
+                mask = merge_key_padding_mask(
+                    mask=mask, 
+                    key_padding_mask=key_padding_mask, 
+                    query_padding_mask=key_padding_mask[:, input_pos]
+                )
 
         # Transformer
-        for block in self.blocks:
-            x = block(x, self.rope, mask)
+        for n, block in enumerate(self.blocks):
+            kv_cache = kv_caches[n] if kv_caches is not None else None
+            x = block(x, rope, mask, kv_cache, input_pos)
         # x: (b, t, d)
 
+        seq_lens = [seq.shape[1] for seq in seqs]
+
+        if compute_heads is None:
+            compute_heads = [True] * len(seqs)
+
+        if last_only:
+            x = x[:, -1 :, :]  # shape: (b, 1, d)
+            seq_lens = [0] * (len(seqs) - 1) + [1]
+            compute_heads = [False] * (len(seqs) - 1) + [True]
+
         # Output layers
         x = self.ln_f(x)  # shape: (b, t, d)
 
+        if return_latent:
+            latents = x.split(seq_lens, dim=1)
+            return [latent if compute_head else None for latent, compute_head in zip(latents, compute_heads)]
+
         # Split and transform latent into audio latents and text IDs.
-        seq_lens = [seq.shape[1] for seq in seqs]
-        output_seqs = self.latent_to_seqs(latent=x, seq_lens=seq_lens, seq_types=seq_types)
+        output_seqs = self.latent_to_seqs(
+            latent=x, 
+            seq_lens=seq_lens, 
+            seq_types=seq_types, 
+            compute_heads=compute_heads
+        )
 
         return output_seqs
 
@@ -142,20 +218,28 @@ class Llama(nn.Module):
         self, 
         latent: torch.Tensor, 
         seq_lens: list[int], 
-        seq_types: list[str]
-    ) -> list[torch.Tensor]:
-        r"""Split and transform latent into audio latents and text IDs.
+        seq_types: list[str],
+        compute_heads: None | list[bool] = None
+    ) -> list[None | torch.Tensor]:
+        r"""Split and transform latent into audio latents and text IDs. Seqs 
+        whose compute_heads is False are None.
         """
 
+        if compute_heads is None:
+            compute_heads = [True] * len(seq_lens)
+
         seqs = []
         start_idx = 0
 
-        for seq_len, seq_type in zip(seq_lens, seq_types):
+        for seq_len, seq_type, compute_head in zip(seq_lens, seq_types, compute_heads):
 
             x = latent[:, start_idx : start_idx + seq_len, :]
             start_idx += seq_len
 
-            if seq_type == "audio":
+            if not compute_head:
+                x = None
+
+            elif seq_type == "audio":
                 x = self.audio_head(x)  # shape: (b, t_audio, d)
             
             elif seq_type == "text":
@@ -168,6 +252,45 @@ class Llama(nn.Module):
 
         return seqs
 
+    def init_kv_caches(
+        self, 
+        batch_size: int, 
+        max_seq_len: None | int = None, 
+        device: None | torch.device = None, 
+        dtype: None | torch.dtype = None
+    ) -> list[KVCache]:
+        r"""Preallocate one key/value cache per block.
+
+        Args:
+            batch_size: int
+            max_seq_len: None | int, default to config.block_size
+            device: None | torch.device, default to the device of the model
+            dtype: None | torch.dtype, default to the dtype of the model
+
+        Returns:
+            kv_caches: list of KVCache
+        """
+
+        if max_seq_len is None:
+            max_seq_len = self.config.block_size
+
+        assert max_seq_len <= self.config.block_size
+
+        weight = self.wte.weight
+        device = device if device is not None else weight.device
+        dtype = dtype if dtype is not None else weight.dtype
+
+        return [
+            KVCache.empty(
+                batch_size=batch_size,
+                n_head=self.config.n_head,
+                max_seq_len=max_seq_len,
+                head_dim=self.config.n_embd // self.config.n_head,
+                device=device,
+                dtype=dtype
+            ) for _ in self.blocks
+        ]
+
     @torch.no_grad()
     def generate(
         self, 
@@ -175,10 +298,20 @@ class Llama(nn.Module):
         seq_types: list[str],
         max_new_tokens: int, 
         temperature: float = 1.0, 
-        top_k: None | int = None
+        top_k: None | int = None,
+        use_cache: bool = True,
+        eos_token_id: None | int = None
     ):
         r"""Next token sampling with auto-regression. Make sure to use model.eval()
 
+        With use_cache=True the prompt is forwarded once (prefill) and every
+        following step only forwards the newly sampled token (decode).
+
+        With eos_token_id, a row is finished once it samples eos_token_id. 
+        Finished rows are removed from the batch and the loop stops once all 
+        rows are finished. Positions after eos_token_id are filled with 
+        eos_token_id.
+
         b: batch_size
         t: time_steps
         v: vocab_size
@@ -189,39 +322,427 @@ class Llama(nn.Module):
             max_new_tokens: int
             temperature: float
             top_k: None | int
+            use_cache: bool, use key/value caches
+            eos_token_id: None | int, e.g., 102 ([SEP])
 
         Returns:
             seqs: list of input audio embeddings or text ids
         """
 
+        if not use_cache:
+            return self._generate_without_cache(
+                seqs=seqs, 
+                seq_types=seq_types, 
+                max_new_tokens=max_new_tokens, 
+                temperature=temperature, 
+                top_k=top_k,
+                eos_token_id=eos_token_id
+            )
+
+        new_ids = list(self.generate_stream(
+            seqs=seqs, 
+            seq_types=seq_types, 
+            max_new_tokens=max_new_tokens, 
+            temperature=temperature, 
+            top_k=top_k, 
+            eos_token_id=eos_token_id
+        ))
+
+        # Append the sampled tokens to the last seq
+        seqs[-1] = torch.cat([seqs[-1]] + new_ids, dim=1)  # shape: (b, t)
+
+        return seqs
+
+    @torch.no_grad()
+    def generate_stream(
+        self, 
+        seqs: list[torch.Tensor],
+        seq_types: list[str],
+        max_new_tokens: int, 
+        temperature: float = 1.0, 
+        top_k: None | int = None,
+        eos_token_id: None | int = None
+    ) -> Iterator[torch.Tensor]:
+        r"""Same as generate() with key/value caches, but yield the tokens of 
+        each step as soon as they are sampled. seqs are not modified.
+
+        Args:
+            seqs: list of input audio embeddings or text ids
+            seq_types: list of types, e.g., ["audio", "text"]
+            max_new_tokens: int
+            temperature: float
+            top_k: None | int
+            eos_token_id: None | int, e.g., 102 ([SEP])
+
+        Yields:
+            next_token: (b, 1), finished rows are filled with eos_token_id
+        """
+
+        B = seqs[0].shape[0]
+        device = seqs[0].device
+        prompt_len = sum(seq.shape[1] for seq in seqs)
+        max_seq_len = prompt_len + max(max_new_tokens - 1, 0)  # The last token is not forwarded
+
+        assert max_seq_len <= self.config.block_size, \
+            "Can not generate sequence of {} > {}".format(max_seq_len, self.config.block_size)
+
+        kv_caches = self.init_kv_caches(batch_size=B, max_seq_len=max_seq_len)
+        fill_value = eos_token_id if eos_token_id is not None else 0
+
+        # Indexes of the unfinished rows in the batch
+        active = torch.arange(B, device=device)
+
+        # Prefill
+        input_pos = torch.arange(prompt_len, device=device)
+        outputs = self(
+            seqs=seqs, 
+            seq_types=seq_types, 
+            kv_caches=kv_caches, 
+            input_pos=input_pos, 
+            last_only=True
+        )
+
+        for n in range(max_new_tokens):
+
+            # Take the final step logits
+            logits = outputs[-1][:, -1, :]  # shape: (b_active, v)
+
+            # Sample the next token
+            next_token = sample_next_token(logits=logits, temperature=temperature, top_k=top_k)
+            # shape: (b_active, 1)
+
+            if len(active) == B:
+                yield next_token
+            else:
+                step_ids = torch.full((B, 1), fill_value=fill_value, dtype=torch.long, device=device)
+                step_ids[active] = next_token
+                yield step_ids
+
+            if n == max_new_tokens - 1:
+                break
+
+            # Remove finished rows from the batch
+            if eos_token_id is not None:
+                unfinished = next_token[:, 0] != eos_token_id  # shape: (b_active,)
+
+                if not unfinished.all():
+
+                    if not unfinished.any():
+                        break
+
+                    keep = torch.nonzero(unfinished)[:, 0]
+                    active = active[keep]
+                    next_token = next_token[keep]
+
+                    for kv_cache in kv_caches:
+                        kv_cache.index_select_(keep)
+
+            # Decode one step
+            input_pos = torch.tensor([prompt_len + n], device=device)
+            outputs = self(
+                seqs=[next_token], 
+                seq_types=["text"], 
+                kv_caches=kv_caches, 
+                input_pos=input_pos, 
+                last_only=True
+            )
+
+    @torch.no_grad()
+    def beam_search(
+        self, 
+        seqs: list[torch.Tensor],
+        seq_types: list[str],
+        max_new_tokens: int, 
+        beam_size: int,
+        eos_token_id: None | int = None,
+        length_penalty: float = 1.0
+    ):
+        r"""Beam search decoding. Make sure to use model.eval()
+
+        All beams are decoded as one batch of b*k rows. The prompt is 
+        forwarded once per row and its key/value caches are copied to the 
+        beams, after each step the caches are reordered to follow the 
+        surviving beams. Beams are ranked by log probability divided by 
+        length ** length_penalty. Finished beams only extend with 
+        eos_token_id at no cost and the search stops once all beams are 
+        finished.
+
+        b: batch_size
+        k: beam_size
+        t: time_steps
+        v: vocab_size
+
+        Args:
+            seqs: list of input audio embeddings or text ids
+            seq_types: list of types, e.g., ["audio", "text"]
+            max_new_tokens: int
+            beam_size: int
+            eos_token_id: None | int, e.g., 102 ([SEP])
+            length_penalty: float, 0 for no length normalisation
+
+        Returns:
+            seqs: list of input audio embeddings or text ids, the last seq is 
+                extended with the best beam of each row
+        """
+
+        B = seqs[0].shape[0]
+        K = beam_size
+        device = seqs[0].device
+        prompt_len = sum(seq.shape[1] for seq in seqs)
+        max_seq_len = prompt_len + max(max_new_tokens - 1, 0)  # The last token is not forwarded
+
+        assert max_seq_len <= self.config.block_size, \
+            "Can not generate sequence of {} > {}".format(max_seq_len, self.config.block_size)
+
+        kv_caches = self.init_kv_caches(batch_size=B, max_seq_len=max_seq_len)
+
+        # Prefill
+        input_pos = torch.arange(prompt_len, device=device)
+        outputs = self(
+            seqs=seqs, 
+            seq_types=seq_types, 
+            kv_caches=kv_caches, 
+            input_pos=input_pos, 
+            last_only=True
+        )
+
+        # Copy each row to its beams
+        beam_index = torch.arange(B, device=device).repeat_interleave(K)  # shape: (b*k,)
+        logits = outputs[-1][:, -1, :].index_select(dim=0, index=beam_index)  # shape: (b*k, v)
+
+        for kv_cache in kv_caches:
+            kv_cache.index_select_(beam_index)
+
+        # Only the first beam of each row is alive before the first step
+        scores = torch.full((B, K), fill_value=-float("Inf"), device=device)
+        scores[:, 0] = 0.
+        scores = scores.flatten()  # shape: (b*k,)
+        
+        lengths = torch.zeros(B * K, dtype=torch.long, device=device)
+        finished = torch.zeros(B * K, dtype=torch.bool, device=device)
+        fill_value = eos_token_id if eos_token_id is not None else 0
+        new_ids = torch.full((B * K, max_new_tokens), fill_value=fill_value, dtype=torch.long, device=device)
+        num_new_tokens = 0
+        row_offsets = torch.arange(B, device=device)[:, None] * K  # shape: (b, 1)
+
+        for n in range(max_new_tokens):
+
+            log_probs = F.log_softmax(logits.float(), dim=-1)  # shape: (b*k, v)
+            V = log_probs.shape[-1]
+
+            # Finished beams can only be extended with eos_token_id at no cost
+            if eos_token_id is not None:
+                log_probs[finished] = -float("Inf")
+                log_probs[finished, eos_token_id] = 0.
+
+            cand_scores = scores[:, None] + log_probs  # shape: (b*k, v)
+            cand_lengths = lengths + (~finished).long()  # shape: (b*k,)
+            cand_norm_scores = cand_scores / cand_lengths[:, None].float() ** length_penalty
+
+            # Select the top k candidates of each row over all its beams
+            _, flat_idxes = cand_norm_scores.view(B, K * V).topk(K, dim=-1)  # shape: (b, k)
+            parents = torch.div(flat_idxes, V, rounding_mode="floor")  # shape: (b, k)
+            tokens = (flat_idxes % V).flatten()  # shape: (b*k,)
+            index = (row_offsets + parents).flatten()  # shape: (b*k,)
+
+            scores = cand_scores.view(B, K * V).gather(dim=1, index=flat_idxes).flatten()
+            lengths = cand_lengths[index]
+            new_ids = new_ids[index]
+            new_ids[:, n] = tokens
+            num_new_tokens = n + 1
+
+            if eos_token_id is not None:
+                finished = finished[index] | (tokens == eos_token_id)
+
+            if n == max_new_tokens - 1 or finished.all():
+                break
+
+            # Reorder caches to follow the selected beams, then decode one step
+            for kv_cache in kv_caches:
+                kv_cache.index_select_(index)
+
+            input_pos = torch.tensor([prompt_len + n], device=device)
+            outputs = self(
+                seqs=[tokens[:, None]], 
+                seq_types=["text"], 
+                kv_caches=kv_caches, 
+                input_pos=input_pos, 
+                last_only=True
+            )
+            logits = outputs[-1][:, -1, :]  # shape: (b*k, v)
+
+        # Best beam of each row
+        norm_scores = scores / lengths.clamp(min=1).float() ** length_penalty
+        best = norm_scores.view(B, K).argmax(dim=-1)  # shape: (b,)
+        best_ids = new_ids.view(B, K, -1)[torch.arange(B, device=device), best]  # shape: (b, t_new)
+
+        # Append the best beams to the last seq
+        seqs[-1] = torch.cat((seqs[-1], best_ids[:, 0 : num_new_tokens]), dim=1)  # shape: (b, t)
+
+        return seqs
+
+    @torch.no_grad()
+    def _generate_without_cache(
+        self, 
+        seqs: list[torch.Tensor],
+        seq_types: list[str],
+        max_new_tokens: int, 
+        temperature: float = 1.0, 
+        top_k: None | int = None,
+        eos_token_id: None | int = None
+    ):
+        r"""Next token sampling by forwarding the full sequence at every step."""
+
+        B = seqs[0].shape[0]
+        finished = torch.zeros(B, dtype=torch.bool, device=seqs[0].device)
+
         for _ in range(max_new_tokens):
 
             # Forward
-            outputs = self(seqs=seqs, seq_types=seq_types)
+            outputs = self(seqs=seqs, seq_types=seq_types, last_only=True)
 
             # Text logits
             logits = outputs[-1]
 
             # Take the final step logits
-            logits = logits[:, -1, :] / temperature  # shape: (b, v)
-
-            # Crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-
-            # Convert logits to probabilities
-            probs = F.softmax(logits, dim=-1)  # shape: (b, v)
+            logits = logits[:, -1, :]  # shape: (b, v)
 
             # Sample the next token
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (b, 1)
+            next_token = sample_next_token(logits=logits, temperature=temperature, top_k=top_k)
+            # shape: (b, 1)
+
+            if eos_token_id is not None:
+                next_token[finished] = eos_token_id
+                finished |= next_token[:, 0] == eos_token_id
 
             # Append the sampled token to the last seq
             seqs[-1] = torch.cat((seqs[-1], next_token), dim=1)  # shape: (b, t)
 
+            if finished.all():
+                break
+
         return  seqs
 
 
+def logits_to_probs(
+    logits: torch.Tensor, 
+    temperature: float = 1.0, 
+    top_k: None | int = None
+) -> torch.Tensor:
+    r"""Sampling probabilities of logits after temperature and top-k.
+
+    Args:
+        logits: (..., v)
+        temperature: float
+        top_k: None | int
+
+    Outputs:
+        probs: (..., v)
+    """
+
+    logits = logits / temperature  # shape: (..., v)
+
+    # Crop the logits to only the top k options
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits[logits < v[..., [-1]]] = -float('Inf')
+
+    # Convert logits to probabilities
+    probs = F.softmax(logits, dim=-1)  # shape: (..., v)
+
+    return probs
+
+
+def sample_next_token(
+    logits: torch.Tensor, 
+    temperature: float = 1.0, 
+    top_k: None | int = None
+) -> torch.Tensor:
+    r"""Sample next tokens from the final step logits.
+
+    Args:
+        logits: (b, v)
+        temperature: float
+        top_k: None | int
+
+    Outputs:
+        next_token: (b, 1)
+    """
+
+    probs = logits_to_probs(logits=logits, temperature=temperature, top_k=top_k)  # shape: (b, v)
+
+    # Sample the next token
+    next_token = torch.multinomial(probs, num_samples=1)  # shape: (b, 1)
+
+    return next_token
+
+
+class KVCache:
+    r"""Preallocated key and value buffers of one attention layer.
+
+    The buffers are written at absolute positions, so a sequence can be 
+    forwarded in several calls with increasing input_pos.
+    """
+
+    def __init__(self, k: torch.Tensor, v: torch.Tensor) -> None:
+        r"""
+        Args:
+            k: (b, h, t_max, head_dim)
+            v: (b, h, t_max, head_dim)
+        """
+        self.k = k
+        self.v = v
+
+    @classmethod
+    def empty(
+        cls, 
+        batch_size: int, 
+        n_head: int, 
+        max_seq_len: int, 
+        head_dim: int, 
+        device: torch.device, 
+        dtype: torch.dtype
+    ) -> KVCache:
+        shape = (batch_size, n_head, max_seq_len, head_dim)
+        k = torch.zeros(shape, device=device, dtype=dtype)
+        v = torch.zeros(shape, device=device, dtype=dtype)
+        return cls(k=k, v=v)
+
+    @property
+    def max_seq_len(self) -> int:
+        return self.k.shape[2]
+
+    def update(
+        self, 
+        input_pos: torch.Tensor, 
+        k: torch.Tensor, 
+        v: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        r"""Write new keys and values at input_pos.
+
+        Args:
+            input_pos: (t,)
+            k: (b, h, t, head_dim)
+            v: (b, h, t, head_dim)
+
+        Outputs:
+            k: (b, h, t_max, head_dim)
+            v: (b, h, t_max, head_dim)
+        """
+        self.k[:, :, input_pos] = k
+        self.v[:, :, input_pos] = v
+        return self.k, self.v
+
+    def index_select_(self, index: torch.Tensor) -> None:
+        r"""Keep or reorder rows of the batch in place.
+
+        Args:
+            index: (b_new,)
+        """
+        self.k = self.k.index_select(dim=0, index=index)
+        self.v = self.v.index_select(dim=0, index=index)
+
+
 class Block(nn.Module):
     def __init__(self, config: LlamaConfig) -> None:
         super().__init__()
@@ -234,19 +755,23 @@ class Block(nn.Module):
         self,
         x: torch.Tensor,
         rope: torch.Tensor,
-        mask: torch.Tensor,
+        mask: None | torch.Tensor,
+        kv_cache: None | KVCache = None,
+        input_pos: None | torch.Tensor = None,
     ) -> torch.Tensor:
         r"""
 
         Args:
             x: (b, t, d)
-            rope: (t, head_dim/2)
-            mask: (1, 1, t, t)
+            rope: (t, head_dim/2, 2) | (b, t, head_dim/2, 2)
+            mask: None | (1, 1, t, t) | (b, 1, t, t), None for causal masks
+            kv_cache: None | KVCache
+            input_pos: None | (t,)
 
         Outputs:
             x: (b, t, d)
         """
-        x = x + self.att(self.att_norm(x), rope, mask)
+        x = x + self.att(self.att_norm(x), rope, mask, kv_cache, input_pos)
         x = x + self.mlp(self.ffn_norm(x))
         return x
 
@@ -296,10 +821,9 @@ class CausalSelfAttention(nn.Module):
         self,
         x: torch.Tensor,
         rope: torch.Tensor,
-        mask: torch.Tensor,
-        # max_seq_length: int,
-        # input_pos: Optional[torch.Tensor] = None,
-        # kv_cache: Optional[KVCache] = None,
+        mask: None | torch.Tensor,
+        kv_cache: None | KVCache = None,
+        input_pos: None | torch.Tensor = None,
     ) -> torch.Tensor:
         r"""Causal self attention.
 
@@ -310,8 +834,12 @@ class CausalSelfAttention(nn.Module):
 
         Args:
             x: (b, t, d)
-            rope: (t, head_dim/2, 2)
-            mask: (1, 1, )
+            rope: (t, head_dim/2, 2) | (b, t, head_dim/2, 2)
+            mask: None | (1, 1, t, t) | (1, 1, t, t_max) with kv_cache, the 
+                first dim can be b with key padding. None for causal masks 
+                without kv_cache
+            kv_cache: None | KVCache, keys and values of previous steps
+            input_pos: None | (t,), absolute positions of x, required with kv_cache
 
         Outputs:
             x: (b, t, d)
@@ -328,8 +856,8 @@ class CausalSelfAttention(nn.Module):
         v = v.view(B, T, self.n_head, D // self.n_head)
         # q, k, v shapes: (b, t, h, d/h)
 
-        q = apply_rope(q, rope)
-        k = apply_rope(k, rope)
+        q = apply_rope_fast(q, rope)
+        k = apply_rope_fast(k, rope)
         # q, k shapes: (b, t, h, d/h)
 
         k = k.transpose(1, 2)
@@ -337,13 +865,18 @@ class CausalSelfAttention(nn.Module):
         v = v.transpose(1, 2)
         # q, k, v shapes: (b, h, t, d/h)
 
+        if kv_cache is not None:
+            k, v = kv_cache.update(input_pos=input_pos, k=k, v=v)
+            # k, v shapes: (b, h, t_max, d/h)
+
         # Efficient attention using Flash Attention CUDA kernels
         x = F.scaled_dot_product_attention(
             query=q, 
             key=k, 
             value=v, 
             attn_mask=mask, 
-            dropout_p=0.0
+            dropout_p=0.0,
+            is_causal=mask is None
         )
         # shape: (b, h, t, d/h)
 
@@ -385,4 +918,88 @@ def build_causal_mask(seq_len: int) -> torch.Tensor:
     r"""Build causal mask."""
     ones = torch.ones((seq_len, seq_len), dtype=torch.bool)  # shape: (t, t)
     mask = torch.tril(ones)[None, None, :, :]  # shape: (1, 1, t, t)
-    return mask
\ No newline at end of file
+    return mask
+
+
+def build_key_padding_mask(
+    seqs: list[torch.Tensor], 
+    seq_types: list[str], 
+    pad_token_id: int
+) -> torch.Tensor:
+    r"""Build the key padding mask of concatenated seqs. Audio steps are always 
+    valid and text steps are valid if they are not pad_token_id.
+
+    Args:
+        seqs: list of input audio embeddings or text ids
+        seq_types: list of types, e.g., ["audio", "text"]
+        pad_token_id: int
+
+    Outputs:
+        key_padding_mask: (b, t), True for valid steps
+    """
+
+    masks = []
+
+    for seq, seq_type in zip(seqs, seq_types):
+
+        if seq_type == "audio":
+            masks.append(torch.ones(seq.shape[0 : 2], dtype=torch.bool, device=seq.device))
+
+        elif seq_type == "text":
+            masks.append(seq != pad_token_id)
+
+        else:
+            raise ValueError(seq_type)
+
+    key_padding_mask = torch.cat(masks, dim=1)  # shape: (b, t)
+
+    return key_padding_mask
+
+
+def merge_key_padding_mask(
+    mask: torch.Tensor, 
+    key_padding_mask: torch.Tensor, 
+    query_padding_mask: None | torch.Tensor = None
+) -> torch.Tensor:
+    r"""Remove padded keys from attention masks. Padded queries keep their 
+    original masks, so that no row is fully masked (which makes SDPA output 
+    NaN). Outputs of padded queries should be ignored.
+
+    Args:
+        mask: (1, 1, t, t_k)
+        key_padding_mask: (b, t_k), True for valid keys
+        query_padding_mask: None | (b, t), True for valid queries. Default to 
+            key_padding_mask, i.e., queries and keys are the same steps
+
+    Outputs:
+        mask: (b, 1, t, t_k)
+    """
+
+    if query_padding_mask is None:
+        query_padding_mask = key_padding_mask
+
+    valid = key_padding_mask[:, None, None, :] | ~query_padding_mask[:, None, :, None]
+    # shape: (b, 1, t, t_k)
+
+    return mask & valid
+
+
+def build_packed_mask(segment_ids: torch.Tensor, input_pos: torch.Tensor) -> torch.Tensor:
+    r"""Build the block-diagonal causal mask of packed rows. A step attends to 
+    the steps of the same segment at earlier or equal positions, i.e., the 
+    causal mask of each segment forwarded alone. Padded steps share segment -1 
+    and position 0 so that they only attend to each other.
+
+    Args:
+        segment_ids: (b, t), segment index of each step, -1 for padded steps
+        input_pos: (b, t), position of each step in its segment
+
+    Outputs:
+        mask: (b, 1, t, t)
+    """
+
+    same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]  # shape: (b, t, t)
+    causal = input_pos[:, :, None] >= input_pos[:, None, :]  # shape: (b, t, t)
+    mask = (same_segment & causal)[:, None, :, :]  # shape: (b, 1, t, t)
+
+    return mask
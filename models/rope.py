@@ -48,4 +48,100 @@ def apply_rope(x: torch.Tensor, rope_cache: torch.Tensor) -> torch.Tensor:
     )
 
     x_out2 = x_out2.flatten(3)
-    return x_out2.type_as(x)
\ No newline at end of file
+    return x_out2.type_as(x)
+
+
+def apply_rope_cos_sin(x: torch.Tensor, rope: torch.Tensor, offset: int = 0) -> torch.Tensor:
+    r"""Rotate x with the precomputed cos and sin of rope, in the dtype of x.
+    The (x_{2i}, x_{2i+1}) pairs of the heads are strided views of x, rotated
+    with one multiply and one addcmul each and written into the pair slots of
+    the output. Only real ops are used, so the ONNX export of the decoder,
+    which has no complex tensors, uses this path. It is not faster than
+    apply_rope_complex(), see benchmarks/rope.py.
+
+    Args:
+        x: (b, t, h, head_dim)
+        rope: (t_max, head_dim/2, 2), sliced from offset | (t, head_dim/2, 2) |
+            (b, t, head_dim/2, 2), already at the positions of x
+        offset: int, position of the first step of x, e.g., the number of
+            cached steps
+
+    Outputs:
+        x: (b, t, h, head_dim)
+    """
+
+    if rope.ndim == 3:
+        T = x.size(1)
+        rope = rope[None, offset : offset + T]  # shape: (1, t, head_dim/2, 2)
+
+    cos = rope[:, :, None, :, 0]  # shape: (b, t, 1, head_dim/2)
+    sin = rope[:, :, None, :, 1]  # shape: (b, t, 1, head_dim/2)
+
+    x0 = x[..., 0::2]  # shape: (b, t, h, head_dim/2)
+    x1 = x[..., 1::2]  # shape: (b, t, h, head_dim/2)
+
+    out = torch.empty_like(x)
+    out[..., 0::2] = torch.addcmul(x0 * cos, x1, sin, value=-1)
+    out[..., 1::2] = torch.addcmul(x1 * cos, x0, sin)
+
+    return out
+
+
+def apply_rope_complex(x: torch.Tensor, rope: torch.Tensor, offset: int = 0) -> torch.Tensor:
+    r"""Rotate x as complex numbers with one multiply on a complex view of x.
+    x and rope must be float32 or float64, see apply_rope_fast().
+
+    Args:
+        x: (b, t, h, head_dim)
+        rope: (t_max, head_dim/2, 2), sliced from offset | (t, head_dim/2, 2) |
+            (b, t, head_dim/2, 2), already at the positions of x
+        offset: int, position of the first step of x, e.g., the number of
+            cached steps
+
+    Outputs:
+        x: (b, t, h, head_dim)
+    """
+
+    if rope.ndim == 3:
+        T = x.size(1)
+        rope = rope[None, offset : offset + T]  # shape: (1, t, head_dim/2, 2)
+
+    rope = rope[:, :, None, :, :]  # shape: (b, t, 1, head_dim/2, 2)
+    xshaped = x.unflatten(-1, (-1, 2))  # shape: (b, t, h, head_dim/2, 2)
+
+    x_out = torch.view_as_real(
+        torch.view_as_complex(xshaped) * torch.view_as_complex(rope)
+    )  # shape: (b, t, h, head_dim/2, 2)
+
+    return x_out.flatten(3)
+
+
+def apply_rope_fast(x: torch.Tensor, rope: torch.Tensor, offset: int = 0) -> torch.Tensor:
+    r"""Rotate x with apply_rope_complex(), the fastest path on CPU. float16
+    and bfloat16 x are rotated in float32 and cast back, which is still
+    faster than apply_rope() and apply_rope_cos_sin() in their dtype at all
+    sequence lengths. While exporting to ONNX, which has no complex tensors,
+    rotate with apply_rope_cos_sin().
+
+    Args:
+        x: (b, t, h, head_dim)
+        rope: (t_max, head_dim/2, 2) | (t, head_dim/2, 2) | (b, t, head_dim/2, 2)
+        offset: int
+
+    Outputs:
+        x: (b, t, h, head_dim)
+    """
+
+    if torch.onnx.is_in_onnx_export():
+        return apply_rope_cos_sin(x, rope, offset)
+
+    if x.dtype in (torch.float32, torch.float64) and rope.dtype == x.dtype:
+        return apply_rope_complex(x, rope, offset)
+
+    # Only cast the rows of rope at the positions of x
+    if rope.ndim == 3:
+        rope = rope[offset : offset + x.size(1)]
+
+    dtype = torch.float64 if x.dtype == torch.float64 else torch.float32
+
+    return apply_rope_complex(x.to(dtype), rope.to(dtype)).to(x.dtype)
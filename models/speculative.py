@@ -0,0 +1,180 @@
+"""Speculative decoding: a small draft Llama proposes tokens and the target
+Llama verifies them in one forward.
+
+Ref: Leviathan et al., Fast Inference from Transformers via Speculative
+Decoding, 2023. https://arxiv.org/abs/2211.17192
+"""
+from __future__ import annotations
+
+import copy
+
+import torch
+
+from models.llama import Llama, LlamaConfig, logits_to_probs
+
+
+def init_draft_from_target(target: Llama, n_layer: int = 2) -> Llama:
+    r"""Build a draft Llama with the first n_layer blocks of the target. The
+    embeddings, output layers and the kept blocks are copied from the target,
+    so that the draft starts close to it before distillation.
+    """
+
+    config = copy.deepcopy(target.config)
+    config.n_layer = n_layer
+
+    draft = Llama(config=config)
+    draft.load_state_dict(target.state_dict(), strict=False)
+
+    return draft.to(target.wte.weight.device)
+
+
+@torch.no_grad()
+def speculative_generate(
+    target: Llama,
+    draft: Llama,
+    seqs: list[torch.Tensor],
+    seq_types: list[str],
+    max_new_tokens: int,
+    num_draft_tokens: int = 4,
+    temperature: float = 1.0,
+    top_k: None | int = None,
+    eos_token_id: None | int = None
+) -> tuple[list[torch.Tensor], dict]:
+    r"""Same as target.generate(), but the draft proposes num_draft_tokens
+    tokens which the target verifies in one forward. With the acceptance
+    sampling of the reference, the output distribution is the same as
+    sampling from the target (with the same temperature and top-k).
+
+    Stale key/values of rejected tokens stay in the caches. They are at
+    positions after the accepted tokens, so they are masked out and then
+    overwritten by the next forward.
+
+    Args:
+        target: Llama
+        draft: Llama, same vocabulary and audio_latent_dim as the target
+        seqs: list of input audio embeddings or text ids, batch size 1
+        seq_types: list of types, e.g., ["audio", "text"]
+        max_new_tokens: int
+        num_draft_tokens: int, tokens proposed per target forward
+        temperature: float
+        top_k: None | int
+        eos_token_id: None | int, e.g., 102 ([SEP])
+
+    Returns:
+        seqs: list of input and generated seqs
+        stats: dict, number of target forwards and accepted draft tokens
+    """
+
+    assert seqs[0].shape[0] == 1, "Speculative decoding supports batch size 1"
+
+    device = seqs[0].device
+    prompt_len = sum(seq.shape[1] for seq in seqs)
+    max_seq_len = prompt_len + max_new_tokens + num_draft_tokens
+
+    assert max_seq_len <= min(target.config.block_size, draft.config.block_size), \
+        "Can not generate sequence of {} > block_size".format(max_seq_len)
+
+    target_caches = target.init_kv_caches(batch_size=1, max_seq_len=max_seq_len)
+    draft_caches = draft.init_kv_caches(batch_size=1, max_seq_len=max_seq_len)
+    stats = {"target_forwards": 0, "drafted_tokens": 0, "accepted_tokens": 0}
+
+    if max_new_tokens == 0:
+        return seqs, stats
+
+    # Prefill both models and sample the first token from the target
+    input_pos = torch.arange(prompt_len, device=device)
+    target_logits = target(
+        seqs=seqs,
+        seq_types=seq_types,
+        kv_caches=target_caches,
+        input_pos=input_pos,
+        last_only=True
+    )[-1][:, -1, :]  # shape: (1, v)
+    draft(seqs=seqs, seq_types=seq_types, kv_caches=draft_caches, input_pos=input_pos, last_only=True)
+    stats["target_forwards"] += 1
+
+    probs = logits_to_probs(target_logits, temperature=temperature, top_k=top_k)
+    new_ids = [torch.multinomial(probs, num_samples=1)[0, 0].item()]
+
+    # The target caches hold positions [0, n - 1), the last token is not
+    # forwarded yet. The draft caches hold positions [0, draft_len)
+    draft_len = prompt_len
+
+    while len(new_ids) < max_new_tokens and new_ids[-1] != eos_token_id:
+
+        n = prompt_len + len(new_ids)
+
+        # At most max_new_tokens including the token sampled from the target
+        k = min(num_draft_tokens, max_new_tokens - len(new_ids) - 1)
+
+        # Draft k tokens. Forward the tokens the draft has not seen first
+        draft_ids = []
+        draft_probs = []
+        pending = new_ids[draft_len - prompt_len :]  # Tokens at positions [draft_len, n)
+
+        for i in range(k):
+            ids = torch.tensor([pending], dtype=torch.long, device=device)  # shape: (1, t)
+            input_pos = torch.arange(draft_len, draft_len + len(pending), device=device)
+            logits = draft(
+                seqs=[ids],
+                seq_types=["text"],
+                kv_caches=draft_caches,
+                input_pos=input_pos,
+                last_only=True
+            )[-1][0, -1, :]  # shape: (v,)
+            draft_len += len(pending)
+
+            q = logits_to_probs(logits, temperature=temperature, top_k=top_k)  # shape: (v,)
+            token = torch.multinomial(q, num_samples=1).item()
+            draft_ids.append(token)
+            draft_probs.append(q)
+            pending = [token]
+
+        # Verify: the target forwards the last token and the k draft tokens
+        ids = torch.tensor([[new_ids[-1]] + draft_ids], dtype=torch.long, device=device)  # shape: (1, k+1)
+        input_pos = torch.arange(n - 1, n + k, device=device)
+        logits = target(
+            seqs=[ids],
+            seq_types=["text"],
+            kv_caches=target_caches,
+            input_pos=input_pos
+        )[-1][0]  # shape: (k+1, v)
+        stats["target_forwards"] += 1
+        stats["drafted_tokens"] += k
+
+        p = logits_to_probs(logits, temperature=temperature, top_k=top_k)  # shape: (k+1, v)
+
+        # Accept draft token i with probability min(1, p_i / q_i), otherwise
+        # sample from the residual max(0, p_i - q_i) and stop
+        accepted = 0
+
+        for i, token in enumerate(draft_ids):
+            q = draft_probs[i]
+
+            if torch.rand(()).item() * q[token] < p[i, token]:
+                new_ids.append(token)
+                accepted += 1
+
+                if token == eos_token_id:
+                    break
+
+            else:
+                residual = torch.clamp(p[i] - q, min=0.)
+                if residual.sum() <= 0:
+                    residual = p[i]
+                new_ids.append(torch.multinomial(residual, num_samples=1).item())
+                break
+
+        else:
+            # All draft tokens are accepted, sample one more from the target
+            new_ids.append(torch.multinomial(p[k], num_samples=1).item())
+
+        stats["accepted_tokens"] += accepted
+
+        # Draft key/values after the accepted tokens are stale
+        draft_len = min(draft_len, n + accepted)
+
+    new_ids = torch.tensor([new_ids[0 : max_new_tokens]], dtype=torch.long, device=device)
+    seqs[-1] = torch.cat((seqs[-1], new_ids), dim=1)  # shape: (1, t)
+
+    return seqs, stats
@@ -0,0 +1,52 @@
+"""Normalize and tokenize all Clotho captions once into a memory-mapped caption
+index. Set caption_index_dir in train.py to look captions up instead of
+tokenizing them in every DataLoader worker.
+
+Usage:
+    python tokenize_captions.py --clotho_root /datasets/clotho --output_dir ./caption_index
+"""
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+from data.caption_index import build_caption_index
+from data.text_normalization import TextNormalization
+from data.text_tokenization import BertTokenizer
+
+
+CAPTIONS_CSVS = ["clotho_captions_development.csv", "clotho_captions_evaluation.csv"]
+
+
+def tokenize_captions(args):
+
+    captions = []
+
+    for captions_csv in CAPTIONS_CSVS:
+        df = pd.read_csv(Path(args.clotho_root, captions_csv))
+        for n in range(1, 6):
+            captions.extend(df["caption_{}".format(n)].tolist())
+
+    tokenizer = BertTokenizer(max_length=args.max_length).tokenizer
+
+    build_caption_index(
+        root=args.output_dir,
+        captions=captions,
+        tokenizer=tokenizer,
+        normalize=TextNormalization()
+    )
+
+    print("Write the token IDs of {} captions to {}".format(len(set(captions)), args.output_dir))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clotho_root", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, default="./caption_index")
+    parser.add_argument("--max_length", type=int, default=30)
+    args = parser.parse_args()
+
+    tokenize_captions(args)
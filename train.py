@@ -10,7 +10,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from audidata.datasets import Clotho
-from audidata.io.crops import RandomCrop
+from audidata.io.crops import RandomCrop, StartCrop
 from audidata.samplers import InfiniteSampler, PseudoRandomSampler
 from audidata.transforms import Mono
 from panns_inference import AudioTagging
@@ -18,9 +18,15 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 import wandb
 
+from data.bucketing import BucketBatchSampler, TrimCollate, caption_lengths
+from data.caption_index import CaptionIndex
+from data.embedding_cache import EmbeddingCache, encoder_fingerprint
+from data.feature_store import ClothoFeatures
+from data.packing import pack_captions
 from data.text_normalization import TextNormalization
 from data.text_tokenization import BertTokenizer
-from models.llama import Llama, LlamaConfig
+from models.cross_entropy import chunked_cross_entropy
+from models.llama import Llama, LlamaConfig, build_packed_mask
 
 
 def train(args):
@@ -29,17 +35,24 @@ def train(args):
     sr = 32000  # To be consistent with the encoder
     batch_size = 16
     num_workers = 16
-    pin_memory = True
+    pin_memory = torch.cuda.is_available()
     learning_rate = 1e-4
     test_every_n_steps = 200
     save_every_n_steps = 2000
     training_steps = 20000
     wandb_log = True
-    device = "cuda"
+    device = "cuda" if torch.cuda.is_available() else "cpu"
     max_length = 30  # Max caption length
     clip_duration = 10.  # Audio clip duration
     audio_encoder_name = "Cnn14"
     llm_decoder_name = "Llama"
+    embedding_cache_dir = None  # e.g., "./embedding_cache" to reuse CNN14 embeddings in validation
+    feature_store_dir = None  # e.g., "./features" written by extract_features.py, skips CNN14 in training
+    caption_index_dir = None  # e.g., "./caption_index" written by tokenize_captions.py, skips tokenization
+    bucket_batching = False  # Batch captions of similar lengths and trim padded tokens
+    pack_length = None  # e.g., 1024, pack the captions of a step into rows of up to pack_length steps
+    pack_batch_size = 256  # Captions per training step with pack_length, about 48 fit in a row of 1024 steps
+    loss_chunk_size = None  # e.g., 1024, compute text_head and the loss in chunks of steps, skipping padded steps
 
     filename = Path(__file__).stem
     
@@ -54,51 +67,107 @@ def train(args):
     # Audio Cropper
     crop = RandomCrop(clip_duration=clip_duration, end_pad=0.)
 
+    # With an embedding cache, validate on the same clips every time so that 
+    # their embeddings are cached. Otherwise validate on random crops
+    if embedding_cache_dir:
+        eval_crop = StartCrop(start=0., clip_duration=clip_duration)
+    else:
+        eval_crop = crop
+
     # Caption transforms
-    target_transform = [
-        TextNormalization(),  # Remove punctuations
-        BertTokenizer(max_length=max_length)  # Convert captions to token IDs
-    ]
-    pad_token_id = target_transform[1].tokenizer.pad_token_id  # 0
-    text_vocab_size = target_transform[1].tokenizer.vocab_size  # 30,522
+    if caption_index_dir:
+        # Look up pre-tokenized captions
+        caption_index = CaptionIndex(root=caption_index_dir, max_length=max_length)
+        target_transform = [caption_index]
+        pad_token_id = caption_index.pad_token_id  # 0
+        text_vocab_size = caption_index.vocab_size  # 30,522
+
+    else:
+        target_transform = [
+            TextNormalization(),  # Remove punctuations
+            BertTokenizer(max_length=max_length)  # Convert captions to token IDs
+        ]
+        pad_token_id = target_transform[1].tokenizer.pad_token_id  # 0
+        text_vocab_size = target_transform[1].tokenizer.vocab_size  # 30,522
 
     # Datasets
-    train_dataset = Clotho(
-        root=root,
-        split="train",
-        sr=sr,
-        crop=crop,
-        transform=Mono(),
-        target_transform=target_transform
-    )
+    if feature_store_dir:
+        # Precomputed CNN14 embeddings of random crops
+        train_dataset = ClothoFeatures(root=Path(feature_store_dir, "train"), target_transform=target_transform)
+        eval_train_dataset = train_dataset
+        test_dataset = ClothoFeatures(root=Path(feature_store_dir, "test"), target_transform=target_transform)
 
-    test_dataset = Clotho(
-        root=root,
-        split="test",
-        sr=sr,
-        crop=crop,
-        transform=Mono(),
-        target_transform=target_transform
-    )
+    else:
+        train_dataset = Clotho(
+            root=root,
+            split="train",
+            sr=sr,
+            crop=crop,
+            transform=Mono(),
+            target_transform=target_transform
+        )
+
+        if embedding_cache_dir:
+            eval_train_dataset = Clotho(
+                root=root,
+                split="train",
+                sr=sr,
+                crop=eval_crop,
+                transform=Mono(),
+                target_transform=target_transform
+            )
+        else:
+            eval_train_dataset = train_dataset
+
+        test_dataset = Clotho(
+            root=root,
+            split="test",
+            sr=sr,
+            crop=eval_crop,
+            transform=Mono(),
+            target_transform=target_transform
+        )
 
     # Sampler
     train_sampler = InfiniteSampler(train_dataset)
-    eval_train_sampler = PseudoRandomSampler(train_dataset)
+    eval_train_sampler = PseudoRandomSampler(eval_train_dataset)
     eval_test_sampler = PseudoRandomSampler(test_dataset)
+
+    # Packed steps carry many more captions than padded batches
+    train_batch_size = pack_batch_size if pack_length else batch_size
+
+    # Trim batches to their longest captions
+    collate_fn = TrimCollate(pad_token_id=pad_token_id) if bucket_batching else None
     
     # Dataloader
-    train_dataloader = DataLoader(
-        dataset=train_dataset, 
-        batch_size=batch_size, 
-        sampler=train_sampler,
-        num_workers=num_workers, 
-        pin_memory=pin_memory
-    )
+    if bucket_batching:
+        lengths = caption_lengths(
+            captions=train_dataset.meta_dict["caption"], 
+            target_transform=target_transform, 
+            pad_token_id=pad_token_id
+        )
+        train_dataloader = DataLoader(
+            dataset=train_dataset, 
+            batch_sampler=BucketBatchSampler(lengths=lengths, batch_size=train_batch_size),
+            collate_fn=collate_fn,
+            num_workers=num_workers, 
+            pin_memory=pin_memory
+        )
+
+    else:
+        train_dataloader = DataLoader(
+            dataset=train_dataset, 
+            batch_size=train_batch_size, 
+            sampler=train_sampler,
+            num_workers=num_workers, 
+            pin_memory=pin_memory
+        )
 
     eval_train_dataloader = DataLoader(
-        dataset=train_dataset, 
+        dataset=eval_train_dataset, 
         batch_size=batch_size, 
         sampler=eval_train_sampler,
+        collate_fn=collate_fn,
         num_workers=num_workers, 
         pin_memory=pin_memory
     )
@@ -107,13 +176,27 @@ def train(args):
         dataset=test_dataset, 
         batch_size=batch_size, 
         sampler=eval_test_sampler,
+        collate_fn=collate_fn,
         num_workers=num_workers, 
         pin_memory=pin_memory
     )
 
     # Pretrained audio encoder
-    audio_encoder, audio_latent_dim = get_audio_encoder(model_name=audio_encoder_name)
-    audio_encoder.to(device)
+    if feature_store_dir:
+        audio_encoder, audio_latent_dim = None, train_dataset.store.dim
+    else:
+        audio_encoder, audio_latent_dim = get_audio_encoder(model_name=audio_encoder_name)
+        audio_encoder.to(device)
+
+    # Cache of audio embeddings, keyed by the encoder weights
+    if embedding_cache_dir and audio_encoder is not None:
+        embedding_cache = EmbeddingCache(
+            cache_dir=embedding_cache_dir, 
+            encoder_id=encoder_fingerprint(audio_encoder_name, audio_encoder), 
+            sr=sr
+        )
+    else:
+        embedding_cache = None
 
     # LLM decoder
     llm_decoder = get_llm_decoder(
@@ -130,39 +213,83 @@ def train(args):
         wandb.init(project="mini_audio_caption", mode="offline", name="{}".format(model_name))
         # Set to offline mode
 
+    # Compute text_head in the loss
+    text_head = llm_decoder.text_head if loss_chunk_size else None
+
+    # Padded tokens before and after trimming
+    padding = torch.zeros(2, dtype=torch.long)
+
     # Train
     for step, data in enumerate(tqdm(train_dataloader)):
 
+        if "padding" in data:
+            padding += data["padding"]
+
         # Move data to device
-        audio = data["audio"].to(device)  # shape: (b, c, t_audio)
         text_ids = data["target"].to(device)  # shape: (b, t_text)
         
         # Extract audio embeddings
-        audio_latent = get_audio_latent(
-            model_name=audio_encoder_name, 
-            model=audio_encoder, audio=audio
-        )
+        if "audio_latent" in data:
+            audio_latent = data["audio_latent"].to(device)  # shape: (b, t_audio, d)
+        else:
+            audio = data["audio"].to(device)  # shape: (b, c, t_audio)
+            audio_latent = get_audio_latent(
+                model_name=audio_encoder_name, 
+                model=audio_encoder, audio=audio
+            )
         
         # Combine audio embeddings and text ids
-        input_seqs = [audio_latent, text_ids]
         seq_types = ["audio", "text"]
 
         # Forward
         llm_decoder.train()
 
-        output_seqs = llm_decoder(
-            seqs=input_seqs,
-            seq_types=seq_types,
-            mask=None
-        )
-        # list of output, e.g., [(b, t_audio, audio_dim), (b, t_text, vocab_size)]
+        if pack_length:
+            # Pack captions into long rows with block-diagonal causal masks
+            packed = pack_captions(
+                audio_latent=audio_latent, 
+                text_ids=text_ids, 
+                pad_token_id=pad_token_id, 
+                pack_length=pack_length
+            )
 
-        # Loss
-        loss = caption_loss(
-            output_seqs=output_seqs, 
-            input_seqs=input_seqs, 
-            ignore_index=pad_token_id
-        )
+            output_seqs = llm_decoder(
+                seqs=[packed["audio_latent"], packed["text_ids"]],
+                seq_types=seq_types,
+                mask=build_packed_mask(segment_ids=packed["segment_ids"], input_pos=packed["input_pos"]),
+                input_pos=packed["input_pos"],
+                compute_heads=[False, True],
+                return_latent=text_head is not None
+            )
+
+            loss = packed_caption_loss(
+                output_seqs=output_seqs, 
+                targets=packed["targets"], 
+                ignore_index=pad_token_id,
+                text_head=text_head,
+                chunk_size=loss_chunk_size
+            )
+
+        else:
+            input_seqs = [audio_latent, text_ids]
+
+            output_seqs = llm_decoder(
+                seqs=input_seqs,
+                seq_types=seq_types,
+                mask=None,
+                compute_heads=[False, True],  # The loss only uses text logits
+                return_latent=text_head is not None
+            )
+            # list of output, e.g., [(b, t_audio, audio_dim), (b, t_text, vocab_size)]
+
+            # Loss
+            loss = caption_loss(
+                output_seqs=output_seqs, 
+                input_seqs=input_seqs, 
+                ignore_index=pad_token_id,
+                text_head=text_head,
+                chunk_size=loss_chunk_size
+            )
 
         # Optimize
         optimizer.zero_grad()   # Reset all parameter.grad to 0
@@ -177,25 +304,30 @@ def train(args):
                 audio_encoder_name=audio_encoder_name, 
                 audio_encoder=audio_encoder, 
                 llm_decoder=llm_decoder, 
-                pad_token_id=pad_token_id
+                pad_token_id=pad_token_id,
+                embedding_cache=embedding_cache
             )
             test_loss = validate(
                 dataloader=eval_test_dataloader, 
                 audio_encoder_name=audio_encoder_name, 
                 audio_encoder=audio_encoder, 
                 llm_decoder=llm_decoder, 
-                pad_token_id=pad_token_id
+                pad_token_id=pad_token_id,
+                embedding_cache=embedding_cache
             )
 
             print("------ step: {} ------".format(step))
             print("Train loss: {}".format(train_loss))
             print("Test loss: {}".format(test_loss))
 
+            log = {"train_loss": train_loss, "test_loss": test_loss}
+
+            if bucket_batching:
+                log["padding_eliminated"] = 1. - padding[1].item() / max(padding[0].item(), 1)
+                print("Padded tokens eliminated: {:.1%}".format(log["padding_eliminated"]))
+
             if wandb_log:
-                wandb.log(
-                    data={"train_loss": train_loss, "test_loss": test_loss},
-                    step=step
-                )
+                wandb.log(data=log, step=step)
         
         # Save model
         if step % save_every_n_steps == 0:
@@ -265,16 +397,63 @@ def get_audio_latent(
         raise ValueError(model_name)        
 
 
+def get_cached_audio_latent(
+    embedding_cache: None | EmbeddingCache,
+    model_name: str, 
+    model: nn.Module, 
+    data: dict,
+    device: str
+) -> torch.Tensor:
+    r"""Same as get_audio_latent() of data["audio"], but look up the latents 
+    of the clips in embedding_cache by their audio paths and crops, and only 
+    move the missing clips to device and compute them."""
+
+    audio = data["audio"]  # shape: (b, c, t_audio)
+
+    if embedding_cache is None:
+        return get_audio_latent(model_name=model_name, model=model, audio=audio.to(device))
+
+    keys = [
+        embedding_cache.clip_key(audio_path=audio_path, start_time=start_time, duration=duration) 
+        for audio_path, start_time, duration in zip(data["audio_path"], data["start_time"].tolist(), data["duration"].tolist())
+    ]
+
+    latent = embedding_cache.get_or_compute(
+        keys=keys,
+        compute=lambda idxes: get_audio_latent(
+            model_name=model_name, model=model, audio=audio[idxes].to(device)
+        ).cpu().numpy()
+    )
+
+    return torch.from_numpy(latent).to(device)
+
+
 def caption_loss(
     output_seqs: list[torch.Tensor], 
     input_seqs: list[torch.Tensor], 
-    ignore_index: int
+    ignore_index: int,
+    text_head: None | nn.Linear = None,
+    chunk_size: None | int = None
 ) -> torch.float:
-    r"""Calculate caption loss."""
+    r"""Calculate caption loss.
+
+    With text_head, output_seqs are latents of llm_decoder(return_latent=True), 
+    and text_head and the loss are computed together in chunks of chunk_size 
+    steps without the logits of padded steps, see chunked_cross_entropy().
+    """
 
     output_audio_logits, output_text_logtis = output_seqs
     target_audio_latents, target_text_ids = input_seqs
 
+    if text_head is not None:
+        return chunked_cross_entropy(
+            latent=output_text_logtis[:, 0 : -1, :],  # shape: (B, T, D)
+            weight=text_head.weight,
+            targets=target_text_ids[:, 1 :],  # shape: (B, T)
+            ignore_index=ignore_index,
+            chunk_size=chunk_size
+        )
+
     loss = F.cross_entropy(
         input=output_text_logtis[:, 0 : -1, :].flatten(0, 1),  # shape: (B*T, V)
         target=target_text_ids[:, 1 :].flatten(0, 1),  # shape: (B*T,)
@@ -284,27 +463,66 @@ def caption_loss(
     return loss
 
 
+def packed_caption_loss(
+    output_seqs: list[torch.Tensor], 
+    targets: torch.Tensor, 
+    ignore_index: int,
+    text_head: None | nn.Linear = None,
+    chunk_size: None | int = None
+) -> torch.float:
+    r"""Calculate caption loss of packed rows, see pack_captions(). The same as 
+    caption_loss() of the unpacked captions."""
+
+    output_audio_logits, output_text_logtis = output_seqs
+
+    if text_head is not None:
+        return chunked_cross_entropy(
+            latent=output_text_logtis,  # shape: (B, T, D)
+            weight=text_head.weight,
+            targets=targets,  # shape: (B, T)
+            ignore_index=ignore_index,
+            chunk_size=chunk_size
+        )
+
+    loss = F.cross_entropy(
+        input=output_text_logtis.flatten(0, 1),  # shape: (B*T, V)
+        target=targets.flatten(0, 1),  # shape: (B*T,)
+        ignore_index=ignore_index
+    )
+
+    return loss
+
+
 def validate(
     dataloader: DataLoader, 
     audio_encoder_name: str,
-    audio_encoder: nn.Module, 
+    audio_encoder: None | nn.Module, 
     llm_decoder: nn.Module, 
     pad_token_id: int,
-    valid_steps=10
+    valid_steps=10,
+    embedding_cache: None | EmbeddingCache = None
 ) -> float:
     r"""Validate the model on part of data."""
 
-    device = next(audio_encoder.parameters()).device
+    device = next(llm_decoder.parameters()).device
     losses = []
 
     for step, data in enumerate(dataloader):
 
         # Move data to device
-        audio = data["audio"].to(device)  # shape: (b, t_audio)
         text_ids = data["target"].to(device)  # shape: (b, t_text)
         
         # Extract audio embeddings
-        audio_latent = get_audio_latent(model_name=audio_encoder_name, model=audio_encoder, audio=audio)
+        if "audio_latent" in data:
+            audio_latent = data["audio_latent"].to(device)  # shape: (b, t_audio, d)
+        else:
+            audio_latent = get_cached_audio_latent(
+                embedding_cache=embedding_cache,
+                model_name=audio_encoder_name, 
+                model=audio_encoder, 
+                data=data,
+                device=device
+            )
         
         # Combine audio embeddings and text ids
         input_seqs = [audio_latent, text_ids]
@@ -315,7 +533,8 @@ def validate(
         outputs = llm_decoder(
             seqs=input_seqs,
             seq_types=seq_types,
-            mask=None
+            mask=None,
+            compute_heads=[False, True]  # The loss only uses text logits
         )
 
         # Loss
@@ -0,0 +1,242 @@
+"""Distill a small draft Llama from a trained target Llama for speculative
+decoding (see models/speculative.py).
+"""
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from audidata.datasets import Clotho
+from audidata.io.crops import RandomCrop
+from audidata.samplers import InfiniteSampler, PseudoRandomSampler
+from audidata.transforms import Mono
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from data.text_normalization import TextNormalization
+from data.text_tokenization import BertTokenizer
+from models.speculative import init_draft_from_target
+from train import get_audio_encoder, get_audio_latent, get_llm_decoder
+
+
+def train_draft(args):
+
+    # Default parameters
+    sr = 32000
+    batch_size = 16
+    num_workers = 16
+    pin_memory = torch.cuda.is_available()
+    learning_rate = 1e-4
+    test_every_n_steps = 200
+    save_every_n_steps = 2000
+    training_steps = args.training_steps
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    max_length = 30
+    clip_duration = 10.
+    audio_encoder_name = "Cnn14"
+    llm_decoder_name = "Llama"
+
+    filename = Path(__file__).stem
+
+    # Dataset
+    root = "/root/autodl-tmp/datasets/clotho" # Change to local path
+
+    # Checkpoints directory
+    model_name = "{}_{}_draft_{}layers".format(audio_encoder_name, llm_decoder_name, args.n_layer)
+    ckpts_dir = Path("./checkpoints", filename, model_name)
+    Path(ckpts_dir).mkdir(parents=True, exist_ok=True)
+
+    crop = RandomCrop(clip_duration=clip_duration, end_pad=0.)
+
+    target_transform = [
+        TextNormalization(),
+        BertTokenizer(max_length=max_length)
+    ]
+    pad_token_id = target_transform[1].tokenizer.pad_token_id
+    text_vocab_size = target_transform[1].tokenizer.vocab_size
+
+    train_dataset = Clotho(
+        root=root,
+        split="train",
+        sr=sr,
+        crop=crop,
+        transform=Mono(),
+        target_transform=target_transform
+    )
+
+    test_dataset = Clotho(
+        root=root,
+        split="test",
+        sr=sr,
+        crop=crop,
+        transform=Mono(),
+        target_transform=target_transform
+    )
+
+    train_dataloader = DataLoader(
+        dataset=train_dataset,
+        batch_size=batch_size,
+        sampler=InfiniteSampler(train_dataset),
+        num_workers=num_workers,
+        pin_memory=pin_memory
+    )
+
+    test_dataloader = DataLoader(
+        dataset=test_dataset,
+        batch_size=batch_size,
+        sampler=PseudoRandomSampler(test_dataset),
+        num_workers=num_workers,
+        pin_memory=pin_memory
+    )
+
+    # Pretrained audio encoder
+    audio_encoder, audio_latent_dim = get_audio_encoder(model_name=audio_encoder_name)
+    audio_encoder.to(device)
+
+    # Frozen target decoder
+    target = get_llm_decoder(
+        model_name=llm_decoder_name,
+        audio_latent_dim=audio_latent_dim,
+        text_vocab_size=text_vocab_size
+    )
+    target.load_state_dict(torch.load(args.target_ckpt_path, map_location=device))
+    target.to(device)
+    target.eval()
+
+    # Draft decoder initialized from the first blocks of the target
+    draft = init_draft_from_target(target=target, n_layer=args.n_layer)
+    draft.to(device)
+
+    optimizer = optim.AdamW(params=draft.parameters(), lr=learning_rate)
+
+    for step, data in enumerate(tqdm(train_dataloader)):
+
+        audio = data["audio"].to(device)  # shape: (b, c, t_audio)
+        text_ids = data["target"].to(device)  # shape: (b, t_text)
+
+        audio_latent = get_audio_latent(
+            model_name=audio_encoder_name,
+            model=audio_encoder, audio=audio
+        )
+
+        draft.train()
+        loss = distillation_loss(
+            target=target,
+            draft=draft,
+            audio_latent=audio_latent,
+            text_ids=text_ids,
+            pad_token_id=pad_token_id
+        )
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        if step % test_every_n_steps == 0:
+            test_loss = validate(
+                dataloader=test_dataloader,
+                audio_encoder_name=audio_encoder_name,
+                audio_encoder=audio_encoder,
+                target=target,
+                draft=draft,
+                pad_token_id=pad_token_id
+            )
+            print("------ step: {} ------".format(step))
+            print("Train KL: {}".format(loss.item()))
+            print("Test KL: {}".format(test_loss))
+
+        if step % save_every_n_steps == 0:
+            ckpt_path = Path(ckpts_dir, "step={}.pth".format(step))
+            torch.save(draft.state_dict(), ckpt_path)
+            print("Save model to {}".format(ckpt_path))
+
+        if step == training_steps:
+            break
+
+
+def distillation_loss(
+    target: torch.nn.Module,
+    draft: torch.nn.Module,
+    audio_latent: torch.Tensor,
+    text_ids: torch.Tensor,
+    pad_token_id: int
+) -> torch.Tensor:
+    r"""KL(target || draft) of the next token distributions at the caption
+    steps. Matching the target distribution, rather than the captions, is
+    what raises the acceptance rate of speculative decoding."""
+
+    seqs = [audio_latent, text_ids]
+    seq_types = ["audio", "text"]
+
+    with torch.no_grad():
+        target_logits = target(seqs=seqs, seq_types=seq_types, compute_heads=[False, True])[1]
+
+    draft_logits = draft(seqs=seqs, seq_types=seq_types, compute_heads=[False, True])[1]
+    # shape: (b, t_text, v)
+
+    # Steps that predict a caption token
+    valid = (text_ids[:, 1 :] != pad_token_id).flatten()  # shape: (b*t,)
+
+    kl = F.kl_div(
+        input=F.log_softmax(draft_logits[:, 0 : -1, :].flatten(0, 1), dim=-1)[valid],
+        target=F.log_softmax(target_logits[:, 0 : -1, :].flatten(0, 1), dim=-1)[valid],
+        log_target=True,
+        reduction="batchmean"
+    )
+
+    return kl
+
+
+def validate(
+    dataloader: DataLoader,
+    audio_encoder_name: str,
+    audio_encoder: torch.nn.Module,
+    target: torch.nn.Module,
+    draft: torch.nn.Module,
+    pad_token_id: int,
+    valid_steps=10
+) -> float:
+    r"""Distillation loss on part of data."""
+
+    device = next(audio_encoder.parameters()).device
+    losses = []
+
+    for step, data in enumerate(dataloader):
+
+        audio = data["audio"].to(device)
+        text_ids = data["target"].to(device)
+
+        audio_latent = get_audio_latent(
+            model_name=audio_encoder_name,
+            model=audio_encoder, audio=audio
+        )
+
+        draft.eval()
+        with torch.no_grad():
+            loss = distillation_loss(
+                target=target,
+                draft=draft,
+                audio_latent=audio_latent,
+                text_ids=text_ids,
+                pad_token_id=pad_token_id
+            )
+        losses.append(loss.item())
+
+        if step == valid_steps:
+            break
+
+    return np.mean(losses)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target_ckpt_path", type=str, default="inference/step=10000.pth")
+    parser.add_argument("--n_layer", type=int, default=2)
+    parser.add_argument("--training_steps", type=int, default=10000)
+    args = parser.parse_args()
+
+    train_draft(args)